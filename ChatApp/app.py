@@ -1,20 +1,36 @@
 import os
+import async_mode
+# Under eventlet/gevent every blocking call (PyMySQL sockets, pool locks,
+# Redis listeners) must be cooperative or one query stalls the hub, so patch
+# for the same mode SocketIO will run, before anything imports socket
+if async_mode.GREEN:
+    async_mode.monkey_patch()
 import re
 import uuid
 import base64
+import hashlib
 import imghdr
 import emoji
 import secrets
 from datetime import datetime, timezone, timedelta
-from functools import wraps
+from functools import partial, wraps
 from flask import (
 Flask, render_template, request, jsonify, session,
-send_from_directory, redirect, url_for, abort
+send_from_directory, send_file, redirect, url_for, abort
 )
+from werkzeug.exceptions import HTTPException
 import mimetypes
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from werkzeug.utils import secure_filename, safe_join
 from database import Database
+from uploads import ChunkedUploadStore, UploadError
+from blob_store import BlobStore
+from upload_index import UploadNameIndex
+from thumbnails import ThumbnailService
+from presence import PresenceService
+from read_receipts import GroupSeenAggregator, ReadReceiptBatcher
+from cluster import InvalidationBus, SharedPresence, connect_shared_state
+from request_session import init_request_sessions
 
 
 def convert_datetime(obj):
@@ -34,7 +50,9 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-app = Flask(__name__)
+# Built-in static route disabled: /static is served by serve_static (endpoint
+# 'static', so url_for('static', ...) keeps working) to reach blob/legacy lookups
+app = Flask(__name__, static_folder=None)
 # Core configuration (env-overridable for deployment)
 app.config['SECRET_KEY'] = 
 app.config['MAX_CONTENT_LENGTH'] = 
@@ -43,26 +61,190 @@ app.config['FILES_UPLOAD_FOLDER'] =
 app.config['JSON_SORT_KEYS'] = 
 app.config['JSON_AS_ASCII'] = 
 app.config['PREFERRED_URL_SCHEME'] = 
+# Let nginx/apache stream downloads (X-Sendfile) when deployed behind one
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', '0') == '1'
+# Partial chunked uploads (kept outside static/ so they are never served)
+app.config['UPLOAD_TEMP_FOLDER'] = os.getenv('UPLOAD_TEMP_FOLDER', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads_tmp'))
+# Generated image previews, keyed by the source blob's hash
+app.config['THUMBNAIL_FOLDER'] = os.getenv('THUMBNAIL_FOLDER', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads', 'thumbs'))
 
 
-# Socket.IO: prefer eventlet if available; allow tuning via env
-_async_mode = os.getenv('SOCKETIO_ASYNC_MODE') or None  # let flask-socketio choose best
+# Socket.IO: SOCKETIO_ASYNC_MODE or the best installed (see async_mode.py)
 socketio = SocketIO(
     app,
     cors_allowed_origins=os.getenv('CORS_ALLOWED_ORIGINS', '*'),
-    async_mode=_async_mode,
+    async_mode=async_mode.ASYNC_MODE,
     ping_interval=float(os.getenv('SOCKETIO_PING_INTERVAL', '25')),
     ping_timeout=float(os.getenv('SOCKETIO_PING_TIMEOUT', '60')),
-    max_http_buffer_size=app.config['MAX_CONTENT_LENGTH']  # cap payloads
+    max_http_buffer_size=app.config['MAX_CONTENT_LENGTH'],  # cap payloads
+    # Multi-worker mode: rooms and emits are relayed between workers through
+    # this queue (e.g. redis://localhost:6379/0); see README for sticky sessions
+    message_queue=os.getenv('SOCKETIO_MESSAGE_QUEUE') or None,
+    channel=os.getenv('SOCKETIO_CHANNEL', 'flask-socketio'),
 )
 db = Database()
+app.logger.info('Async mode %s, DB pool %s', async_mode.ASYNC_MODE, db.pool_kind)
 db.create_tables()
 
+# Per-worker caches/counters move to Redis (or are invalidated through it)
+# when more than one worker serves the app
+_shared_state_url = os.getenv('SHARED_STATE_URL') or (
+    os.getenv('SOCKETIO_MESSAGE_QUEUE') if (os.getenv('SOCKETIO_MESSAGE_QUEUE') or '').startswith(('redis://', 'rediss://')) else None
+)
+shared_state = connect_shared_state(_shared_state_url)
+invalidation_bus = InvalidationBus(shared_state, sleep=socketio.sleep)
+if shared_state is not None:
+    db.use_shared_state(shared_state, invalidation_bus)
+    socketio.start_background_task(invalidation_bus.run)
+# Warm the employee directory so the first messages don't pay for it
+try:
+    db.employees.refresh()
+except Exception:
+    app.logger.exception('Failed to preload employee directory')
+
+# Presence is held in memory and written/broadcast in debounced batches
+presence = PresenceService(
+    db,
+    publish=lambda diff: socketio.emit('presence_update', diff),
+    debounce=float(os.getenv('PRESENCE_DEBOUNCE_SECONDS', '3')),
+    flush_interval=float(os.getenv('PRESENCE_FLUSH_INTERVAL', '1')),
+    sleep=socketio.sleep,
+    shared=SharedPresence(shared_state) if shared_state is not None else None,
+)
+socketio.start_background_task(presence.run)
+
+# "Read up to N" receipts; a burst of them becomes one UPDATE and one emit
+read_receipts = ReadReceiptBatcher(
+    db,
+    publish_read=lambda reader_id, sender_id, up_to_id: socketio.emit(
+        'message_read', {'reader_id': reader_id, 'up_to_id': up_to_id}, room=sender_id),
+    publish_counts=lambda user_id: socketio.emit(
+        'unread_counts_update', db.unread_ledger.snapshot(user_id), room=user_id),
+    window=float(os.getenv('READ_RECEIPT_WINDOW_SECONDS', '0.25')),
+    sleep=socketio.sleep,
+)
+socketio.start_background_task(read_receipts.run)
+
+# Group "seen" deltas, at most one broadcast per group room per window
+group_seen = GroupSeenAggregator(
+    publish=lambda group_id, updates: socketio.emit(
+        'group_message_seen_update', {'group_id': group_id, 'updates': updates}, room=f'group_{group_id}'),
+    window=float(os.getenv('GROUP_SEEN_WINDOW_SECONDS', '1')),
+    sleep=socketio.sleep,
+)
+socketio.start_background_task(group_seen.run)
+
 
 # Ensure upload directories exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['FILES_UPLOAD_FOLDER'], exist_ok=True)
 
+# Content-addressed stores behind the 'uploads/images' and 'uploads/files' URLs
+blob_stores = {
+    'uploads/images': BlobStore(app.config['UPLOAD_FOLDER'], index=db),
+    'uploads/files': BlobStore(app.config['FILES_UPLOAD_FOLDER'], index=db),
+}
+
+# Basename/suffix indexes for legacy upload names (replaces per-request listdir)
+legacy_upload_indexes = {
+    'uploads/images': UploadNameIndex(os.path.join(app.root_path, 'static', 'uploads', 'images')),
+    'uploads/files': UploadNameIndex(os.path.join(app.root_path, 'static', 'uploads', 'files')),
+}
+for _index in legacy_upload_indexes.values():
+    _index.refresh()
+
+# Thumbnails are rendered off the request path by a small worker pool
+thumbnails = ThumbnailService(app.config['THUMBNAIL_FOLDER'], workers=int(os.getenv('THUMBNAIL_WORKERS', '2')))
+if not thumbnails.enabled:
+    app.logger.warning('Pillow not installed; image thumbnails disabled')
+
+def upload_disk_path(media_url):
+    """Disk path for a stored 'uploads/images|files/<name>' URL, or None"""
+    rel = (media_url or '').replace('\\', '/').lstrip('/')
+    if rel.startswith('static/'):
+        rel = rel[len('static/'):]
+    for prefix, store in blob_stores.items():
+        if rel.startswith(prefix + '/'):
+            return store.locate(rel)
+    if rel.startswith('uploads/thumbs/'):
+        return thumbnails.locate(rel)
+    return None
+
+def attach_thumbnails(messages):
+    """Set thumb_url/preview_url on image messages, queueing any missing variants"""
+    for message in messages:
+        media_url = message.get('media_url') or ''
+        if 'uploads/images/' not in media_url:
+            continue
+        message['thumb_url'] = message['preview_url'] = None
+        digest = thumbnails.digest_of(media_url)
+        variants = thumbnails.variants(digest)
+        if len(variants) < len(thumbnails.sizes):
+            # Images uploaded before thumbnails existed are rendered on first view
+            thumbnails.submit(upload_disk_path(media_url), digest)
+        if variants:
+            sizes = sorted(variants)
+            message['thumb_url'] = f"/static/uploads/thumbs/{variants[sizes[0]]}"
+            message['preview_url'] = f"/static/uploads/thumbs/{variants[sizes[-1]]}"
+    return messages
+
+# Blob names are '<sha256>.<ext>': the name pins the content forever
+# (thumbnail variants add '-<size>': '<sha256>-<size>.<fmt>')
+_HASHED_NAME_RE = re.compile(r'^([0-9a-f]{64}(?:-\d+)?)(?:\.[A-Za-z0-9]+)?$')
+IMMUTABLE_MAX_AGE = 31536000
+STATIC_ROOT = os.path.join(app.root_path, 'static')
+
+def send_media(path, public=True, **kwargs):
+    """
+    send_file with conditional GET and Range support. Content-addressed blobs
+    use their hash as a strong ETag and are cached as immutable for a year;
+    anything else gets a validator and must be revalidated.
+    """
+    match = _HASHED_NAME_RE.match(os.path.basename(path))
+    if not match:
+        return send_file(path, conditional=True, **kwargs)
+    resp = send_file(path, conditional=True, etag=match.group(1), max_age=IMMUTABLE_MAX_AGE, **kwargs)
+    resp.cache_control.immutable = True
+    if not public:
+        resp.cache_control.public = False
+        resp.cache_control.private = True
+    return resp
+
+# (size, mtime, version) per static file, so assets are hashed once per change
+_asset_versions = {}
+
+def asset_version(filename):
+    """Short content hash of a file under static/, or None if it doesn't exist"""
+    path = safe_join(STATIC_ROOT, filename or '')
+    try:
+        st = os.stat(path) if path else None
+    except OSError:
+        st = None
+    if st is None or not os.path.isfile(path):
+        return None
+    cached = _asset_versions.get(filename)
+    if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+        return cached[2]
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(64 * 1024), b''):
+            sha.update(block)
+    version = sha.hexdigest()[:12]
+    _asset_versions[filename] = (st.st_size, st.st_mtime, version)
+    return version
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    """url_for('static', ...) emits '?v=<content hash>' so assets can be cached as immutable"""
+    if endpoint != 'static' or 'v' in values:
+        return
+    filename = values.get('filename') or ''
+    if filename.startswith('uploads/'):
+        return  # already content-addressed
+    version = asset_version(filename)
+    if version:
+        values['v'] = version
+
 # Optional: compression (best-effort)
 try:
     from flask_compress import Compress  # type: ignore
@@ -70,6 +252,30 @@ try:
 except Exception:
     pass
 
+def unit_of_work(handler):
+    """Run a Socket.IO event handler on one pooled connection with a single commit"""
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        with db.session():
+            return handler(*args, **kwargs)
+    return wrapper
+
+def emit_after_commit(event, data, room):
+    """socketio.emit once the current unit of work has committed (now outside one)"""
+    db.after_commit(partial(socketio.emit, event, data, room=room))
+
+def emit_unread_counts_after_commit(user_ids, seeded_only=False):
+    """Send each user's combined unread counts once the ledger deltas are applied"""
+    def send():
+        for uid in user_ids:
+            try:
+                if seeded_only and not db.unread_ledger.is_seeded(uid):
+                    continue  # not connected since startup; seeded on connect
+                socketio.emit('unread_counts_update', db.unread_ledger.snapshot(uid), room=uid)
+            except Exception:
+                app.logger.exception('Failed to emit unread counts for %s', uid)
+    db.after_commit(send)
+
 # Security headers for basic hardening
 @app.after_request
 def add_security_headers(resp):
@@ -97,6 +303,10 @@ def add_security_headers(resp):
         pass
     return resp
 
+# One DB session per HTTP request, committed (or rolled back on errors)
+# before the response goes out; registered last so it runs first
+init_request_sessions(app, db)
+
 """
 Allowed types
 - images: only jpeg/jpg and png (gif/webp removed per requirement)
@@ -117,9 +327,66 @@ ALLOWED_DOC_MIME_PREFIXES = {
     'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
 }
 
+def classify_upload(head_bytes, mime, original_filename):
+    """Validate an upload from its leading bytes, mime hint and name.
+
+    Returns (True, (ext, base_dir, rel_dir)) or (False, error_msg)
+    """
+    # Determine type and extension
+    filename = secure_filename(original_filename or 'attachment')
+    ext = os.path.splitext(filename)[1].lower().lstrip('.')
+
+    # Heuristic: if image/* or imghdr detects image -> treat as image
+    file_type = imghdr.what(None, head_bytes)
+    is_image = False
+    if mime and mime.startswith('image/'):
+        is_image = True
+    if file_type:
+        is_image = True
+
+    if is_image:
+        # Restrict to jpeg/jpg/png
+        kind = (file_type or '').lower()
+        if not kind and mime:
+            kind = mime.split('/')[-1]
+        if kind == 'jpg':
+            kind = 'jpeg'
+        if kind not in ALLOWED_IMAGE_TYPES:
+            return False, 'Invalid image format. Allowed: JPEG, PNG'
+        # Normalize extension
+        ext = 'jpg' if kind == 'jpeg' else 'png'
+        base_dir = app.config['UPLOAD_FOLDER']
+        # Always use forward slashes for stored URLs
+        rel_dir = 'uploads/images'
+    else:
+        # Documents
+        # Validate by mime or extension
+        valid_by_mime = (mime in ALLOWED_DOC_MIME_PREFIXES) if mime else False
+        valid_by_ext = ext in ALLOWED_DOC_EXTS
+        if not (valid_by_mime or valid_by_ext):
+            return False, 'Unsupported file type. Allowed: PDF, Word, Excel'
+
+        # Basic signature checks to reduce spoofing
+        if ext == 'pdf' and not head_bytes.startswith(b'%PDF'):
+            return False, 'Invalid PDF file'
+        if ext in {'docx', 'xlsx'} and not head_bytes.startswith(b'PK'):
+            return False, 'Invalid Office file'
+        if ext in {'doc', 'xls'} and not (head_bytes[:8] == b"\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1"):
+            # Old OLE header
+            return False, 'Invalid legacy Office file'
+
+        base_dir = app.config['FILES_UPLOAD_FOLDER']
+        # Always use forward slashes for stored URLs
+        rel_dir = 'uploads/files'
+
+    return True, (ext, base_dir, rel_dir)
+
 def save_uploaded_file(file_data, original_filename):
     """Save uploaded image or document to filesystem with dedup by hash.
 
+    Legacy path for base64 data URLs sent inside socket payloads; new clients
+    upload through /uploads and reference the result by upload_id.
+
     Returns (True, relative_path) or (False, error_msg)
     relative_path is under 'uploads/images' or 'uploads/files'
     """
@@ -142,62 +409,15 @@ def save_uploaded_file(file_data, original_filename):
         if len(file_bytes) > app.config['MAX_CONTENT_LENGTH']:
             return False, f"File size exceeds {app.config['MAX_CONTENT_LENGTH'] / (1024 * 1024)}MB"
 
-        # Determine type and extension
-        filename = secure_filename(original_filename or 'attachment')
-        ext = os.path.splitext(filename)[1].lower().lstrip('.')
-
-        # Heuristic: if image/* or imghdr detects image -> treat as image
-        file_type = imghdr.what(None, file_bytes)
-        is_image = False
-        if mime and mime.startswith('image/'):
-            is_image = True
-        if file_type:
-            is_image = True
-
-        if is_image:
-            # Restrict to jpeg/jpg/png
-            kind = (file_type or '').lower()
-            if not kind and mime:
-                kind = mime.split('/')[-1]
-            if kind == 'jpg':
-                kind = 'jpeg'
-            if kind not in ALLOWED_IMAGE_TYPES:
-                return False, 'Invalid image format. Allowed: JPEG, PNG'
-            # Normalize extension
-            ext = 'jpg' if kind == 'jpeg' else 'png'
-            base_dir = app.config['UPLOAD_FOLDER']
-            # Always use forward slashes for stored URLs
-            rel_dir = 'uploads/images'
-        else:
-            # Documents
-            # Validate by mime or extension
-            valid_by_mime = (mime in ALLOWED_DOC_MIME_PREFIXES) if mime else False
-            valid_by_ext = ext in ALLOWED_DOC_EXTS
-            if not (valid_by_mime or valid_by_ext):
-                return False, 'Unsupported file type. Allowed: PDF, Word, Excel'
-
-            # Basic signature checks to reduce spoofing
-            if ext == 'pdf' and not file_bytes.startswith(b'%PDF'):
-                return False, 'Invalid PDF file'
-            if ext in {'docx', 'xlsx'} and not file_bytes.startswith(b'PK'):
-                return False, 'Invalid Office file'
-            if ext in {'doc', 'xls'} and not (file_bytes[:8] == b"\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1"):
-                # Old OLE header
-                return False, 'Invalid legacy Office file'
-
-            base_dir = app.config['FILES_UPLOAD_FOLDER']
-            # Always use forward slashes for stored URLs
-            rel_dir = 'uploads/files'
-
-        # Deduplicate by content hash
-        import hashlib
-        file_hash = hashlib.sha256(file_bytes).hexdigest()
-        dedup_filename = f"{file_hash}.{ext}" if ext else file_hash
-        file_path = os.path.join(base_dir, dedup_filename)
-
-        if not os.path.exists(file_path):
-            with open(file_path, 'wb') as f:
-                f.write(file_bytes)
+        ok, classified = classify_upload(file_bytes[:64], mime, original_filename)
+        if not ok:
+            return False, classified
+        ext, base_dir, rel_dir = classified
+
+        # Deduplicate by content hash (skips the write for known blobs)
+        dedup_filename = blob_stores[rel_dir].put_bytes(file_bytes, ext, mime)
+        if rel_dir == 'uploads/images':
+            thumbnails.submit(blob_stores[rel_dir].locate(dedup_filename))
 
         # Return URL-ish path with forward slashes regardless of OS
         return True, f"{rel_dir}/{dedup_filename}"
@@ -205,6 +425,91 @@ def save_uploaded_file(file_data, original_filename):
         app.logger.error(f"Error saving file: {str(e)}", exc_info=True)
         return False, f"Error processing file: {str(e)}"
 
+def finalize_chunked_upload(upload):
+    """ChunkedUploadStore callback: validate the assembled temp file and move it into place"""
+    ok, classified = classify_upload(upload.head, upload.mime, upload.filename)
+    if not ok:
+        return False, classified
+    ext, base_dir, rel_dir = classified
+    dedup_filename = blob_stores[rel_dir].put_file(
+        upload.temp_path, upload.sha256.hexdigest(), ext, upload.size, upload.mime
+    )
+    if rel_dir == 'uploads/images':
+        thumbnails.submit(blob_stores[rel_dir].locate(dedup_filename))
+    return True, {
+        'media_url': f"{rel_dir}/{dedup_filename}",
+        'media_type': 'image' if rel_dir == 'uploads/images' else 'file',
+        'file_size': upload.size,
+        'filename': secure_filename(upload.filename or '') or dedup_filename,
+    }
+
+upload_store = ChunkedUploadStore(
+    app.config['UPLOAD_TEMP_FOLDER'],
+    max_size=app.config['MAX_CONTENT_LENGTH'],
+    finalize=finalize_chunked_upload,
+    chunk_size=int(os.getenv('UPLOAD_CHUNK_SIZE', str(1024 * 1024))),
+)
+
+def _upload_error_response(e):
+    body = {'error': str(e)}
+    if e.offset is not None:
+        body['offset'] = e.offset
+    return jsonify(body), e.status
+
+@app.route('/uploads', methods=['POST'])
+@login_required
+def create_upload():
+    """Start a resumable upload: {filename, size, mime_type} -> {upload_id, offset, chunk_size}"""
+    data = request.get_json(silent=True) or {}
+    try:
+        upload = upload_store.create(
+            session['user_id'],
+            (data.get('filename') or '').strip(),
+            int(data.get('size') or 0),
+            data.get('mime_type'),
+        )
+    except UploadError as e:
+        return _upload_error_response(e)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid upload request'}), 400
+    body = upload.to_dict()
+    body['chunk_size'] = upload_store.chunk_size
+    return jsonify(body), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    """Current offset (to resume from) and, once complete, the stored file details"""
+    try:
+        return jsonify(upload_store.get(upload_id, session['user_id']).to_dict())
+    except UploadError as e:
+        return _upload_error_response(e)
+
+@app.route('/uploads/<upload_id>', methods=['PUT', 'PATCH'])
+@login_required
+def upload_chunk(upload_id):
+    """Append the raw request body at Upload-Offset (or ?offset=)"""
+    offset = request.headers.get('Upload-Offset', request.args.get('offset'))
+    try:
+        offset = int(offset)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Missing Upload-Offset'}), 400
+    try:
+        upload = upload_store.append(upload_id, session['user_id'], offset, request.stream)
+    except UploadError as e:
+        return _upload_error_response(e)
+    except Exception:
+        app.logger.exception('upload_chunk failed')
+        return jsonify({'error': 'Upload failed'}), 500
+    return jsonify(upload.to_dict())
+
+def resolve_upload_token(upload_id, user_id):
+    """(True, stored-file dict) for a completed upload owned by user_id, else (False, error)"""
+    try:
+        return True, upload_store.resolve(str(upload_id), user_id)
+    except UploadError as e:
+        return False, str(e)
+
 @app.route('/offline.html')
 def offline_page():
     # Serve offline template for PWA fallback
@@ -212,35 +517,56 @@ def offline_page():
 
 @app.route('/sw.js')
 def service_worker():
-    return send_from_directory('.', 'sw.js', mimetype='application/javascript')
+    """
+    sw.js with its precached '/static/...' URLs rewritten to their versioned
+    form, and the cache name tied to those versions so an asset change
+    installs a fresh cache.
+    """
+    with open(os.path.join(app.root_path, 'sw.js'), encoding='utf-8') as f:
+        source = f.read()
+    versioned = []
+
+    def _versioned_url(match):
+        url = url_for('static', filename=match.group(1))
+        versioned.append(url)
+        return f"'{url}'"
+
+    source = re.sub(r"'/static/([^'?#]+)'", _versioned_url, source)
+    digest = hashlib.sha256('\n'.join(versioned).encode('utf-8')).hexdigest()[:8]
+    source = re.sub(r"(const CACHE_NAME = '[^']+)'", lambda m: f"{m.group(1)}-{digest}'", source, count=1)
+    resp = app.response_class(source, mimetype='application/javascript')
+    resp.cache_control.no_cache = True
+    return resp
 
-@app.route('/static/<path:filename>')
+@app.route('/static/<path:filename>', endpoint='static')
 def serve_static(filename):
     """Serve static files safely with fallback for legacy image names"""
     try:
+        if '/.' in '/' + filename:
+            # Dot-segments cover in-progress blob writes (uploads/*/.tmp)
+            return jsonify({'error': 'File not found'}), 404
         # Ensure the requested path resolves under the static directory
         safe_path = safe_join(app.root_path, 'static', filename)
-        if safe_path and os.path.exists(safe_path):
-            # Use the original subpath for send_from_directory
-            return send_from_directory('static', filename)
-
-        # Legacy fallback: try to match uploads by basename only (images)
-        if filename.startswith('uploads/images/'):
-            legacy_name = os.path.basename(filename)
-            uploads_dir = os.path.join(app.root_path, 'static', 'uploads', 'images')
-            if os.path.exists(uploads_dir):
-                for f in os.listdir(uploads_dir):
-                    if f.endswith(legacy_name):
-                        return send_from_directory(uploads_dir, f)
-
-        # Legacy fallback for files
-        if filename.startswith('uploads/files/'):
-            legacy_name = os.path.basename(filename)
-            files_dir = os.path.join(app.root_path, 'static', 'uploads', 'files')
-            if os.path.exists(files_dir):
-                for f in os.listdir(files_dir):
-                    if f.endswith(legacy_name):
-                        return send_from_directory(files_dir, f)
+        if safe_path and os.path.isfile(safe_path):
+            version = request.args.get('v')
+            if version and version == asset_version(filename):
+                # Versioned asset URL: a content change produces a new URL
+                resp = send_file(safe_path, conditional=True, max_age=IMMUTABLE_MAX_AGE)
+                resp.cache_control.immutable = True
+                return resp
+            return send_media(safe_path)
+
+        # Content-addressed uploads live in fan-out directories
+        blob_path = upload_disk_path(filename)
+        if blob_path:
+            return send_media(blob_path)
+
+        # Legacy fallback: match uploads by basename/suffix via the in-memory index
+        for prefix, index in legacy_upload_indexes.items():
+            if filename.startswith(prefix + '/'):
+                stored = index.find(os.path.basename(filename))
+                if stored:
+                    return send_media(safe_join(index.directory, stored))
 
         app.logger.warning(f"[404] File not found: {filename}")
         return send_from_directory('static/images', 'error-image.png'), 404
@@ -252,7 +578,7 @@ def serve_static(filename):
 @app.route('/download/<int:message_id>')
 def download_message_file(message_id):
     try:
-        message = db.get_message_by_id(message_id)
+        message = db.get_message_media(message_id)
         if not message:
             abort(404)
         media_url = message.get('media_url')
@@ -260,61 +586,55 @@ def download_message_file(message_id):
         if not media_url:
             abort(404)
 
-        # Normalize relative path to disk path (handle leading '/' and backslashes)
-        rel = media_url
-        rel = rel.replace('\\', '/')
-        if rel.startswith('/'):
-            rel = rel[1:]
-        if rel.startswith('static/'):
-            rel = rel[len('static/'):]
-        # Some rows may accidentally prefix text before 'uploads/...'
-        uploads_idx = rel.find('uploads/')
-        if uploads_idx > 0:
-            rel = rel[uploads_idx:]
-        disk_path = safe_join(app.root_path, 'static', rel)
-
-        # Fallback: search by basename in images/files directories if path missing
-        if not disk_path or not os.path.exists(disk_path):
-            base = os.path.basename(rel)
-            candidates = [
-                os.path.join(app.root_path, 'static', 'uploads', 'files', base),
-                os.path.join(app.root_path, 'static', 'uploads', 'images', base)
-            ]
-            found = None
-            for c in candidates:
-                if os.path.exists(c):
-                    found = c
-                    break
-            if not found:
-                # try search by extension match (hash names scenario)
-                files_dir = os.path.join(app.root_path, 'static', 'uploads', 'files')
-                images_dir = os.path.join(app.root_path, 'static', 'uploads', 'images')
-                for d in (files_dir, images_dir):
-                    if os.path.isdir(d):
-                        for f in os.listdir(d):
-                            if os.path.splitext(f)[1].lower() == os.path.splitext(base)[1].lower():
-                                found = os.path.join(d, f)
-                                break
-                    if found:
+        # Indexed rows resolve deterministically to one blob
+        disk_path = None
+        if message.get('blob_name'):
+            store = blob_stores.get(f"uploads/{message['kind']}")
+            if store:
+                disk_path = store.locate(message['blob_name'])
+
+        if not disk_path:
+            # Not indexed yet: normalize the stored URL (handle leading '/' and backslashes)
+            rel = media_url
+            rel = rel.replace('\\', '/')
+            if rel.startswith('/'):
+                rel = rel[1:]
+            if rel.startswith('static/'):
+                rel = rel[len('static/'):]
+            # Some rows may accidentally prefix text before 'uploads/...'
+            uploads_idx = rel.find('uploads/')
+            if uploads_idx > 0:
+                rel = rel[uploads_idx:]
+            disk_path = safe_join(app.root_path, 'static', rel)
+            if not disk_path or not os.path.exists(disk_path):
+                disk_path = upload_disk_path(rel)
+
+            # Fallback: same basename in the other upload directory
+            if not disk_path:
+                base = os.path.basename(rel)
+                for store in blob_stores.values():
+                    disk_path = store.locate(base)
+                    if disk_path:
                         break
-            disk_path = found
 
         if not disk_path or not os.path.exists(disk_path):
             abort(404)
 
-        directory = os.path.dirname(disk_path)
-        basename = os.path.basename(disk_path)
-
         inline = request.args.get('inline') == '1'
-        guessed_type, _ = mimetypes.guess_type(filename or basename)
+        guessed_type, _ = mimetypes.guess_type(filename or os.path.basename(disk_path))
         as_attachment = not inline
-        return send_from_directory(
-            directory,
-            basename,
+        # send_file hands the open file to the server's wsgi.file_wrapper
+        # (sendfile) or to the front proxy when USE_X_SENDFILE is enabled;
+        # the message -> blob mapping never changes, so blobs cache privately
+        return send_media(
+            disk_path,
+            public=False,
             as_attachment=as_attachment,
             download_name=filename,
             mimetype=guessed_type or None
         )
+    except HTTPException:
+        raise
     except Exception:
         app.logger.exception('download_message_file failed')
         abort(404)
@@ -367,42 +687,40 @@ def index():
     })
 
 @socketio.on('connect')
+@unit_of_work
 def handle_connect():
     user_id = (session.get('user_id') or '').strip()
     if not user_id:
         return False  # reject unauthenticated connections
     join_room(user_id)
-    db.update_user_status(user_id, True)
-    # Notify all clients about the user connection
-    socketio.emit('user_connected', {'user_id': user_id})
-    # Send initial unread counts for both direct and group messages
-    unread_counts = db.get_user_unread_counts(user_id)
-    group_unread_counts = db.get_user_group_unread_counts(user_id)
-    combined_counts = {**unread_counts, **group_unread_counts}
-    emit('unread_counts_update', combined_counts)
+    # Only the user's first socket marks them online; persisted and broadcast
+    # (as part of a presence_update diff) by the presence flush loop
+    presence.connect(user_id, request.sid)
+    # Seed the unread ledger from the database once per connect; later
+    # updates are applied as deltas by the Database write paths
+    combined_counts = db.unread_ledger.seed(user_id)
+    emit_after_commit('unread_counts_update', combined_counts, request.sid)
 
     # Auto-subscribe this socket to all group rooms the user belongs to.
     # This ensures real-time group events (including notifications) are received
     # even when the user is not actively viewing that group in the UI.
     try:
-        groups = db.get_user_groups(user_id) or []
-        for g in groups:
-            gid = g.get('id')
-            if gid is not None:
-                join_room(f'group_{gid}')
+        for gid in db.memberships.groups(user_id):
+            join_room(f'group_{gid}')
     except Exception:
         app.logger.exception('Failed to join group rooms on connect')
 
 @socketio.on('disconnect')
+@unit_of_work
 def handle_disconnect():
     user_id = session.get('user_id')
     if user_id:
         leave_room(user_id)
-        db.update_user_status(user_id, False)
-        # Notify all clients about the user disconnection
-        socketio.emit('user_disconnected', {'user_id': user_id})
+        # Offline only once the user's last socket is gone
+        presence.disconnect(user_id, request.sid)
 
 @socketio.on('send_message')
+@unit_of_work
 def handle_message(data):
     try:
         sender_id = session.get('user_id')
@@ -431,14 +749,25 @@ def handle_message(data):
         if message_type == 'text':
             content = emoji.emojize(content)
 
+        # Attachment uploaded beforehand through /uploads
+        upload_id = data.get('upload_id')
+        if message_type in ('image', 'file') and upload_id:
+            is_valid, result = resolve_upload_token(upload_id, sender_id)
+            if not is_valid:
+                return {'error': result}
+            media_url = result['media_url']
+            media_type = result['media_type']
+            file_size = result['file_size']
+            filename = filename or result['filename']
+
         # Handle attachment upload (image or document)
-        if message_type in ('image', 'file') and media_url:
+        elif message_type in ('image', 'file') and media_url:
             is_valid, result = save_uploaded_file(media_url, filename or "attachment")
             if not is_valid:
                 return {'error': result}
             media_url = result
-            file_path = os.path.join('static', media_url)
-            if os.path.exists(file_path):
+            file_path = upload_disk_path(media_url)
+            if file_path:
                 file_size = os.path.getsize(file_path)
             else:
                 return {'error': 'Failed to save file'}
@@ -474,7 +803,7 @@ def handle_message(data):
         if not message_id:
             return {'error': 'Failed to save message'}
 
-        sender = db.get_employee_by_id(sender_id)
+        sender = db.employees.get(sender_id)
         current_utc = datetime.now(timezone.utc)
         timestamp = current_utc.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
 
@@ -498,7 +827,7 @@ def handle_message(data):
         if message_type == 'reply' and parent_message_id:
             parent_message = db.get_message_by_id(parent_message_id)
             if parent_message:
-                parent_sender = db.get_employee_by_id(parent_message['sender_id'])
+                parent_sender = db.employees.get(parent_message['sender_id'])
                 parent_sender_name = parent_sender['name'] if parent_sender else 'User'
                 message_data.update({
                     'parent_content': parent_message['content'],
@@ -514,7 +843,7 @@ def handle_message(data):
         if message_type == 'forward' and parent_message_id:
             parent_message = db.get_message_by_id(parent_message_id)
             if parent_message:
-                parent_sender = db.get_employee_by_id(parent_message['sender_id'])
+                parent_sender = db.employees.get(parent_message['sender_id'])
                 parent_sender_name = parent_sender['name'] if parent_sender else 'Unknown'
                 original_content = parent_message['content']
                 cleaned_content = original_content.replace(parent_sender_name, '').strip()
@@ -529,45 +858,34 @@ def handle_message(data):
                     'parent_filename': parent_message.get('filename')
                 })
 
-        # Send message to rooms
-        emit('new_message', message_data, room=sender_id)
+        # Forwards/re-uploads of a known image already have thumbnails
+        attach_thumbnails([message_data])
+
+        # Send message to rooms once the row is committed, so a receipt for
+        # it can never arrive before the message is visible to other sessions
+        emit_after_commit('new_message', message_data, sender_id)
         if sender_id != receiver_id:
-            emit('new_message', message_data, room=receiver_id)
+            emit_after_commit('new_message', message_data, receiver_id)
             
             # Sorting/activity reordering removed
 
         # Proactively notify both clients to update last-activity cache for direct list
-        try:
-            now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
-            # For the sender's list, the active peer is the receiver
-            emit('update_last_activity', {
-                'peer_id': receiver_id,
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        # For the sender's list, the active peer is the receiver
+        emit_after_commit('update_last_activity', {
+            'peer_id': receiver_id,
+            'timestamp': now_ms
+        }, sender_id)
+        # For the receiver's list, the active peer is the sender
+        if sender_id != receiver_id:
+            emit_after_commit('update_last_activity', {
+                'peer_id': sender_id,
                 'timestamp': now_ms
-            }, room=sender_id)
-            # For the receiver's list, the active peer is the sender
-            if sender_id != receiver_id:
-                emit('update_last_activity', {
-                    'peer_id': sender_id,
-                    'timestamp': now_ms
-                }, room=receiver_id)
-        except Exception:
-            app.logger.exception('Failed to emit update_last_activity for direct message')
+            }, receiver_id)
 
-        # Send updated unread counts (combined direct + group) to both participants
-        try:
-            # Receiver combined counts
-            r_direct = db.get_user_unread_counts(receiver_id)
-            r_group = db.get_user_group_unread_counts(receiver_id)
-            r_combined = {**r_group, **r_direct}
-            emit('unread_counts_update', r_combined, room=receiver_id)
-
-            # Sender combined counts (their list may change ordering)
-            s_direct = db.get_user_unread_counts(sender_id)
-            s_group = db.get_user_group_unread_counts(sender_id)
-            s_combined = {**s_group, **s_direct}
-            emit('unread_counts_update', s_combined, room=sender_id)
-        except Exception:
-            app.logger.exception('Failed to emit combined unread counts after direct message')
+        # Send updated unread counts (combined direct + group) to both
+        # participants; the sender's list may change ordering
+        emit_unread_counts_after_commit([receiver_id, sender_id])
 
         return {'success': True}
 
@@ -576,6 +894,7 @@ def handle_message(data):
         return {'error': 'Internal server error'}
 
 @socketio.on('mark_read')
+@unit_of_work
 def handle_mark_read(data):
     message_id = data.get('message_id')
     receiver_id = session.get('user_id') or data.get('receiver_id')
@@ -585,23 +904,36 @@ def handle_mark_read(data):
         db.update_message_status(message_id, True)
         
         # ✅ CRITICAL: Notify sender that their message was read
-        emit('message_read', {'message_id': message_id}, room=sender_id)
+        emit_after_commit('message_read', {'message_id': message_id}, sender_id)
         
         # Update unread counts for both sender and receiver (combined)
-        r_direct = db.get_user_unread_counts(receiver_id)
-        r_group = db.get_user_group_unread_counts(receiver_id)
-        receiver_combined = {**r_group, **r_direct}
-
-        s_direct = db.get_user_unread_counts(sender_id)
-        s_group = db.get_user_group_unread_counts(sender_id)
-        sender_combined = {**s_group, **s_direct}
-        
-        # Emit to both users
-        emit('unread_counts_update', receiver_combined, room=receiver_id)
-        emit('unread_counts_update', sender_combined, room=sender_id)
+        emit_unread_counts_after_commit([receiver_id, sender_id])
+
+@socketio.on('mark_read_batch')
+def handle_mark_read_batch(data):
+    """Batched receipts: {'receipts': [{'sender_id', 'up_to_id'}, ...]} or a single pair"""
+    reader_id = session.get('user_id')
+    if not reader_id or not isinstance(data, dict):
+        return {'error': 'Unauthorized'}
+    receipts = data.get('receipts')
+    if not isinstance(receipts, list):
+        receipts = [data]
+    accepted = 0
+    for receipt in receipts:
+        try:
+            sender_id = str(receipt.get('sender_id') or '').strip()
+            up_to_id = int(receipt.get('up_to_id'))
+        except (AttributeError, TypeError, ValueError):
+            continue
+        if not sender_id or sender_id == reader_id or up_to_id <= 0:
+            continue
+        read_receipts.submit(reader_id, sender_id, up_to_id)
+        accepted += 1
+    return {'success': True, 'accepted': accepted}
 
 # Delivery acknowledgement for direct messages
 @socketio.on('message_delivered')
+@unit_of_work
 def handle_message_delivered(data):
     try:
         message_id = data.get('message_id')
@@ -615,14 +947,39 @@ def handle_message_delivered(data):
     except Exception:
         app.logger.exception('Failed to handle message_delivered')
 
+def _history_cursor_args():
+    """Read keyset paging args (limit, before_id, after_id) from the query string"""
+    limit = request.args.get('limit', 50, type=int) or 50
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+    return limit, before_id, after_id
+
+def _history_response(messages, limit, before_id, after_id):
+    """Plain list for legacy callers; {messages, next_cursor} when paging with a cursor.
+
+    next_cursor is the id to pass back as before_id (or after_id when paging
+    forward); None once the end of the history is reached.
+    """
+    attach_thumbnails(messages)
+    next_cursor = None
+    if messages and len(messages) >= limit:
+        next_cursor = messages[0]['id'] if after_id is not None else messages[-1]['id']
+    if before_id is None and after_id is None:
+        resp = jsonify(messages)
+    else:
+        resp = jsonify({'messages': messages, 'next_cursor': next_cursor})
+    if next_cursor is not None:
+        resp.headers['X-Next-Cursor'] = str(next_cursor)
+    return resp
+
 @app.route('/messages/<sender_id>/<receiver_id>')
 def get_messages(sender_id, receiver_id):
     try:
         session_user = (session.get('user_id') or '').strip()
         if session_user != (sender_id or '').strip():
             return jsonify({"error": "Forbidden"}), 403
-        limit = request.args.get('limit', 50, type=int)
-        messages = db.get_messages(sender_id, receiver_id, limit)
+        limit, before_id, after_id = _history_cursor_args()
+        messages = db.get_messages(sender_id, receiver_id, limit, before_id, after_id)
         
         # Mark messages as read when fetched
         unread_ids = [msg['id'] for msg in messages 
@@ -631,12 +988,9 @@ def get_messages(sender_id, receiver_id):
         if unread_ids:
             db.bulk_update_message_status(unread_ids, True)
             # Update unread counts after marking messages as read (combined)
-            d_counts = db.get_user_unread_counts(sender_id)
-            g_counts = db.get_user_group_unread_counts(sender_id)
-            combined = {**g_counts, **d_counts}
-            socketio.emit('unread_counts_update', combined, room=sender_id)
+            emit_unread_counts_after_commit([sender_id])
         
-        return jsonify(messages)
+        return _history_response(messages, limit, before_id, after_id)
     except Exception as e:
         app.logger.error(f"Error in get_messages: {str(e)}", exc_info=True) 
         return jsonify({"error": "Failed to fetch messages"}), 500
@@ -672,15 +1026,12 @@ def set_chat_pin():
         return jsonify({'error': 'Invalid request'}), 400
     user_id = session.get('user_id')
     db.set_chat_pin(user_id, target_type, target_id, pin)
-    try:
-        # notify this user only; clients of this user will update their own UI
-        socketio.emit('chat_pin_updated', {
-            'target_type': target_type,
-            'target_id': target_id,
-            'pin': pin
-        }, room=user_id)
-    except Exception:
-        app.logger.exception('Failed to emit chat_pin_updated')
+    # notify this user only; clients of this user will update their own UI
+    emit_after_commit('chat_pin_updated', {
+        'target_type': target_type,
+        'target_id': target_id,
+        'pin': pin
+    }, user_id)
     return jsonify({'success': True, 'pin': pin})
 
 @app.route('/groups/<int:group_id>/last_activity')
@@ -691,8 +1042,32 @@ def group_last_activity(group_id):
     activity = db.get_group_last_activity(group_id)
     return jsonify(activity)    
 
+@app.route('/metrics')
+@login_required
+def metrics():
+    """In-process cache/counter snapshot for this worker (?user_id=<self> adds the caller's socket refcount)"""
+    user_id = request.args.get('user_id')
+    if user_id:
+        if user_id != session.get('user_id'):
+            return jsonify({'error': 'Forbidden'}), 403
+        return jsonify({'user_id': user_id, 'refcount': presence.refcount(user_id), 'online': presence.is_online(user_id)})
+    return jsonify({
+        'employee_directory': db.employees.stats(),
+        'group_memberships': db.memberships.stats(),
+        'thumbnails': thumbnails.stats(),
+        'presence': presence.stats(),
+        'read_receipts': read_receipts.stats(),
+        'group_seen': group_seen.stats(),
+        'db_pool': db.pool_stats(),
+        'shared_state': {'enabled': shared_state is not None, 'invalidations_received': invalidation_bus.received,
+                         'bus_reconnects': invalidation_bus.reconnects},
+    })
+
 @app.route('/user_status/<user_id>')
 def get_user_status(user_id):
+    # online_status lags the in-memory state by up to one debounce window
+    if presence.is_online(user_id):
+        return jsonify({'status': 'online'})
     status = db.get_user_status(user_id)
     return jsonify({'status': status})
 
@@ -736,7 +1111,7 @@ def create_group():
     if group_data:
         group_data = convert_datetime(group_data)
         for uid in [creator_id] + member_ids:
-            socketio.emit('group_created', group_data, room=uid)
+            emit_after_commit('group_created', group_data, uid)
     return jsonify({'group_id': group_id})
 
 @app.route('/groups/<int:group_id>/members', methods=['GET'])
@@ -775,9 +1150,9 @@ def remove_group_member(group_id):
 
 @app.route('/groups/<int:group_id>/messages', methods=['GET'])
 def get_group_messages(group_id):
-    limit = request.args.get('limit', 50, type=int)
-    messages = db.get_group_messages(group_id, limit)
-    return jsonify(convert_datetime(messages))
+    limit, before_id, after_id = _history_cursor_args()
+    messages = db.get_group_messages(group_id, limit, before_id, after_id)
+    return _history_response(convert_datetime(messages), limit, before_id, after_id)
 
 @app.route('/messages/<int:message_id>/seen', methods=['GET'])
 def get_message_seen_users(message_id):
@@ -786,6 +1161,7 @@ def get_message_seen_users(message_id):
 
 # --- SOCKET EVENTS FOR GROUP CHAT ---
 @socketio.on('join_group')
+@unit_of_work
 def handle_join_group(data):
     group_id = data.get('group_id')
     user_id = session.get('user_id')
@@ -793,6 +1169,7 @@ def handle_join_group(data):
         join_room(f'group_{group_id}')
 
 @socketio.on('leave_group')
+@unit_of_work
 def handle_leave_group(data):
     group_id = data.get('group_id')
     user_id = session.get('user_id')
@@ -800,6 +1177,7 @@ def handle_leave_group(data):
         leave_room(f'group_{group_id}')
 
 @socketio.on('send_group_message')
+@unit_of_work
 def handle_send_group_message(data):
     try:
         sender_id = session.get('user_id')
@@ -826,13 +1204,23 @@ def handle_send_group_message(data):
 
         if message_type == 'text':
             content = emoji.emojize(content)
-        if message_type in ('image', 'file') and media_url:
+        # Attachment uploaded beforehand through /uploads
+        upload_id = data.get('upload_id')
+        if message_type in ('image', 'file') and upload_id:
+            is_valid, result = resolve_upload_token(upload_id, sender_id)
+            if not is_valid:
+                return {'error': result}
+            media_url = result['media_url']
+            media_type = result['media_type']
+            file_size = result['file_size']
+            filename = filename or result['filename']
+        elif message_type in ('image', 'file') and media_url:
             is_valid, result = save_uploaded_file(media_url, filename or "attachment")
             if not is_valid:
                 return {'error': result}
             media_url = result
-            file_path = os.path.join('static', media_url)
-            if os.path.exists(file_path):
+            file_path = upload_disk_path(media_url)
+            if file_path:
                 file_size = os.path.getsize(file_path)
             else:
                 return {'error': 'Failed to save file'}
@@ -867,7 +1255,7 @@ def handle_send_group_message(data):
         if not message_id:
             return {'error': 'Failed to save message'}
         
-        sender = db.get_employee_by_id(sender_id)
+        sender = db.employees.get(sender_id)
         current_utc = datetime.now(timezone.utc)
         timestamp = current_utc.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
         
@@ -890,7 +1278,7 @@ def handle_send_group_message(data):
         if message_type == 'reply' and parent_message_id:
             parent_message = db.get_message_by_id(parent_message_id)
             if parent_message:
-                parent_sender = db.get_employee_by_id(parent_message['sender_id'])
+                parent_sender = db.employees.get(parent_message['sender_id'])
                 parent_sender_name = parent_sender['name'] if parent_sender else 'User'
                 message_data.update({
                     'parent_content': parent_message['content'],
@@ -906,7 +1294,7 @@ def handle_send_group_message(data):
             parent_message = db.get_message_by_id(parent_message_id)
             if parent_message:
                 # Get original sender
-                parent_sender = db.get_employee_by_id(parent_message['sender_id'])
+                parent_sender = db.employees.get(parent_message['sender_id'])
                 parent_sender_name = parent_sender['name'] if parent_sender else 'Unknown'
 
                 # Remove sender name from the beginning of the content if present
@@ -923,29 +1311,22 @@ def handle_send_group_message(data):
                     'parent_filename': parent_message.get('filename')
                 })
                                 
-        # Emit to group room only once
-        emit('new_group_message', message_data, room=f'group_{group_id}')
+        attach_thumbnails([message_data])
+
+        # Emit to group room only once, after the row is committed
+        emit_after_commit('new_group_message', message_data, f'group_{group_id}')
 
         # Add this section with proper indentation (4 spaces)
         current_time = int(datetime.now(timezone.utc).timestamp() * 1000)
-        members = db.get_group_members(group_id)
-        for member in members:
-            socketio.emit('update_group_activity', {
+        member_ids = db.memberships.members(group_id)
+        for uid in member_ids:
+            emit_after_commit('update_group_activity', {
                 'group_id': group_id,
                 'timestamp': current_time
-            }, room=member['user_id'])
+            }, uid)
         
         # Update unread counts for all members (combined), including sender to keep UI in sync
-        members = db.get_group_members(group_id)
-        for member in members:
-            try:
-                uid = member['user_id']
-                d_counts = db.get_user_unread_counts(uid)
-                g_counts = db.get_user_group_unread_counts(uid)
-                combined_counts = {**g_counts, **d_counts}
-                emit('unread_counts_update', combined_counts, room=uid)
-            except Exception:
-                app.logger.exception('Failed to emit combined unread counts after group message')
+        emit_unread_counts_after_commit(member_ids, seeded_only=True)
 
         return {'success': True}
     except Exception as e:
@@ -953,26 +1334,27 @@ def handle_send_group_message(data):
         return {'error': 'Internal server error'}
 
 @socketio.on('mark_group_message_seen')
+@unit_of_work
 def handle_mark_group_message_seen(data):
     message_id = data.get('message_id')
     user_id = session.get('user_id')
-    group_id = data.get('group_id')
     
-    if message_id and user_id and group_id:
-        db.mark_message_seen(message_id, user_id)
-        
-        unread_counts = db.get_user_group_unread_counts(user_id)
-        direct_unread_counts = db.get_user_unread_counts(user_id)
-        combined_counts = {**direct_unread_counts, **unread_counts}
+    if message_id and user_id:
+        # Seen state is a per-member read pointer; re-marking older messages is
+        # a no-op. The group comes from the message, not from the client.
+        try:
+            advanced = db.mark_message_seen(message_id, user_id)
+        except PermissionError:
+            return {'error': 'Not authorized'}
+        if not advanced:
+            return
+        group_id, _, up_to_id = advanced
         
-        emit('unread_counts_update', combined_counts, room=user_id)
+        emit_unread_counts_after_commit([user_id])
         
-        seen_users = db.get_message_seen_users(message_id)
-        seen_users = convert_datetime(seen_users)
-        emit('group_message_seen_update', {
-            'message_id': message_id,
-            'seen_users': seen_users
-        }, room=f'group_{group_id}')
+        # The room learns about it in the next aggregated delta; full seen
+        # lists are fetched on demand from /messages/<id>/seen
+        db.after_commit(group_seen.submit, group_id, user_id, up_to_id)
 
 @app.route('/messages/pin', methods=['POST'])
 def pin_message():
@@ -990,9 +1372,9 @@ def pin_message():
             sender_id = message.get('sender_id')
             receiver_id = message.get('receiver_id')
             if sender_id:
-                socketio.emit('message_pinned', {'message_id': message_id, 'pinned': pin}, room=sender_id)
+                emit_after_commit('message_pinned', {'message_id': message_id, 'pinned': pin}, sender_id)
             if receiver_id and receiver_id != sender_id:
-                socketio.emit('message_pinned', {'message_id': message_id, 'pinned': pin}, room=receiver_id)
+                emit_after_commit('message_pinned', {'message_id': message_id, 'pinned': pin}, receiver_id)
     except Exception:
         app.logger.exception('Failed to broadcast message_pinned')
     return jsonify({'success': True, 'pinned': pin})
@@ -1014,10 +1396,7 @@ def pin_group_message(group_id):
         return jsonify({'error': 'Missing message_id'}), 400
     db.pin_message(message_id, pin)
     # Broadcast to group room and to all clients for consistency
-    try:
-        socketio.emit('group_message_pinned', {'message_id': message_id, 'pinned': pin, 'group_id': group_id}, room=f'group_{group_id}')
-    except Exception:
-        app.logger.exception('Failed to broadcast group_message_pinned')
+    emit_after_commit('group_message_pinned', {'message_id': message_id, 'pinned': pin, 'group_id': group_id}, f'group_{group_id}')
     return jsonify({'success': True, 'pinned': pin})
 
 @app.route('/messages/search', methods=['GET'])
@@ -1026,13 +1405,34 @@ def search_messages():
     sender_id = request.args.get('sender_id')
     receiver_id = request.args.get('receiver_id')
     group_id = request.args.get('group_id')
-    limit = request.args.get('limit', 50, type=int)
+    limit = max(1, min(request.args.get('limit', 50, type=int) or 50, 200))
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'Unauthorized'}), 401
+    # Only conversations the caller takes part in can be searched
+    if group_id and str(group_id) not in db.memberships.groups(user_id):
+        return jsonify({'error': 'Not authorized'}), 403
+    if not group_id and sender_id and receiver_id and user_id not in (sender_id, receiver_id):
+        return jsonify({'error': 'Not authorized'}), 403
+    global_scope = request.args.get('scope') == 'all' or not (group_id or (sender_id and receiver_id))
     if not query:
-        return jsonify([])
-    messages = db.search_messages(query, sender_id, receiver_id, group_id, limit)
-    return jsonify(messages)
+        return jsonify({'conversations': [], 'next_cursor': None} if global_scope else [])
+    cursor = request.args.get('cursor')
+    if global_scope:
+        conversations, next_cursor = db.search_all_messages(user_id, query, limit, cursor)
+        resp = jsonify({'conversations': conversations, 'next_cursor': next_cursor})
+        if next_cursor:
+            resp.headers['X-Next-Cursor'] = next_cursor
+        return resp
+    messages, next_cursor = db.search_messages(query, sender_id, receiver_id, group_id, limit, cursor)
+    # Same convention as history: plain list unless the caller pages with ?cursor=
+    resp = jsonify({'messages': messages, 'next_cursor': next_cursor}) if 'cursor' in request.args else jsonify(messages)
+    if next_cursor:
+        resp.headers['X-Next-Cursor'] = next_cursor
+    return resp
 
 @socketio.on('pin_message')
+@unit_of_work
 def handle_pin_message(data):
     message_id = data.get('message_id')
     pin = data.get('pin', True)
@@ -1044,9 +1444,9 @@ def handle_pin_message(data):
             sender_id = message.get('sender_id')
             receiver_id = message.get('receiver_id')
             if sender_id:
-                socketio.emit('message_pinned', {'message_id': message_id, 'pinned': pin}, room=sender_id)
+                emit_after_commit('message_pinned', {'message_id': message_id, 'pinned': pin}, sender_id)
             if receiver_id and receiver_id != sender_id:
-                socketio.emit('message_pinned', {'message_id': message_id, 'pinned': pin}, room=receiver_id)
+                emit_after_commit('message_pinned', {'message_id': message_id, 'pinned': pin}, receiver_id)
     except Exception:
         app.logger.exception('Failed to emit message_pinned for direct message')
 
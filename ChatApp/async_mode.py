@@ -0,0 +1,60 @@
+import importlib.util
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Imported by app.py before anything opens a socket, so the monkey-patch,
+# SocketIO(async_mode=...) and the database pool all follow one decision.
+GREEN_MODES = ('eventlet', 'gevent', 'gevent_uwsgi')
+
+
+def resolve_async_mode() -> str:
+    """SOCKETIO_ASYNC_MODE, or what Flask-SocketIO would pick on its own"""
+    mode = (os.getenv('SOCKETIO_ASYNC_MODE') or '').strip().lower()
+    if mode:
+        return mode
+    # Same preference order as Flask-SocketIO's auto-detection
+    for candidate in ('eventlet', 'gevent'):
+        if importlib.util.find_spec(candidate) is not None:
+            return candidate
+    return 'threading'
+
+
+ASYNC_MODE = resolve_async_mode()
+GREEN = ASYNC_MODE in GREEN_MODES
+
+
+def monkey_patch() -> bool:
+    """Make the stdlib cooperative for the resolved green mode; False if not green"""
+    if ASYNC_MODE == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+        return True
+    if ASYNC_MODE in ('gevent', 'gevent_uwsgi'):
+        from gevent import monkey
+        monkey.patch_all()
+        return True
+    return False
+
+
+class _EventletTpoolExecutor:
+    """submit() runs `fn` on eventlet's native thread pool (tpool)"""
+
+    def submit(self, fn, *args, **kwargs):
+        import eventlet
+        from eventlet import tpool
+        return eventlet.spawn(tpool.execute, fn, *args, **kwargs)
+
+
+def native_executor(max_workers: int, thread_name_prefix: str = ''):
+    """
+    Executor whose jobs run on real OS threads even after monkey_patch().
+
+    A patched ThreadPoolExecutor hands CPU-bound work (image decoding) to
+    greenlets, which holds the hub for every socket until it finishes.
+    """
+    if ASYNC_MODE in ('gevent', 'gevent_uwsgi'):
+        from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+        return GeventThreadPoolExecutor(max_workers=max_workers)
+    if ASYNC_MODE == 'eventlet':
+        return _EventletTpoolExecutor()  # sized by EVENTLET_THREADPOOL_SIZE
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
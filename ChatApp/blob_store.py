@@ -0,0 +1,129 @@
+import hashlib
+import os
+import secrets
+import shutil
+from typing import Optional, Tuple
+
+# Bytes hashed/written per step by put_stream
+STREAM_BLOCK_SIZE = 64 * 1024
+
+
+class BlobStore:
+    """
+    Content-addressed file store: blobs are named '<sha256>.<ext>' and laid out
+    in two levels of fan-out directories ('ab/cd/abcd....ext') under `root`.
+
+    Writes go to a temp file in `root/.tmp` and are renamed into place, so a
+    blob is either absent or complete. When an `index` (the Database) is
+    given, every put is recorded there (size, mime, first seen, refcount) and
+    a blob that is already indexed and on disk is not written again.
+    Files from the older flat layout ('root/<sha256>.<ext>') are still found
+    by `locate`.
+    """
+
+    def __init__(self, root: str, index=None):
+        self.root = root
+        self.index = index
+        self.tmp_dir = os.path.join(root, '.tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    @staticmethod
+    def name_for(digest: str, ext: Optional[str]) -> str:
+        return f"{digest}.{ext}" if ext else digest
+
+    def path_for(self, name: str) -> str:
+        """Fan-out path for a blob name (whether or not it exists)"""
+        return os.path.join(self.root, name[0:2], name[2:4], name)
+
+    def locate(self, name: str) -> Optional[str]:
+        """Disk path of a stored blob by its name, checking the legacy flat layout too"""
+        name = os.path.basename(name or '')
+        if not name:
+            return None
+        path = self.path_for(name)
+        if os.path.isfile(path):
+            return path
+        flat = os.path.join(self.root, name)
+        if os.path.isfile(flat):
+            return flat
+        return None
+
+    def _known(self, digest: str, name: str) -> bool:
+        if self.index is not None:
+            try:
+                if not self.index.get_blob(digest):
+                    return False
+            except Exception:
+                pass
+        return self.locate(name) is not None
+
+    def _record(self, digest: str, ext: Optional[str], size: int, mime: Optional[str]) -> None:
+        if self.index is None:
+            return
+        try:
+            self.index.register_blob(digest, ext, size, mime)
+        except Exception:
+            pass  # the file is stored; the index is advisory
+
+    def _install(self, temp_path: str, name: str) -> None:
+        dest = self.path_for(name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.exists(dest):
+            os.remove(temp_path)
+            return
+        try:
+            os.replace(temp_path, dest)
+        except OSError:
+            # Source on another filesystem: copy next to dest, then rename
+            staged = self._temp_path()
+            shutil.move(temp_path, staged)
+            os.replace(staged, dest)
+
+    def _temp_path(self) -> str:
+        return os.path.join(self.tmp_dir, secrets.token_hex(12))
+
+    def put_bytes(self, data: bytes, ext: Optional[str], mime: Optional[str] = None) -> str:
+        """Store in-memory bytes; returns the blob name"""
+        digest = hashlib.sha256(data).hexdigest()
+        name = self.name_for(digest, ext)
+        if not self._known(digest, name):
+            temp_path = self._temp_path()
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            self._install(temp_path, name)
+        self._record(digest, ext, len(data), mime)
+        return name
+
+    def put_stream(self, stream, ext: Optional[str], mime: Optional[str] = None,
+                   max_size: Optional[int] = None) -> Tuple[str, int]:
+        """Store a file-like stream, hashing while writing; returns (name, size)"""
+        sha = hashlib.sha256()
+        size = 0
+        temp_path = self._temp_path()
+        try:
+            with open(temp_path, 'wb') as f:
+                while True:
+                    block = stream.read(STREAM_BLOCK_SIZE)
+                    if not block:
+                        break
+                    size += len(block)
+                    if max_size is not None and size > max_size:
+                        raise ValueError('Stream exceeds maximum size')
+                    sha.update(block)
+                    f.write(block)
+            digest = sha.hexdigest()
+            return self.put_file(temp_path, digest, ext, size, mime), size
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def put_file(self, src_path: str, digest: str, ext: Optional[str], size: int,
+                 mime: Optional[str] = None) -> str:
+        """Adopt an already-hashed file (moved, not copied); returns the blob name"""
+        name = self.name_for(digest, ext)
+        if self._known(digest, name):
+            os.remove(src_path)
+        else:
+            self._install(src_path, name)
+        self._record(digest, ext, size, mime)
+        return name
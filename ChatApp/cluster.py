@@ -0,0 +1,187 @@
+import json
+import os
+import socket
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+try:
+    import redis
+except ImportError:  # only needed for multi-worker deployments
+    redis = None
+
+# Identifies this process in shared presence counters and bus messages
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def connect_shared_state(url: Optional[str]):
+    """Redis client for SHARED_STATE_URL, or None in single-worker mode"""
+    if not url:
+        return None
+    if redis is None:
+        raise RuntimeError('SHARED_STATE_URL is set but the redis package is not installed')
+    return redis.Redis.from_url(url, decode_responses=True)
+
+
+class InvalidationBus:
+    """
+    Cross-worker cache invalidation over Redis pub/sub.
+
+    `publish(kind, key)` tells every other worker to drop `key` from the
+    cache registered for `kind`; the publishing worker has already dropped it
+    locally. Without a client (single worker) publishing is a no-op.
+
+    If the subscription drops, `run` reconnects with exponential backoff.
+    Drops published while it was away are lost, so every `on_resubscribe`
+    callback (typically "clear the whole cache") runs once it is back.
+    """
+
+    def __init__(self, client=None, channel: str = 'chatapp:invalidate', worker_id: str = WORKER_ID,
+                 sleep: Callable[[float], None] = time.sleep, min_backoff: float = 0.5, max_backoff: float = 30.0):
+        self._client = client
+        self.channel = channel
+        self.worker_id = worker_id
+        self._sleep = sleep
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._handlers: Dict[str, Callable[[str], None]] = {}
+        self._resubscribe_handlers: List[Callable[[], None]] = []
+        self._running = False
+        self.received = 0
+        self.reconnects = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._client is not None
+
+    def subscribe(self, kind: str, handler: Callable[[str], None]) -> None:
+        self._handlers[kind] = handler
+
+    def on_resubscribe(self, handler: Callable[[], None]) -> None:
+        self._resubscribe_handlers.append(handler)
+
+    def publish(self, kind: str, key) -> None:
+        if self._client is None:
+            return
+        try:
+            self._client.publish(self.channel, json.dumps({'w': self.worker_id, 'k': kind, 'v': str(key)}))
+        except Exception:
+            pass  # other workers fall back to their TTLs/reseeds
+
+    def run(self) -> None:
+        """Listen loop; start with socketio.start_background_task"""
+        if self._client is None:
+            return
+        self._running = True
+        backoff = self.min_backoff
+        while self._running:
+            pubsub = None
+            try:
+                pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                if self.reconnects:
+                    self._resubscribed()
+                backoff = self.min_backoff
+                for message in pubsub.listen():
+                    self._handle(message)
+                    if not self._running:
+                        break
+            except Exception:
+                pass
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+            if not self._running:
+                break
+            self.reconnects += 1
+            self._sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def stop(self) -> None:
+        self._running = False
+
+    def _handle(self, message) -> None:
+        try:
+            data = json.loads(message['data'])
+            if data.get('w') == self.worker_id:
+                return
+            handler = self._handlers.get(data.get('k'))
+            if handler:
+                handler(data.get('v'))
+                self.received += 1
+        except Exception:
+            pass
+
+    def _resubscribed(self) -> None:
+        for handler in self._resubscribe_handlers:
+            try:
+                handler()
+            except Exception:
+                pass
+
+
+class SharedPresence:
+    """
+    Socket counts per user summed across workers, for PresenceService.
+
+    Each worker keeps its own hash ('presence:w:<worker>') next to the global
+    one ('presence:n') and refreshes a heartbeat key. When a worker dies its
+    heartbeat expires and `reap`, run by any surviving worker, subtracts the
+    dead worker's sockets from the global counts.
+    """
+
+    _INCR_SCRIPT = """
+    local n = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+    if n <= 0 then redis.call('HDEL', KEYS[1], ARGV[1]) end
+    local g = redis.call('HINCRBY', KEYS[2], ARGV[1], ARGV[2])
+    if g <= 0 then redis.call('HDEL', KEYS[2], ARGV[1]) g = 0 end
+    return g
+    """
+
+    def __init__(self, client, worker_id: str = WORKER_ID, heartbeat_ttl: int = 30, prefix: str = 'presence:'):
+        self._client = client
+        self.worker_id = worker_id
+        self.heartbeat_ttl = heartbeat_ttl
+        self._prefix = prefix
+        self._incr = client.register_script(self._INCR_SCRIPT)
+
+    def _worker_key(self, worker_id: str) -> str:
+        return f"{self._prefix}w:{worker_id}"
+
+    @property
+    def _global_key(self) -> str:
+        return f"{self._prefix}n"
+
+    def incr(self, user_id: str, delta: int) -> int:
+        """Apply a socket delta for this worker; returns the user's global count"""
+        return int(self._incr(keys=[self._worker_key(self.worker_id), self._global_key], args=[user_id, delta]))
+
+    def count(self, user_id: str) -> int:
+        return int(self._client.hget(self._global_key, user_id) or 0)
+
+    def heartbeat(self) -> None:
+        pipe = self._client.pipeline()
+        pipe.set(f"{self._prefix}alive:{self.worker_id}", 1, ex=self.heartbeat_ttl)
+        pipe.sadd(f"{self._prefix}workers", self.worker_id)
+        pipe.execute()
+
+    def reap(self) -> List[str]:
+        """Drop sockets of workers whose heartbeat expired; returns users now at zero"""
+        offline = []
+        for worker_id in self._client.smembers(f"{self._prefix}workers"):
+            if worker_id == self.worker_id or self._client.exists(f"{self._prefix}alive:{worker_id}"):
+                continue
+            # SREM decides which surviving worker does the cleanup
+            if not self._client.srem(f"{self._prefix}workers", worker_id):
+                continue
+            worker_key = self._worker_key(worker_id)
+            for user_id, sockets in self._client.hgetall(worker_key).items():
+                n = self._client.hincrby(self._global_key, user_id, -int(sockets))
+                if n <= 0:
+                    self._client.hdel(self._global_key, user_id)
+                    offline.append(user_id)
+            self._client.delete(worker_key)
+        return offline
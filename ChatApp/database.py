@@ -4,7 +4,17 @@ import os
 from typing import Optional, Dict, Any
 from werkzeug.security import check_password_hash
 import hashlib
+import logging
 from contextlib import contextmanager
+from contextvars import ContextVar
+from unread_ledger import RedisUnreadLedger, UnreadLedger
+from employee_directory import EmployeeDirectory
+from membership_cache import GroupMembershipCache
+from green_pool import GreenConnectionPool
+import async_mode
+import search
+
+logger = logging.getLogger(__name__)
 
 try:
     # Prefer robust, thread-safe pooling
@@ -17,6 +27,252 @@ try:
 except ImportError:
     bcrypt = None  # fallback if bcrypt is not installed
 
+
+def direct_conversation_key(user_a, user_b):
+    """Order-independent key for a direct chat: '<lower id>:<higher id>' (byte order)"""
+    a, b = str(user_a), str(user_b)
+    return f"{a}:{b}" if a <= b else f"{b}:{a}"
+
+
+def group_conversation_key(group_id):
+    return f"g:{group_id}"
+
+
+# SQL twin of direct_conversation_key/group_conversation_key (BINARY keeps byte order)
+_CONVERSATION_KEY_SQL = """
+    IF(group_id IS NOT NULL, CONCAT('g:', group_id),
+       IF(BINARY sender_id <= BINARY receiver_id,
+          CONCAT(sender_id, ':', receiver_id),
+          CONCAT(receiver_id, ':', sender_id)))
+"""
+
+
+# --- SCHEMA MIGRATIONS ---
+# Ordered, append-only. Each step receives a cursor and must be safe to re-run
+# (a crash between the DDL and the schema_version insert re-applies the step).
+def _index_exists(cursor, table, index_name):
+    cursor.execute(
+        """SELECT 1 FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+            LIMIT 1""",
+        (table, index_name)
+    )
+    return cursor.fetchone() is not None
+
+
+def _add_index(cursor, table, index_name, columns):
+    if not _index_exists(cursor, table, index_name):
+        cursor.execute(f"ALTER TABLE `{table}` ADD INDEX `{index_name}` ({columns})")
+
+
+def _migration_message_indexes(cursor):
+    # Direct unread counts / mark-read: receiver_id = ? AND is_read = ? AND group_id IS NULL [GROUP BY sender_id]
+    _add_index(cursor, 'messages', 'idx_messages_unread', 'receiver_id, is_read, group_id, sender_id')
+    # Group history, keyset paging and last activity: group_id = ? ORDER BY id
+    _add_index(cursor, 'messages', 'idx_messages_group', 'group_id, id')
+    # Direct history: each side of the sender/receiver OR resolves to a range on this index
+    _add_index(cursor, 'messages', 'idx_messages_pair', 'sender_id, receiver_id, id')
+
+
+def _migration_seen_indexes(cursor):
+    # Group unread anti-join probes message_seen by (message_id, user_id) via the PK;
+    # per-user lookups (seen lists, compaction) go through this one
+    _add_index(cursor, 'message_seen', 'idx_message_seen_user', 'user_id, message_id')
+
+
+def _column_exists(cursor, table, column):
+    cursor.execute(
+        """SELECT 1 FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+            LIMIT 1""",
+        (table, column)
+    )
+    return cursor.fetchone() is not None
+
+
+def _backfill_conversation_keys(cursor, batch_size=5000):
+    """Populate messages.conversation_key in primary-key batches, committing each."""
+    cursor.execute("SELECT MIN(id), MAX(id) FROM messages WHERE conversation_key IS NULL")
+    low, high = cursor.fetchone()
+    if low is None:
+        return 0
+    updated = 0
+    start = low - 1
+    while start < high:
+        end = start + batch_size
+        cursor.execute(
+            f"""UPDATE messages SET conversation_key = {_CONVERSATION_KEY_SQL}
+                WHERE id > %s AND id <= %s AND conversation_key IS NULL""",
+            (start, end)
+        )
+        updated += cursor.rowcount
+        cursor.connection.commit()
+        start = end
+    return updated
+
+
+def _migration_conversation_key(cursor):
+    if not _column_exists(cursor, 'messages', 'conversation_key'):
+        cursor.execute("ALTER TABLE messages ADD COLUMN conversation_key VARCHAR(64) NULL")
+    _add_index(cursor, 'messages', 'idx_messages_conversation', 'conversation_key, id')
+    # Existing rows are keyed by Database.run_backfills (manage.py migrate)
+    # Direct history now goes through the conversation key
+    if _index_exists(cursor, 'messages', 'idx_messages_pair'):
+        cursor.execute("ALTER TABLE messages DROP INDEX idx_messages_pair")
+
+
+def _migration_blobs(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 CHAR(64) NOT NULL,
+            ext VARCHAR(10) NOT NULL DEFAULT '',
+            size BIGINT NOT NULL,
+            mime VARCHAR(100) NULL,
+            refcount INT NOT NULL DEFAULT 1,
+            first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (sha256, ext)
+        )
+    """)
+
+
+# SQL twin of media_index_entry: blob name, store kind and hash from messages.media_url
+_MEDIA_BLOB_NAME_SQL = "SUBSTRING_INDEX(REPLACE(media_url, '\\\\', '/'), '/', -1)"
+_MEDIA_KIND_SQL = "IF(REPLACE(media_url, '\\\\', '/') LIKE '%%uploads/files/%%', 'files', 'images')"
+
+
+def _backfill_message_media(cursor, batch_size=5000):
+    """Index media of messages not yet in message_media, in primary-key batches."""
+    cursor.execute("""
+        SELECT MIN(m.id), MAX(m.id) FROM messages m
+        LEFT JOIN message_media mm ON mm.message_id = m.id
+        WHERE m.media_url IS NOT NULL AND m.media_url <> '' AND mm.message_id IS NULL
+    """)
+    low, high = cursor.fetchone()
+    if low is None:
+        return 0
+    indexed = 0
+    start = low - 1
+    while start < high:
+        end = start + batch_size
+        cursor.execute(f"""
+            INSERT IGNORE INTO message_media (message_id, kind, blob_name, sha256)
+            SELECT id, {_MEDIA_KIND_SQL}, {_MEDIA_BLOB_NAME_SQL},
+                   IF({_MEDIA_BLOB_NAME_SQL} REGEXP '^[0-9a-f]{{64}}([.]|$)', LEFT({_MEDIA_BLOB_NAME_SQL}, 64), NULL)
+            FROM messages
+            WHERE id > %s AND id <= %s AND media_url IS NOT NULL AND media_url <> ''
+        """, (start, end))
+        indexed += cursor.rowcount
+        cursor.connection.commit()
+        start = end
+    return indexed
+
+
+def _migration_message_media(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS message_media (
+            message_id INT NOT NULL PRIMARY KEY,
+            kind ENUM('images','files') NOT NULL,
+            blob_name VARCHAR(255) NOT NULL,
+            sha256 CHAR(64) NULL,
+            KEY idx_message_media_sha (sha256),
+            FOREIGN KEY (message_id) REFERENCES messages(id) ON DELETE CASCADE
+        )
+    """)
+
+
+def _migration_message_fulltext(cursor):
+    # The first FULLTEXT index rebuilds the table (InnoDB adds FTS_DOC_ID);
+    # afterwards InnoDB keeps it current on every insert/update
+    if not _index_exists(cursor, 'messages', 'ft_messages_text'):
+        cursor.execute("ALTER TABLE messages ADD FULLTEXT INDEX ft_messages_text (content, filename)")
+
+
+# Advance a read pointer without moving it backwards; seen_at only changes
+# when it advances (assignments run left to right, so seen_at goes first)
+_ADVANCE_READ_POINTER_SQL = """
+    ON DUPLICATE KEY UPDATE
+        seen_at = IF(VALUES(last_seen_message_id) > last_seen_message_id, VALUES(seen_at), seen_at),
+        last_seen_message_id = GREATEST(last_seen_message_id, VALUES(last_seen_message_id))
+"""
+
+
+def _compact_message_seen(cursor, batch_size=5000):
+    """Fold message_seen rows into group_read_pointer in message-id batches,
+    deleting each batch once its pointers are written."""
+    cursor.execute("SELECT MIN(message_id), MAX(message_id) FROM message_seen")
+    low, high = cursor.fetchone()
+    if low is None:
+        return 0
+    compacted = 0
+    start = low - 1
+    while start < high:
+        end = start + batch_size
+        cursor.execute(f"""
+            INSERT INTO group_read_pointer (group_id, user_id, last_seen_message_id, seen_at)
+            SELECT m.group_id, ms.user_id, MAX(ms.message_id), MAX(ms.seen_at)
+            FROM message_seen ms
+            JOIN messages m ON m.id = ms.message_id
+            JOIN `groups` g ON g.id = m.group_id
+            WHERE ms.message_id > %s AND ms.message_id <= %s
+            GROUP BY m.group_id, ms.user_id
+            {_ADVANCE_READ_POINTER_SQL}
+        """, (start, end))
+        cursor.execute("DELETE FROM message_seen WHERE message_id > %s AND message_id <= %s", (start, end))
+        compacted += cursor.rowcount
+        cursor.connection.commit()
+        start = end
+    return compacted
+
+
+def _migration_group_read_pointer(cursor):
+    # One row per (group, member) instead of one per (message, member): the
+    # member has seen every message of the group with id <= last_seen_message_id
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS group_read_pointer (
+            group_id INT NOT NULL,
+            user_id VARCHAR(20) NOT NULL,
+            last_seen_message_id INT NOT NULL DEFAULT 0,
+            seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (group_id, user_id),
+            KEY idx_group_read_pointer_seen (group_id, last_seen_message_id),
+            FOREIGN KEY (group_id) REFERENCES `groups`(id) ON DELETE CASCADE
+        )
+    """)
+    # message_seen is folded in by Database.run_backfills (manage.py migrate)
+
+
+def media_index_entry(media_url):
+    """(kind, blob_name, sha256) for a stored 'uploads/images|files/<name>' URL, or None"""
+    if not media_url:
+        return None
+    rel = str(media_url).replace('\\', '/')
+    name = rel.rsplit('/', 1)[-1]
+    if not name:
+        return None
+    kind = 'files' if 'uploads/files/' in rel else 'images'
+    stem = name.split('.', 1)[0]
+    sha = stem if len(stem) == 64 and all(c in '0123456789abcdef' for c in stem) else None
+    return kind, name, sha
+
+
+class MigrationLockTimeout(RuntimeError):
+    """Another process held the schema migration lock for too long"""
+
+
+# Migrations are schema changes only, so they are safe to apply when a
+# worker starts. Row backfills can take minutes on a large table and run
+# from `manage.py migrate` instead (Database.run_backfills).
+MIGRATIONS = [
+    (1, 'messages composite indexes', _migration_message_indexes),
+    (2, 'message_seen user index', _migration_seen_indexes),
+    (3, 'messages.conversation_key', _migration_conversation_key),
+    (4, 'blobs metadata index', _migration_blobs),
+    (5, 'message_media index', _migration_message_media),
+    (6, 'messages full-text index', _migration_message_fulltext),
+    (7, 'group read pointers (compacts message_seen)', _migration_group_read_pointer),
+]
+
+
 class Database:
     def __init__(self):
         # Single database: all tables live in chat_db
@@ -29,9 +285,22 @@ class Database:
             'autocommit': False,
         }
 
-        # Initialize a shared connection pool for all operations
+        # Initialize a shared connection pool for all operations.
+        # The default follows the resolved async mode: the cooperative pool
+        # under gevent/eventlet, DBUtils under threads. DB_POOL=green|dbutils
+        # overrides it. Without DBUtils the same pool runs on thread locks.
         self._pool = None
-        if PooledDB is not None:
+        pool_kind = (os.getenv('DB_POOL') or ('green' if async_mode.GREEN else 'dbutils')).lower()
+        if pool_kind == 'green' or PooledDB is None:
+            self._pool = GreenConnectionPool(
+                maxsize=int(os.getenv('DB_POOL_SIZE', '50')),
+                timeout=float(os.getenv('DB_POOL_TIMEOUT', '10')),
+                idle_check=float(os.getenv('DB_POOL_IDLE_CHECK', '30')),
+                setsession=['SET SESSION sql_mode="STRICT_TRANS_TABLES"'],
+                **self.db_config,
+            )
+            self.pool_kind = 'green' if self._pool.green else 'threaded'
+        else:
             try:
                 # Tuneables: allow ~200 concurrent clients; most queries are short-lived
                 self._pool = PooledDB(
@@ -42,11 +311,16 @@ class Database:
                     blocking=True,            # wait if exhausted
                     maxusage=None,            # unlimited reuse
                     setsession=['SET SESSION sql_mode="STRICT_TRANS_TABLES"'],
-                    ping=1,                   # 1 = ping on checkout
+                    # No ping on checkout: a dead connection fails its first
+                    # statement and is retried on a fresh one (SteadyDB and
+                    # _RetryingCursor), saving a round trip per cursor
+                    ping=int(os.getenv('DB_POOL_PING', '0')),
                     **self.db_config,
                 )
+                self.pool_kind = 'dbutils'
             except Exception:
                 self._pool = None  # Fall back to per-call connections
+                self.pool_kind = 'none'
 
         # Backwards compatible proxies so existing code using
         # `with self.chat_conn.cursor(...) as cursor:` keeps working.
@@ -57,6 +331,73 @@ class Database:
         # Detect which ID column is present in ot_users (emp_id vs employee_id)
         self.auth_id_col = self._detect_auth_id_column()
 
+        # In-process unread counters, kept current by the write paths below
+        self.unread_ledger = UnreadLedger(self)
+        # Cached id -> name/role lookups for ot_employees
+        self.employees = EmployeeDirectory(self)
+        # group <-> member maps, invalidated by the membership write paths
+        self.memberships = GroupMembershipCache(self)
+
+    def use_shared_state(self, client, bus) -> None:
+        """Multi-worker mode: unread counters in Redis, cache drops broadcast on `bus`"""
+        self.unread_ledger = RedisUnreadLedger(self, client)
+        self.memberships.attach_bus(bus)
+
+    # --- UNIT OF WORK ---
+    def begin_session(self):
+        """Start a lazy session for the current context; None if one is already active"""
+        if _current_session.get() is not None:
+            return None
+        session = DbSession(self._pool, self.db_config)
+        session._token = _current_session.set(session)
+        return session
+
+    def end_session(self, session, exc=None):
+        """Finish a session from begin_session: commit, or roll back if `exc` is set.
+
+        After-commit hooks run once the session is no longer current, so any
+        query they make sees the committed rows on a connection of its own.
+        """
+        if session is None:
+            return
+        try:
+            hooks = session.close(failed=exc is not None)
+        finally:
+            _current_session.reset(session._token)
+        _run_hooks(hooks)
+
+    @contextmanager
+    def session(self):
+        """`with db.session() as s:` runs every Database call inside on one
+        connection and commits once at the end. Nested sessions join the outer one."""
+        session = self.begin_session()
+        if session is None:
+            yield _current_session.get()
+            return
+        try:
+            yield session
+        except BaseException as e:
+            self.end_session(session, e)
+            raise
+        self.end_session(session)
+
+    def after_commit(self, fn, *args):
+        """Run `fn` now, or once the enclosing session has committed.
+
+        Cache/ledger deltas and socket emits go through here so nothing
+        outside the transaction sees a change before its rows are visible.
+        """
+        session = _current_session.get()
+        if session is None:
+            fn(*args)
+        else:
+            session.after_commit(fn, *args)
+
+    def pool_stats(self):
+        """Checkout/wait counters when the cooperative pool is in use"""
+        stats = getattr(self._pool, 'stats', None)
+        return stats() if stats else {'kind': 'dbutils' if self._pool is not None else 'none'}
+
     def _detect_auth_id_column(self) -> str:
         try:
             with self.auth_conn.cursor() as cursor:
@@ -148,7 +489,22 @@ class Database:
                     PRIMARY KEY (user_id, target_type, target_id)
                 )
             """)
+            # Per-user conversation summary (last message + unread), maintained
+            # by the save/mark-read paths so chat lists avoid per-row aggregates
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS conversation_summary (
+                    user_id VARCHAR(20) NOT NULL,
+                    peer_type ENUM('user','group') NOT NULL,
+                    peer_id VARCHAR(64) NOT NULL,
+                    last_message_id INT NULL,
+                    last_message_at TIMESTAMP NULL DEFAULT NULL,
+                    unread_count INT NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, peer_type, peer_id)
+                )
+            """)
         self.chat_conn.commit()
+        # Schema only; existing rows are backfilled by `manage.py migrate`
+        self.migrate()
 
         # Ensure ot_users table exists in chat_db (idempotent)
         try:
@@ -170,6 +526,46 @@ class Database:
         except Exception:
             pass
 
+    def migrate(self):
+        """Apply pending MIGRATIONS in order; returns the resulting schema version.
+
+        Idempotent and safe to call from several workers at once: a named
+        lock serializes runners and applied versions are skipped. Raises
+        MigrationLockTimeout if the lock isn't granted within
+        MIGRATION_LOCK_TIMEOUT seconds (an index build can take a while).
+        """
+        lock_timeout = int(os.getenv('MIGRATION_LOCK_TIMEOUT', '900'))
+        with self.chat_conn.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    description VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cursor.execute("SELECT GET_LOCK('chatapp_schema_migrate', %s)", (lock_timeout,))
+            # 1 = granted, 0 = timed out, NULL = error; never migrate without it
+            if cursor.fetchone()[0] != 1:
+                raise MigrationLockTimeout(
+                    f"Schema migration lock not granted within {lock_timeout}s; "
+                    f"another process is still migrating")
+            try:
+                cursor.execute("SELECT version FROM schema_version")
+                applied = {row[0] for row in cursor.fetchall()}
+                for version, description, step in MIGRATIONS:
+                    if version in applied:
+                        continue
+                    step(cursor)
+                    cursor.execute(
+                        "INSERT IGNORE INTO schema_version (version, description) VALUES (%s, %s)",
+                        (version, description)
+                    )
+                    cursor.connection.commit()
+                    applied.add(version)
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK('chatapp_schema_migrate')")
+            return max(applied) if applied else 0
+
     # --- AUTH METHODS (ardurtechnology.ot_users) ---
     def get_user_by_emp_id(self, emp_id: str) -> Optional[Dict[str, Any]]:
         with self.auth_conn.cursor(pymysql.cursors.DictCursor) as cursor:
@@ -301,17 +697,53 @@ class Database:
             cursor.execute(sql)
             return cursor.fetchall()
 
+    def get_all_employees(self):
+        """All employees (any status) for the in-process directory"""
+        with self.ops_conn.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("SELECT employee_id, name, role, status FROM ot_employees")
+            return cursor.fetchall()
+
     def save_message(self, sender_id, receiver_id, content, message_type='text', parent_message_id=None, media_url=None, media_type=None, file_size=None, filename=None):
         with self.chat_conn.cursor() as cursor:
             # Always set group_id to NULL for direct messages
             sql = """INSERT INTO messages \
-                    (sender_id, receiver_id, group_id, content, message_type, parent_message_id, media_url, media_type, file_size, filename) \
-                    VALUES (%s, %s, NULL, %s, %s, %s, %s, %s, %s, %s)"""
-            cursor.execute(sql, (sender_id, receiver_id, content, message_type, parent_message_id, media_url, media_type, file_size, filename))
+                    (sender_id, receiver_id, group_id, conversation_key, content, message_type, parent_message_id, media_url, media_type, file_size, filename) \
+                    VALUES (%s, %s, NULL, %s, %s, %s, %s, %s, %s, %s, %s)"""
+            cursor.execute(sql, (sender_id, receiver_id, direct_conversation_key(sender_id, receiver_id), content, message_type, parent_message_id, media_url, media_type, file_size, filename))
+            message_id = cursor.lastrowid
+            # Same transaction: bump both participants' conversation summaries
+            summary_sql = """
+                INSERT INTO conversation_summary
+                    (user_id, peer_type, peer_id, last_message_id, last_message_at, unread_count)
+                SELECT %s, 'user', %s, id, created_at, %s FROM messages WHERE id = %s
+                ON DUPLICATE KEY UPDATE
+                    last_message_id = VALUES(last_message_id),
+                    last_message_at = VALUES(last_message_at),
+                    unread_count = unread_count + VALUES(unread_count)
+            """
+            cursor.execute(summary_sql, (receiver_id, sender_id, 1, message_id))
+            if sender_id != receiver_id:
+                cursor.execute(summary_sql, (sender_id, receiver_id, 0, message_id))
+            self._index_message_media(cursor, message_id, media_url)
             self.chat_conn.commit()
-            return cursor.lastrowid
+        self.after_commit(self.unread_ledger.on_direct_message, sender_id, receiver_id)
+        return message_id
+
+    @staticmethod
+    def _cursor_clause(before_id=None, after_id=None):
+        """Keyset predicate/order for history paging on the messages primary key.
+
+        Returns (sql_fragment, params, order). `before_id` pages back from a
+        cursor (newest first); `after_id` pages forward and is fetched ascending
+        so the rows nearest the cursor win the LIMIT.
+        """
+        if before_id is not None:
+            return " AND m.id < %s", [before_id], "DESC"
+        if after_id is not None:
+            return " AND m.id > %s", [after_id], "ASC"
+        return "", [], "DESC"
 
-    def get_messages(self, sender_id, receiver_id, limit=50):
+    def get_messages(self, sender_id, receiver_id, limit=50, before_id=None, after_id=None):
         with self.chat_conn.cursor(pymysql.cursors.DictCursor) as cursor:
             # Only fetch direct messages (group_id IS NULL)
             sql = """SELECT 
@@ -332,87 +764,100 @@ class Database:
                     p.sender_id as parent_sender_id,
                     p.message_type as parent_message_type, 
                     p.media_url as parent_media_url,
-                    COALESCE(e.name, 'Unknown User') as parent_sender_name,
-                    CASE 
-                        WHEN m.message_type = 'forward' THEN CONCAT('Forwarded message ', COALESCE(e.name, 'Unknown User'))
-                        WHEN m.message_type = 'reply' THEN CONCAT('Reply to ', COALESCE(e.name, 'Unknown User'))
-                        ELSE NULL
-                    END as message_header,
-
                     CASE 
                         WHEN m.message_type = 'reply' THEN 'fa-reply'
                         WHEN m.message_type = 'forward' THEN 'fa-share'
                         ELSE NULL
-                    END as header_icon,
-                    e2.name as sender_name
+                    END as header_icon
                     FROM messages m
                     LEFT JOIN messages p ON m.parent_message_id = p.id
-                    LEFT JOIN ot_employees e ON p.sender_id = e.employee_id
-                    LEFT JOIN ot_employees e2 ON m.sender_id = e2.employee_id
-                    WHERE ((m.sender_id = %s AND m.receiver_id = %s) OR (m.sender_id = %s AND m.receiver_id = %s))
-                    AND m.group_id IS NULL
-                    ORDER BY m.created_at DESC LIMIT %s"""
+                    WHERE m.conversation_key = %s{cursor_sql}
+                    ORDER BY m.id {order} LIMIT %s"""
+            cursor_sql, cursor_params, order = self._cursor_clause(before_id, after_id)
+            sql = sql.format(cursor_sql=cursor_sql, order=order)
             
-            cursor.execute(sql, (sender_id, receiver_id, receiver_id, sender_id, limit))
-            messages = cursor.fetchall()
+            cursor.execute(sql, (direct_conversation_key(sender_id, receiver_id), *cursor_params, limit))
+            messages = list(cursor.fetchall())
+            if order == "ASC":
+                messages.reverse()  # always newest first
             
-            for message in messages:
-                if message['created_at']:
-                    message['created_at'] = message['created_at'].strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-                
-                if message['media_url'] and not message['media_url'].startswith('/static/'):
-                    rel = str(message['media_url'])
-                    base = os.path.basename(rel)
-                    if 'uploads/files/' in rel:
-                        message['media_url'] = f"/static/uploads/files/{base}"
-                    else:
-                        message['media_url'] = f"/static/uploads/images/{base}"
-
-                if message['parent_media_url'] and not message['parent_media_url'].startswith('/static/'):
-                    prel = str(message['parent_media_url'])
-                    pbase = os.path.basename(prel)
-                    if 'uploads/files/' in prel:
-                        message['parent_media_url'] = f"/static/uploads/files/{pbase}"
-                    else:
-                        message['parent_media_url'] = f"/static/uploads/images/{pbase}"
-
-                # Fallback if parent details are missing
-                if message['message_type'] in ['reply', 'forward'] and message['parent_message_id']:
-                    if not message['parent_content'] and not message['parent_media_url']:
-                        message['parent_content'] = 'Original message not available'
-                        message['parent_message_type'] = 'text'
-                        message['parent_media_url'] = None
-
-                    if not message['parent_sender_name'] or message['parent_sender_name'] == 'Unknown User':
-                        parent_message = self.get_message_by_id(message['parent_message_id'])
-                        if parent_message:
-                            message['parent_content'] = parent_message['content']
-                            message['parent_sender_name'] = parent_message['sender_name']
-                            message['parent_message_type'] = parent_message['message_type']
-                            message['parent_media_url'] = parent_message['media_url']
-                            message['message_header'] = f"Reply to {parent_message['sender_name']}"
-
-                # Derive filename from path if missing
-                if (not message.get('filename')) and message.get('media_url'):
-                    path_base = os.path.basename(str(message['media_url']))
-                    # If hash.ext pattern, leave as-is but better to show ext only
-                    message['filename'] = path_base
-
-                # ✅ Fix for forwarded message: clean parent content
-                if message['message_type'] == 'forward':
-                    parent_sender_name = message.get('parent_sender_name', '')
-                    parent_content = message.get('parent_content', '')
-                    if parent_sender_name and parent_content:
-                        cleaned_content = parent_content.replace(parent_sender_name, '', 1).strip()
-                        message['content'] = cleaned_content
-
+            self._hydrate_history(messages)
             return messages
 
+    def _hydrate_history(self, messages):
+        """Shared post-processing for a page of direct or group history rows.
+
+        Parent rows that the history join could not attribute are fetched in a
+        single IN (...) query for the whole page rather than one lookup per row.
+        """
+        missing_parent_ids = set()
+        for message in messages:
+            # Names come from the employee directory instead of joining ot_employees
+            message['sender_name'] = self.employees.name(message['sender_id'])
+            parent_sender_name = self.employees.name(message['parent_sender_id'], 'Unknown User')
+            message['parent_sender_name'] = parent_sender_name
+            if message['message_type'] == 'forward':
+                message['message_header'] = f"Forwarded message {parent_sender_name}"
+            elif message['message_type'] == 'reply':
+                message['message_header'] = f"Reply to {parent_sender_name}"
+            else:
+                message['message_header'] = None
+
+            if message['created_at']:
+                message['created_at'] = message['created_at'].strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+            
+            if message['media_url'] and not message['media_url'].startswith('/static/'):
+                rel = str(message['media_url'])
+                base = os.path.basename(rel)
+                if 'uploads/files/' in rel:
+                    message['media_url'] = f"/static/uploads/files/{base}"
+                else:
+                    message['media_url'] = f"/static/uploads/images/{base}"
+
+            if message['parent_media_url'] and not message['parent_media_url'].startswith('/static/'):
+                prel = str(message['parent_media_url'])
+                pbase = os.path.basename(prel)
+                if 'uploads/files/' in prel:
+                    message['parent_media_url'] = f"/static/uploads/files/{pbase}"
+                else:
+                    message['parent_media_url'] = f"/static/uploads/images/{pbase}"
+
+            # Fallback if parent details are missing
+            if message['message_type'] in ['reply', 'forward'] and message['parent_message_id']:
+                if not message['parent_content'] and not message['parent_media_url']:
+                    message['parent_content'] = 'Original message not available'
+                    message['parent_message_type'] = 'text'
+                    message['parent_media_url'] = None
+
+                if not message['parent_sender_name'] or message['parent_sender_name'] == 'Unknown User':
+                    missing_parent_ids.add(message['parent_message_id'])
+
+            # Derive filename from path if missing
+            if (not message.get('filename')) and message.get('media_url'):
+                path_base = os.path.basename(str(message['media_url']))
+                # If hash.ext pattern, leave as-is but better to show ext only
+                message['filename'] = path_base
+
+        parents = self.get_messages_by_ids(missing_parent_ids) if missing_parent_ids else {}
+        for message in messages:
+            parent_message = parents.get(message['parent_message_id'])
+            if parent_message and message['message_type'] in ['reply', 'forward']:
+                message['parent_content'] = parent_message['content']
+                message['parent_sender_name'] = parent_message['sender_name']
+                message['parent_message_type'] = parent_message['message_type']
+                message['parent_media_url'] = parent_message['media_url']
+                message['message_header'] = f"Reply to {parent_message['sender_name']}"
+
+            # ✅ Fix for forwarded message: clean parent content
+            if message['message_type'] == 'forward':
+                parent_sender_name = message.get('parent_sender_name', '')
+                parent_content = message.get('parent_content', '')
+                if parent_sender_name and parent_content:
+                    cleaned_content = parent_content.replace(parent_sender_name, '', 1).strip()
+                    message['content'] = cleaned_content
+
     def update_message_status(self, message_id, is_read=True):
-        with self.chat_conn.cursor() as cursor:
-            sql = "UPDATE messages SET is_read = %s WHERE id = %s"
-            cursor.execute(sql, (is_read, message_id))
-            self.chat_conn.commit()
+        self.bulk_update_message_status([message_id], is_read)
 
     def update_user_status(self, user_id, is_online=True):
         with self.chat_conn.cursor() as cursor:
@@ -424,6 +869,21 @@ class Database:
             cursor.execute(sql, (user_id, is_online))
             self.chat_conn.commit()
 
+    def update_user_statuses(self, changes, batch_size=500):
+        """Upsert many (user_id, is_online) pairs with multi-row INSERTs"""
+        changes = list(changes)
+        with self.chat_conn.cursor() as cursor:
+            for start in range(0, len(changes), batch_size):
+                batch = changes[start:start + batch_size]
+                sql = f"""INSERT INTO online_status (user_id, is_online, last_seen)
+                        VALUES {', '.join(['(%s, %s, NOW())'] * len(batch))}
+                        ON DUPLICATE KEY UPDATE
+                        is_online = VALUES(is_online),
+                        last_seen = VALUES(last_seen)"""
+                params = [value for user_id, is_online in batch for value in (user_id, bool(is_online))]
+                cursor.execute(sql, params)
+            self.chat_conn.commit()
+
     def get_online_users(self):
         with self.chat_conn.cursor(pymysql.cursors.DictCursor) as cursor:
             sql = """SELECT o.user_id, o.is_online, o.last_seen, e.name
@@ -447,26 +907,15 @@ class Database:
                     e.role,
                     COALESCE(os.is_online, FALSE) AS is_online,
                     os.last_seen,
-                    (
-                        SELECT MAX(m.created_at)
-                        FROM messages m
-                        WHERE m.group_id IS NULL
-                        AND ((m.sender_id = e.employee_id AND m.receiver_id = %s)
-                             OR (m.sender_id = %s AND m.receiver_id = e.employee_id))
-                    ) AS last_direct_msg,
-                    (
-                        SELECT COUNT(*)
-                        FROM messages m
-                        WHERE m.receiver_id = %s 
-                        AND m.sender_id = e.employee_id
-                        AND m.is_read = FALSE
-                        AND m.group_id IS NULL
-                    ) AS unread_count
+                    cs.last_message_at AS last_direct_msg,
+                    COALESCE(cs.unread_count, 0) AS unread_count
                 FROM ot_employees e
                 LEFT JOIN online_status os ON os.user_id = e.employee_id
+                LEFT JOIN conversation_summary cs
+                    ON cs.user_id = %s AND cs.peer_type = 'user' AND cs.peer_id = e.employee_id
                 WHERE e.status = 'Active'
             """
-            cursor.execute(sql, (current_user_id, current_user_id, current_user_id))
+            cursor.execute(sql, (current_user_id,))
             rows = cursor.fetchall()
             for row in rows:
                 if row.get('last_seen'):
@@ -489,25 +938,14 @@ class Database:
                     g.name, 
                     g.creator_id, 
                     g.created_at,
-                    (
-                        SELECT MAX(m.created_at)
-                        FROM messages m
-                        WHERE m.group_id = g.id
-                    ) as last_activity,
-                    (
-                        SELECT COUNT(*)
-                        FROM messages m
-                        JOIN group_members gm ON m.group_id = gm.group_id
-                        LEFT JOIN message_seen ms ON m.id = ms.message_id AND ms.user_id = %s
-                        WHERE gm.user_id = %s
-                        AND ms.message_id IS NULL
-                        AND m.sender_id != %s
-                        AND m.group_id = g.id
-                    ) as unread_count
+                    cs.last_message_at as last_activity,
+                    COALESCE(cs.unread_count, 0) as unread_count
                 FROM `groups` g
                 JOIN `group_members` gm ON g.id = gm.group_id
+                LEFT JOIN conversation_summary cs
+                    ON cs.user_id = gm.user_id AND cs.peer_type = 'group' AND cs.peer_id = CAST(g.id AS CHAR)
                 WHERE gm.user_id = %s
-            """, (user_id, user_id, user_id, user_id))
+            """, (user_id,))
             results = cursor.fetchall()
             for row in results:
                 if 'message_type' in row and 'type' not in row:
@@ -565,17 +1003,17 @@ class Database:
     def get_user_group_unread_counts(self, user_id):
         """Get unread counts for group messages"""
         with self.chat_conn.cursor(pymysql.cursors.DictCursor) as cursor:
+            # Everything past the member's read pointer: one range on idx_messages_group per group
             sql = """
                 SELECT m.group_id, COUNT(*) as unread_count
-                FROM messages m
-                JOIN group_members gm ON m.group_id = gm.group_id
-                LEFT JOIN message_seen ms ON m.id = ms.message_id AND ms.user_id = %s
+                FROM group_members gm
+                LEFT JOIN group_read_pointer p ON p.group_id = gm.group_id AND p.user_id = gm.user_id
+                JOIN messages m ON m.group_id = gm.group_id AND m.id > COALESCE(p.last_seen_message_id, 0)
                 WHERE gm.user_id = %s
-                AND ms.message_id IS NULL
                 AND m.sender_id != %s
                 GROUP BY m.group_id
             """
-            cursor.execute(sql, (user_id, user_id, user_id))
+            cursor.execute(sql, (user_id, user_id))
             results = cursor.fetchall()
             return {f"group_{row['group_id']}": row['unread_count'] for row in results} 
 
@@ -598,9 +1036,7 @@ class Database:
                 return 'offline'
             return 'offline'
 
-    def get_message_by_id(self, message_id):
-        with self.chat_conn.cursor(pymysql.cursors.DictCursor) as cursor:
-            sql = """SELECT 
+    _MESSAGE_BY_ID_SQL = """SELECT 
                     m.id, 
                     m.sender_id, 
                     m.receiver_id, 
@@ -617,24 +1053,39 @@ class Database:
                     e.name as sender_name
                     FROM messages m
                     LEFT JOIN ot_employees e ON m.sender_id = e.employee_id
-                    WHERE m.id = %s"""
-            cursor.execute(sql, (message_id,))
-            message = cursor.fetchone()
+                    WHERE m.id IN ({ids})"""
+
+    @staticmethod
+    def _format_message_row(message):
+        if message['created_at']:
+            message['created_at'] = message['created_at'].strftime('%Y-%m-%dT%H:%M:%S.%fZ')
             
-            if message and message['created_at']:
-                message['created_at'] = message['created_at'].strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-                
-            if message and message['media_url'] and not message['media_url'].startswith('/static/'):
-                rel = str(message['media_url'])
-                base = os.path.basename(rel)
-                if 'uploads/files/' in rel:
-                    message['media_url'] = f"uploads/files/{base}"
-                else:
-                    message['media_url'] = f"uploads/images/{base}"
-            if message and not message.get('filename') and message.get('media_url'):
-                message['filename'] = os.path.basename(str(message['media_url']))
-                
-            return message
+        if message['media_url'] and not message['media_url'].startswith('/static/'):
+            rel = str(message['media_url'])
+            base = os.path.basename(rel)
+            if 'uploads/files/' in rel:
+                message['media_url'] = f"uploads/files/{base}"
+            else:
+                message['media_url'] = f"uploads/images/{base}"
+        if not message.get('filename') and message.get('media_url'):
+            message['filename'] = os.path.basename(str(message['media_url']))
+        return message
+
+    def get_message_by_id(self, message_id):
+        with self.chat_conn.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute(self._MESSAGE_BY_ID_SQL.format(ids='%s'), (message_id,))
+            message = cursor.fetchone()
+            return self._format_message_row(message) if message else message
+
+    def get_messages_by_ids(self, message_ids):
+        """Batch form of get_message_by_id: {id: message} for the ids that exist"""
+        message_ids = list(message_ids)
+        if not message_ids:
+            return {}
+        with self.chat_conn.cursor(pymysql.cursors.DictCursor) as cursor:
+            placeholders = ','.join(['%s'] * len(message_ids))
+            cursor.execute(self._MESSAGE_BY_ID_SQL.format(ids=placeholders), message_ids)
+            return {row['id']: self._format_message_row(row) for row in cursor.fetchall()}
 
     # --- CHAT PIN METHODS ---
     def set_chat_pin(self, user_id: str, target_type: str, target_id: str, pin: bool) -> None:
@@ -707,7 +1158,22 @@ class Database:
                 if user_id != creator_id:
                     cursor.execute("INSERT INTO `group_members` (group_id, user_id) VALUES (%s, %s)", (group_id, user_id))
             self.chat_conn.commit()
-            return group_id
+        self.after_commit(self.memberships.invalidate_group, group_id)
+        for user_id in {creator_id, *member_ids}:
+            self.after_commit(self.memberships.invalidate_user, user_id)
+        return group_id
+
+    def get_group_member_ids(self, group_id):
+        """Membership-only lookup (no employee join)"""
+        with self.chat_conn.cursor() as cursor:
+            cursor.execute("SELECT user_id FROM `group_members` WHERE group_id = %s", (group_id,))
+            return [row[0] for row in cursor.fetchall()]
+
+    def get_user_group_ids(self, user_id):
+        """Membership-only lookup of a user's group ids"""
+        with self.chat_conn.cursor() as cursor:
+            cursor.execute("SELECT group_id FROM `group_members` WHERE user_id = %s", (user_id,))
+            return [row[0] for row in cursor.fetchall()]
 
     def get_group_members(self, group_id):
         with self.chat_conn.cursor(pymysql.cursors.DictCursor) as cursor:
@@ -726,12 +1192,23 @@ class Database:
     def add_group_member(self, group_id, user_id, is_admin=False):
         with self.chat_conn.cursor() as cursor:
             cursor.execute("INSERT IGNORE INTO `group_members` (group_id, user_id, is_admin) VALUES (%s, %s, %s)", (group_id, user_id, is_admin))
+            self._refresh_group_summary(cursor, group_id, user_id)
             self.chat_conn.commit()
+        self.after_commit(self.memberships.invalidate_group, group_id)
+        self.after_commit(self.memberships.invalidate_user, user_id)
+        self.after_commit(self.unread_ledger.invalidate, user_id)
 
     def remove_group_member(self, group_id, user_id):
         with self.chat_conn.cursor() as cursor:
             cursor.execute("DELETE FROM `group_members` WHERE group_id = %s AND user_id = %s", (group_id, user_id))
+            cursor.execute(
+                "DELETE FROM conversation_summary WHERE user_id = %s AND peer_type = 'group' AND peer_id = %s",
+                (user_id, str(group_id))
+            )
             self.chat_conn.commit()
+        self.after_commit(self.memberships.invalidate_group, group_id)
+        self.after_commit(self.memberships.invalidate_user, user_id)
+        self.after_commit(self.unread_ledger.invalidate, user_id)
 
     def is_group_admin(self, group_id, user_id):
         with self.chat_conn.cursor() as cursor:
@@ -744,13 +1221,31 @@ class Database:
         with self.chat_conn.cursor() as cursor:
             # Always set receiver_id to NULL for group messages
             sql = """INSERT INTO messages 
-                    (sender_id, receiver_id, group_id, content, message_type, parent_message_id, media_url, media_type, file_size, filename) 
-                    VALUES (%s, NULL, %s, %s, %s, %s, %s, %s, %s, %s)"""
-            cursor.execute(sql, (sender_id, group_id, content, message_type, parent_message_id, media_url, media_type, file_size, filename))
+                    (sender_id, receiver_id, group_id, conversation_key, content, message_type, parent_message_id, media_url, media_type, file_size, filename) 
+                    VALUES (%s, NULL, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+            cursor.execute(sql, (sender_id, group_id, group_conversation_key(group_id), content, message_type, parent_message_id, media_url, media_type, file_size, filename))
+            message_id = cursor.lastrowid
+            # Same transaction: one summary row per member; unread for everyone but the sender
+            cursor.execute("""
+                INSERT INTO conversation_summary
+                    (user_id, peer_type, peer_id, last_message_id, last_message_at, unread_count)
+                SELECT gm.user_id, 'group', CAST(gm.group_id AS CHAR), m.id, m.created_at,
+                       IF(gm.user_id = m.sender_id, 0, 1)
+                FROM `group_members` gm
+                JOIN messages m ON m.id = %s
+                WHERE gm.group_id = %s
+                ON DUPLICATE KEY UPDATE
+                    last_message_id = VALUES(last_message_id),
+                    last_message_at = VALUES(last_message_at),
+                    unread_count = unread_count + VALUES(unread_count)
+            """, (message_id, group_id))
+            self._index_message_media(cursor, message_id, media_url)
             self.chat_conn.commit()
-            return cursor.lastrowid
+        member_ids = self.memberships.members(group_id)
+        self.after_commit(self.unread_ledger.on_group_message, group_id, sender_id, member_ids)
+        return message_id
 
-    def get_group_messages(self, group_id, limit=50):
+    def get_group_messages(self, group_id, limit=50, before_id=None, after_id=None):
         with self.chat_conn.cursor(pymysql.cursors.DictCursor) as cursor:
             sql = """SELECT 
                     m.id, 
@@ -769,80 +1264,99 @@ class Database:
                     p.sender_id as parent_sender_id,
                     p.message_type as parent_message_type, 
                     p.media_url as parent_media_url,
-                    COALESCE(e.name, 'Unknown User') as parent_sender_name,
-                    CASE 
-                        WHEN m.message_type = 'forward' THEN CONCAT('Forwarded message ', COALESCE(e.name, 'Unknown User'))
-                        WHEN m.message_type = 'reply' THEN CONCAT('Reply to ', COALESCE(e.name, 'Unknown User'))
-                        ELSE NULL
-                    END as message_header,
-
                     CASE 
                         WHEN m.message_type = 'reply' THEN 'fa-reply'
                         WHEN m.message_type = 'forward' THEN 'fa-share'
                         ELSE NULL
-                    END as header_icon,
-                    e2.name as sender_name
+                    END as header_icon
                     FROM messages m
                     LEFT JOIN messages p ON m.parent_message_id = p.id
-                    LEFT JOIN ot_employees e ON p.sender_id = e.employee_id
-                    LEFT JOIN ot_employees e2 ON m.sender_id = e2.employee_id
-                    WHERE m.group_id = %s AND m.receiver_id IS NULL
-                    ORDER BY m.created_at DESC LIMIT %s"""
+                    WHERE m.group_id = %s AND m.receiver_id IS NULL{cursor_sql}
+                    ORDER BY m.id {order} LIMIT %s"""
+            cursor_sql, cursor_params, order = self._cursor_clause(before_id, after_id)
+            sql = sql.format(cursor_sql=cursor_sql, order=order)
             
-            cursor.execute(sql, (group_id, limit))
-            messages = cursor.fetchall()
-
-            for message in messages:
-                if message['created_at']:
-                    message['created_at'] = message['created_at'].strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-
-                if message['media_url'] and not message['media_url'].startswith('/static/'):
-                    rel = str(message['media_url'])
-                    base = os.path.basename(rel)
-                    if 'uploads/files/' in rel:
-                        message['media_url'] = f"/static/uploads/files/{base}"
-                    else:
-                        message['media_url'] = f"/static/uploads/images/{base}"
-
-                if message['parent_media_url'] and not message['parent_media_url'].startswith('/static/'):
-                    prel = str(message['parent_media_url'])
-                    pbase = os.path.basename(prel)
-                    if 'uploads/files/' in prel:
-                        message['parent_media_url'] = f"/static/uploads/files/{pbase}"
-                    else:
-                        message['parent_media_url'] = f"/static/uploads/images/{pbase}"
-
-                # Derive filename from path if missing
-                if (not message.get('filename')) and message.get('media_url'):
-                    path_base = os.path.basename(str(message['media_url']))
-                    message['filename'] = path_base
-
-                # ✅ Clean parent content for forwarded messages (remove sender name)
-                if message['message_type'] == 'forward':
-                    parent_sender_name = message.get('parent_sender_name', '')
-                    parent_content = message.get('parent_content', '')
-                    if parent_sender_name and parent_content:
-                        cleaned_content = parent_content.replace(parent_sender_name, '', 1).strip()
-                        message['content'] = cleaned_content
+            cursor.execute(sql, (group_id, *cursor_params, limit))
+            messages = list(cursor.fetchall())
+            if order == "ASC":
+                messages.reverse()  # always newest first
 
+            self._hydrate_history(messages)
             return messages
 
     def mark_message_seen(self, message_id, user_id):
+        """Advance the user's read pointer in the message's group to it.
+
+        Returns (group_id, previous_pointer, up_to_id) like
+        mark_group_seen_up_to. Raises PermissionError when the user is not a
+        member of the message's group.
+        """
         with self.chat_conn.cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO message_seen (message_id, user_id) VALUES (%s, %s)
-                ON DUPLICATE KEY UPDATE seen_at = CURRENT_TIMESTAMP
-            """, (message_id, user_id))
+            cursor.execute("SELECT group_id FROM messages WHERE id = %s", (message_id,))
+            row = cursor.fetchone()
+        if not row or row[0] is None:
+            return None
+        if str(row[0]) not in self.memberships.groups(user_id):
+            raise PermissionError("NOT_GROUP_MEMBER")
+        return self.mark_group_seen_up_to(row[0], user_id, message_id)
+
+    def mark_group_seen_up_to(self, group_id, user_id, up_to_id):
+        """Move the (group, user) read pointer forward to up_to_id.
+
+        Returns (group_id, previous_pointer, up_to_id) when it advanced, None otherwise.
+        The unread count drops by the messages from others inside that range.
+        """
+        up_to_id = int(up_to_id)
+        with self.chat_conn.cursor() as cursor:
+            cursor.execute(
+                """SELECT last_seen_message_id FROM group_read_pointer
+                    WHERE group_id = %s AND user_id = %s FOR UPDATE""",
+                (group_id, user_id)
+            )
+            row = cursor.fetchone()
+            previous = row[0] if row else 0
+            if up_to_id <= previous:
+                self.chat_conn.commit()
+                return None
+            cursor.execute(
+                f"""INSERT INTO group_read_pointer (group_id, user_id, last_seen_message_id, seen_at)
+                    VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
+                    {_ADVANCE_READ_POINTER_SQL}""",
+                (group_id, user_id, up_to_id)
+            )
+            cursor.execute(
+                """SELECT COUNT(*) FROM messages
+                    WHERE group_id = %s AND id > %s AND id <= %s AND sender_id != %s""",
+                (group_id, previous, up_to_id, user_id)
+            )
+            newly_seen = cursor.fetchone()[0]
+            if newly_seen:
+                cursor.execute(
+                    """UPDATE conversation_summary
+                        SET unread_count = GREATEST(unread_count - %s, 0)
+                        WHERE user_id = %s AND peer_type = 'group' AND peer_id = %s""",
+                    (newly_seen, user_id, str(group_id))
+                )
             self.chat_conn.commit()
+        if newly_seen:
+            self.after_commit(self.unread_ledger.on_group_seen, user_id, group_id, newly_seen)
+        return group_id, previous, up_to_id
 
     def get_message_seen_users(self, message_id):
+        """Members whose read pointer has reached the message (its sender excluded).
+
+        seen_at is when the pointer last advanced, so it is the time the
+        member caught up to (at least) this message.
+        """
         with self.chat_conn.cursor(pymysql.cursors.DictCursor) as cursor:
             sql = """
-                SELECT s.user_id, e.name, 
-                    CONVERT_TZ(s.seen_at, @@session.time_zone, '+00:00') as seen_at_utc
-                FROM message_seen s
-                LEFT JOIN ot_employees e ON s.user_id = e.employee_id
-                WHERE s.message_id = %s
+                SELECT p.user_id, e.name,
+                    CONVERT_TZ(p.seen_at, @@session.time_zone, '+00:00') as seen_at_utc
+                FROM messages m
+                JOIN group_read_pointer p
+                    ON p.group_id = m.group_id AND p.last_seen_message_id >= m.id
+                LEFT JOIN ot_employees e ON p.user_id = e.employee_id
+                WHERE m.id = %s AND p.user_id != m.sender_id
             """
             cursor.execute(sql, (message_id,))
             users = cursor.fetchall()
@@ -852,6 +1366,166 @@ class Database:
                     user['seen_at'] = user['seen_at_utc'].isoformat() + 'Z' if user['seen_at_utc'] else None
             return users
 
+    # --- BLOB INDEX ---
+    def get_blob(self, sha256):
+        with self.chat_conn.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("SELECT * FROM blobs WHERE sha256 = %s LIMIT 1", (sha256,))
+            return cursor.fetchone()
+
+    def register_blob(self, sha256, ext, size, mime=None):
+        """Record a stored blob, or bump its refcount if already known"""
+        with self.chat_conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO blobs (sha256, ext, size, mime) VALUES (%s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE refcount = refcount + 1
+            """, (sha256, ext or '', size, mime))
+        self.chat_conn.commit()
+
+    # --- MESSAGE MEDIA INDEX ---
+    @staticmethod
+    def _index_message_media(cursor, message_id, media_url):
+        entry = media_index_entry(media_url)
+        if entry:
+            cursor.execute(
+                "INSERT IGNORE INTO message_media (message_id, kind, blob_name, sha256) VALUES (%s, %s, %s, %s)",
+                (message_id, *entry)
+            )
+
+    def get_message_media(self, message_id):
+        """media_url/filename of a message plus its message_media row (kind, blob_name, sha256)"""
+        with self.chat_conn.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT m.id, m.media_url, m.filename, mm.kind, mm.blob_name, mm.sha256
+                FROM messages m
+                LEFT JOIN message_media mm ON mm.message_id = m.id
+                WHERE m.id = %s
+            """, (message_id,))
+            return cursor.fetchone()
+
+    def backfill_message_media(self, batch_size=5000):
+        with self.chat_conn.cursor() as cursor:
+            return _backfill_message_media(cursor, batch_size)
+
+    def iter_message_media(self, batch_size=5000):
+        """Yield all message_media rows in primary-key order"""
+        last_id = 0
+        while True:
+            with self.chat_conn.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute(
+                    "SELECT message_id, kind, blob_name, sha256 FROM message_media "
+                    "WHERE message_id > %s ORDER BY message_id LIMIT %s",
+                    (last_id, batch_size)
+                )
+                rows = cursor.fetchall()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1]['message_id']
+
+    # --- CONVERSATION SUMMARY ---
+    def _refresh_group_summary(self, cursor, group_id=None, user_id=None):
+        """Recompute group summary rows from messages/group_read_pointer.
+
+        Scoped to one group and/or one member when given; all memberships otherwise.
+        """
+        where = []
+        params = []
+        if group_id is not None:
+            where.append("gm.group_id = %s")
+            params.append(group_id)
+        if user_id is not None:
+            where.append("gm.user_id = %s")
+            params.append(user_id)
+        cursor.execute(f"""
+            INSERT INTO conversation_summary
+                (user_id, peer_type, peer_id, last_message_id, last_message_at, unread_count)
+            SELECT
+                gm.user_id, 'group', CAST(gm.group_id AS CHAR),
+                (SELECT MAX(m.id) FROM messages m WHERE m.group_id = gm.group_id),
+                (SELECT MAX(m.created_at) FROM messages m WHERE m.group_id = gm.group_id),
+                (
+                    SELECT COUNT(*)
+                    FROM messages m
+                    WHERE m.group_id = gm.group_id
+                    AND m.id > COALESCE((
+                        SELECT p.last_seen_message_id FROM group_read_pointer p
+                        WHERE p.group_id = gm.group_id AND p.user_id = gm.user_id
+                    ), 0)
+                    AND m.sender_id != gm.user_id
+                )
+            FROM `group_members` gm
+            {('WHERE ' + ' AND '.join(where)) if where else ''}
+            ON DUPLICATE KEY UPDATE
+                last_message_id = VALUES(last_message_id),
+                last_message_at = VALUES(last_message_at),
+                unread_count = VALUES(unread_count)
+        """, params)
+
+    def backfill_conversation_summary(self):
+        """Rebuild conversation_summary from existing messages (idempotent)."""
+        with self.chat_conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO conversation_summary
+                    (user_id, peer_type, peer_id, last_message_id, last_message_at, unread_count)
+                SELECT t.user_id, 'user', t.peer_id, MAX(t.id), MAX(t.created_at), SUM(t.unread)
+                FROM (
+                    SELECT sender_id AS user_id, receiver_id AS peer_id, id, created_at, 0 AS unread
+                    FROM messages
+                    WHERE group_id IS NULL AND receiver_id IS NOT NULL
+                    UNION ALL
+                    SELECT receiver_id, sender_id, id, created_at, IF(is_read, 0, 1)
+                    FROM messages
+                    WHERE group_id IS NULL AND receiver_id IS NOT NULL
+                ) t
+                GROUP BY t.user_id, t.peer_id
+                ON DUPLICATE KEY UPDATE
+                    last_message_id = VALUES(last_message_id),
+                    last_message_at = VALUES(last_message_at),
+                    unread_count = VALUES(unread_count)
+            """)
+            self._refresh_group_summary(cursor)
+        self.chat_conn.commit()
+
+    def run_backfills(self, batch_size=5000):
+        """Row backfills that go with MIGRATIONS; each only touches rows still
+        missing their data, so re-running is cheap. Returns counts per step."""
+        with self.chat_conn.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM conversation_summary LIMIT 1")
+            summary_empty = cursor.fetchone() is None
+        done = {
+            'conversation_key': self.backfill_conversation_keys(batch_size),
+            'message_media': self.backfill_message_media(batch_size),
+            'message_seen': self.compact_message_seen(batch_size),
+        }
+        if summary_empty:
+            self.backfill_conversation_summary()
+        done['conversation_summary'] = 'rebuilt' if summary_empty else 'kept'
+        return done
+
+    def compact_message_seen(self, batch_size=5000):
+        """Fold legacy message_seen rows into group_read_pointer"""
+        with self.chat_conn.cursor() as cursor:
+            return _compact_message_seen(cursor, batch_size)
+
+    def backfill_conversation_keys(self, batch_size=5000):
+        """Fill messages.conversation_key for rows written before the column existed"""
+        with self.chat_conn.cursor() as cursor:
+            return _backfill_conversation_keys(cursor, batch_size)
+
+    def get_unread_summary(self, user_id):
+        """Combined unread counts keyed like `unread_counts_update` (peer id / group_<id>)"""
+        with self.chat_conn.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("""
+                SELECT peer_type, peer_id, unread_count
+                FROM conversation_summary
+                WHERE user_id = %s AND unread_count > 0
+            """, (user_id,))
+            counts = {}
+            for row in cursor.fetchall():
+                key = row['peer_id'] if row['peer_type'] == 'user' else f"group_{row['peer_id']}"
+                counts[key] = row['unread_count']
+            return counts
+
     def pin_message(self, message_id, pin=True):
         with self.chat_conn.cursor() as cursor:
             sql = "UPDATE messages SET pinned = %s WHERE id = %s"
@@ -864,48 +1538,356 @@ class Database:
                 sql = "SELECT * FROM messages WHERE group_id = %s AND pinned = TRUE ORDER BY created_at DESC"
                 cursor.execute(sql, (group_id,))
             elif sender_id and receiver_id:
-                sql = "SELECT * FROM messages WHERE ((sender_id = %s AND receiver_id = %s) OR (sender_id = %s AND receiver_id = %s)) AND group_id IS NULL AND pinned = TRUE ORDER BY created_at DESC"
-                cursor.execute(sql, (sender_id, receiver_id, receiver_id, sender_id))
+                sql = "SELECT * FROM messages WHERE conversation_key = %s AND pinned = TRUE ORDER BY id DESC"
+                cursor.execute(sql, (direct_conversation_key(sender_id, receiver_id),))
             else:
                 return []
             return cursor.fetchall()
 
-    def search_messages(self, query, sender_id=None, receiver_id=None, group_id=None, limit=50):
-        with self.chat_conn.cursor(pymysql.cursors.DictCursor) as cursor:
-            like_query = f"%{query}%"
-            # Search in content OR filename OR media_url (covers images/files by name)
-            if group_id:
-                sql = (
-                    "SELECT * FROM messages "
-                    "WHERE group_id = %s AND (content LIKE %s OR filename LIKE %s OR media_url LIKE %s) "
-                    "ORDER BY created_at DESC LIMIT %s"
-                )
-                cursor.execute(sql, (group_id, like_query, like_query, like_query, limit))
-            elif sender_id and receiver_id:
-                sql = (
-                    "SELECT * FROM messages "
-                    "WHERE ((sender_id = %s AND receiver_id = %s) OR (sender_id = %s AND receiver_id = %s)) "
-                    "AND group_id IS NULL "
-                    "AND (content LIKE %s OR filename LIKE %s OR media_url LIKE %s) "
-                    "ORDER BY created_at DESC LIMIT %s"
+    _SEARCH_MATCH_SQL = "MATCH(m.content, m.filename) AGAINST (%s IN BOOLEAN MODE)"
+
+    def search_messages(self, query, sender_id=None, receiver_id=None, group_id=None, limit=50, cursor=None):
+        """Full-text search within one direct pair or one group.
+
+        Words are prefix-matched and all required; results are ranked by
+        relevance (newest first on ties) and carry an HTML `snippet` with the
+        matches in <mark>. Returns (messages, next_cursor). Queries with no
+        indexable word (all shorter than the index's minimum token size)
+        fall back to an escaped LIKE scan of that conversation.
+        """
+        if group_id:
+            scope_sql, scope_params = "m.group_id = %s", [group_id]
+        elif sender_id and receiver_id:
+            scope_sql, scope_params = "m.conversation_key = %s", [direct_conversation_key(sender_id, receiver_id)]
+        else:
+            return [], None
+        return self._search(query, scope_sql, scope_params, limit, cursor)
+
+    def search_all_messages(self, user_id, query, limit=50, cursor=None):
+        """Full-text search across every conversation `user_id` can see.
+
+        The scope is the user's own direct messages plus the groups they
+        belong to (from the membership cache), evaluated in one query against
+        the full-text index. Hits are ranked as in `search_messages` and then
+        grouped by conversation, best conversation first. Returns
+        (conversations, next_cursor). The cursor pages through the underlying
+        hit list, so a conversation can continue on the next page.
+        """
+        user_id = str(user_id)
+        scope_sql = "(m.group_id IS NULL AND (m.sender_id = %s OR m.receiver_id = %s))"
+        scope_params = [user_id, user_id]
+        group_ids = sorted(self.memberships.groups(user_id))
+        if group_ids:
+            placeholders = ','.join(['%s'] * len(group_ids))
+            scope_sql = f"({scope_sql} OR m.group_id IN ({placeholders}))"
+            scope_params += [int(gid) for gid in group_ids]
+        rows, next_cursor = self._search(query, scope_sql, scope_params, limit, cursor)
+        return self._group_search_hits(user_id, rows), next_cursor
+
+    def _group_search_hits(self, user_id, rows):
+        conversations = {}
+        for row in rows:
+            # Derived here rather than read from the row: conversation_key is
+            # NULL on rows the backfill hasn't reached yet
+            if row.get('group_id'):
+                key = group_conversation_key(row['group_id'])
+            else:
+                key = direct_conversation_key(row['sender_id'], row['receiver_id'])
+            if key not in conversations:
+                if row.get('group_id'):
+                    entry = {'type': 'group', 'group_id': row['group_id']}
+                else:
+                    peer_id = row['receiver_id'] if str(row['sender_id']) == user_id else row['sender_id']
+                    entry = {'type': 'user', 'peer_id': peer_id, 'name': self.employees.name(peer_id)}
+                entry.update({'conversation_key': key, 'top_score': row['score'], 'messages': []})
+                conversations[key] = entry
+            conversations[key]['messages'].append(row)
+        group_ids = {c['group_id'] for c in conversations.values() if c['type'] == 'group'}
+        if group_ids:
+            placeholders = ','.join(['%s'] * len(group_ids))
+            with self.chat_conn.cursor() as cur:
+                cur.execute(f"SELECT id, name FROM `groups` WHERE id IN ({placeholders})", tuple(group_ids))
+                names = dict(cur.fetchall())
+            for conversation in conversations.values():
+                if conversation['type'] == 'group':
+                    conversation['name'] = names.get(conversation['group_id'])
+        # Rows arrive best-first, so insertion order already ranks conversations
+        return list(conversations.values())
+
+    def _search(self, query, scope_sql, scope_params, limit, cursor):
+        tokens = search.tokenize(query)
+        if not tokens:
+            return [], None
+        boolean = search.boolean_query(tokens)
+        # Highlight what the index matched; the LIKE fallback matched the raw words
+        highlight = search.query_terms(tokens) if boolean else tokens
+        after = search.decode_cursor(cursor)
+        with self.chat_conn.cursor(pymysql.cursors.DictCursor) as cur:
+            if boolean:
+                score_sql = f"ROUND({self._SEARCH_MATCH_SQL}, 6)"
+                where = [scope_sql, self._SEARCH_MATCH_SQL]
+                params = [boolean, *scope_params, boolean]
+                if after:
+                    where.append(f"({score_sql} < %s OR ({score_sql} = %s AND m.id < %s))")
+                    params += [boolean, after[0], boolean, after[0], after[1]]
+                cur.execute(
+                    f"""SELECT m.*, {score_sql} AS score FROM messages m
+                        WHERE {' AND '.join(where)}
+                        ORDER BY score DESC, m.id DESC LIMIT %s""",
+                    (*params, limit)
                 )
-                cursor.execute(sql, (sender_id, receiver_id, receiver_id, sender_id, like_query, like_query, like_query, limit))
             else:
-                return []
-            return cursor.fetchall()
+                like = f"%{search.escape_like(' '.join(tokens))}%"
+                where = [scope_sql, "(m.content LIKE %s OR m.filename LIKE %s)"]
+                params = [*scope_params, like, like]
+                if after:
+                    where.append("m.id < %s")
+                    params.append(after[1])
+                cur.execute(
+                    f"""SELECT m.*, 0 AS score FROM messages m
+                        WHERE {' AND '.join(where)}
+                        ORDER BY m.id DESC LIMIT %s""",
+                    (*params, limit)
+                )
+            rows = cur.fetchall()
+        for row in rows:
+            row['score'] = float(row['score'] or 0)
+            row['sender_name'] = self.employees.name(row['sender_id'])
+            row['snippet'] = search.snippet(row.get('content'), highlight) or search.snippet(row.get('filename'), highlight)
+            if row.get('created_at'):
+                row['created_at'] = row['created_at'].strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        next_cursor = search.encode_cursor(rows[-1]['score'], rows[-1]['id']) if len(rows) >= limit else None
+        return rows, next_cursor
+
+    def mark_direct_read_up_to(self, receiver_id, sender_id, up_to_id):
+        """Mark every unread message from sender to receiver with id <= up_to_id
+        as read in one statement; returns how many rows flipped"""
+        with self.chat_conn.cursor() as cursor:
+            changed = cursor.execute(
+                """UPDATE messages SET is_read = TRUE
+                    WHERE conversation_key = %s AND id <= %s
+                      AND receiver_id = %s AND sender_id = %s AND is_read = FALSE""",
+                (direct_conversation_key(sender_id, receiver_id), up_to_id, receiver_id, sender_id)
+            )
+            if changed:
+                cursor.execute(
+                    """UPDATE conversation_summary
+                        SET unread_count = GREATEST(unread_count - %s, 0)
+                        WHERE user_id = %s AND peer_type = 'user' AND peer_id = %s""",
+                    (changed, receiver_id, sender_id)
+                )
+            self.chat_conn.commit()
+        if changed:
+            self.after_commit(self.unread_ledger.on_direct_read, receiver_id, sender_id, changed)
+        return changed
 
     def bulk_update_message_status(self, message_ids, is_read=True):
+        if not message_ids:
+            return
+        placeholders = ','.join(['%s'] * len(message_ids))
         with self.chat_conn.cursor() as cursor:
+            # Lock the rows whose read state actually flips so the ledger
+            # deltas match what this statement changes
+            cursor.execute(
+                f"""SELECT receiver_id, sender_id, COUNT(*)
+                    FROM messages
+                    WHERE id IN ({placeholders}) AND is_read = %s AND group_id IS NULL
+                    GROUP BY receiver_id, sender_id
+                    FOR UPDATE""",
+                (*message_ids, not is_read)
+            )
+            changed = cursor.fetchall()
             sql = "UPDATE messages SET is_read = %s WHERE id IN (%s)" % (
-                is_read, ','.join(['%s'] * len(message_ids)))
+                is_read, placeholders)
             cursor.execute(sql, message_ids)
-            self.chat_conn.commit()        
+            for receiver_id, sender_id, count in changed:
+                cursor.execute(
+                    """UPDATE conversation_summary
+                        SET unread_count = GREATEST(unread_count + %s, 0)
+                        WHERE user_id = %s AND peer_type = 'user' AND peer_id = %s""",
+                    (-count if is_read else count, receiver_id, sender_id)
+                )
+            self.chat_conn.commit()
+        for receiver_id, sender_id, count in changed:
+            if is_read:
+                self.after_commit(self.unread_ledger.on_direct_read, receiver_id, sender_id, count)
+            else:
+                self.after_commit(self.unread_ledger.invalidate, receiver_id)
 
     def __del__(self):
         # Connections are pooled; nothing to close here.
         pass
 
 
+# Client errors meaning the server connection is gone (wait_timeout, restart, ...)
+_CONNECTION_LOST_CODES = {2006, 2013, 2014, 2045, 2055}
+
+
+class _RetryingCursor:
+    """
+    Cursor proxy that re-runs the first statement of a checkout once on a new
+    connection when the pooled one turns out to be dead. Later statements are
+    never retried, since earlier work in the transaction would be lost.
+    """
+
+    def __init__(self, ctx, cursor, retry=True):
+        self._ctx = ctx
+        self._cursor = cursor
+        self._executed = not retry
+
+    def _run(self, name, *args):
+        if self._executed:
+            return getattr(self._cursor, name)(*args)
+        self._executed = True
+        try:
+            return getattr(self._cursor, name)(*args)
+        except pymysql.err.OperationalError as e:
+            if not e.args or e.args[0] not in _CONNECTION_LOST_CODES:
+                raise
+            self._cursor = self._ctx._reconnect()
+            return getattr(self._cursor, name)(*args)
+
+    def execute(self, query, args=None):
+        return self._run('execute', query, args)
+
+    def executemany(self, query, args):
+        return self._run('executemany', query, args)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+# Unit of work active in the current thread/greenlet (see Database.session)
+_current_session = ContextVar('chat_db_session', default=None)
+
+
+def _run_hooks(hooks):
+    # One failing hook must not stop the rest (or fail an already committed
+    # unit of work), but a broken emit or ledger delta has to show up in logs
+    for fn, args in hooks:
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception("Session hook %r failed", fn)
+
+
+class DbSession:
+    """
+    One pooled connection and transaction shared by every Database call made
+    while the session is active. The connection is checked out on first use
+    and the session commits once when it ends. It rolls back instead only if
+    an exception escaped the block: a statement error the caller handled
+    leaves the InnoDB transaction open, so the other writes still commit.
+    """
+
+    def __init__(self, pool, cfg):
+        self._pool = pool
+        self._cfg = cfg
+        self._conn = None
+        self._token = None
+        self.executed = False
+        self._after_commit = []
+        self._on_rollback = []
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = self._pool.connection() if self._pool is not None else pymysql.connect(**self._cfg)
+        return self._conn
+
+    def _discard_connection(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if hasattr(conn, 'broken'):
+            conn.broken = True
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def cursor(self, cursor_class=None):
+        return _SessionCursorContext(self, cursor_class)
+
+    def after_commit(self, fn, *args):
+        self._after_commit.append((fn, args))
+
+    def on_rollback(self, fn, *args):
+        self._on_rollback.append((fn, args))
+
+    def commit(self):
+        """Commit what has run so far; the session stays usable"""
+        _run_hooks(self._commit())
+
+    def rollback(self):
+        _run_hooks(self._rollback())
+
+    def _commit(self):
+        if self._conn is not None:
+            try:
+                self._conn.commit()
+            except Exception:
+                self.rollback()
+                raise
+        hooks, self._after_commit, self._on_rollback = self._after_commit, [], []
+        return hooks
+
+    def _rollback(self):
+        if self._conn is not None:
+            try:
+                self._conn.rollback()
+            except Exception:
+                self._discard_connection()
+        hooks, self._after_commit, self._on_rollback = self._on_rollback, [], []
+        return hooks
+
+    def close(self, failed=False):
+        """Commit (or roll back) and return the connection to the pool.
+
+        Returns the hooks for the outcome; the caller runs them once the
+        session is no longer current (see Database.end_session).
+        """
+        try:
+            return self._rollback() if failed else self._commit()
+        finally:
+            if self._conn is not None:
+                conn, self._conn = self._conn, None
+                conn.close()
+
+
+class _SessionCursorContext:
+    """Cursor on the session's connection; commit/rollback are left to the session"""
+
+    def __init__(self, session, cursor_class=None):
+        self._session = session
+        self._cursor_class = cursor_class
+        self._cursor = None
+
+    def _open(self):
+        conn = self._session._connection()
+        self._cursor = conn.cursor(self._cursor_class) if self._cursor_class else conn.cursor()
+        return self._cursor
+
+    def _reconnect(self):
+        self._session._discard_connection()
+        return self._open()
+
+    def __enter__(self):
+        # Only the session's very first statement may be retried on a new connection
+        retry = not self._session.executed
+        self._session.executed = True
+        return _RetryingCursor(self, self._open(), retry=retry)
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self._cursor is not None:
+                self._cursor.close()
+        except Exception:
+            pass
+
+
 class _PooledCursorContext:
     def __init__(self, pool, cfg, cursor_class=None):
         self._pool = pool
@@ -914,7 +1896,7 @@ class _PooledCursorContext:
         self._conn = None
         self._cursor = None
 
-    def __enter__(self):
+    def _open(self):
         if self._pool is not None:
             self._conn = self._pool.connection()
         else:
@@ -923,6 +1905,23 @@ class _PooledCursorContext:
         self._cursor = self._conn.cursor(self._cursor_class) if self._cursor_class else self._conn.cursor()
         return self._cursor
 
+    def _reconnect(self):
+        """Drop the dead connection and check out another one"""
+        if hasattr(self._conn, 'broken'):
+            self._conn.broken = True
+        try:
+            self._cursor.close()
+        except Exception:
+            pass
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+        return self._open()
+
+    def __enter__(self):
+        return _RetryingCursor(self, self._open())
+
     def __exit__(self, exc_type, exc, tb):
         try:
             if exc_type is None:
@@ -955,6 +1954,9 @@ class _PooledConnectionProxy:
         self._cfg = cfg
 
     def cursor(self, cursor_class=None):
+        session = _current_session.get()
+        if session is not None:
+            return session.cursor(cursor_class)
         return _PooledCursorContext(self._pool, self._cfg, cursor_class)
 
     def commit(self):
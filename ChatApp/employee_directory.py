@@ -0,0 +1,86 @@
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+class EmployeeDirectory:
+    """
+    Read-through cache of ot_employees keyed by employee_id.
+
+    The whole table is loaded in one query and reloaded once `ttl` seconds
+    have passed; ids not in the snapshot fall back to a single-row lookup
+    and are cached (found or not) until the next reload.
+    """
+
+    def __init__(self, db, ttl: Optional[float] = None):
+        self._db = db
+        self.ttl = float(ttl if ttl is not None else os.getenv('EMPLOYEE_CACHE_TTL', '300'))
+        self._lock = threading.Lock()
+        self._by_id: Dict[str, Dict[str, Any]] = {}
+        self._missing = set()
+        self._loaded_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def refresh(self) -> None:
+        """Reload the full directory in one query"""
+        rows = self._db.get_all_employees()
+        by_id = {str(row['employee_id']): row for row in rows}
+        with self._lock:
+            self._by_id = by_id
+            self._missing = set()
+            self._loaded_at = time.monotonic()
+            self.reloads += 1
+
+    def _ensure_fresh(self) -> None:
+        if time.monotonic() - self._loaded_at > self.ttl:
+            try:
+                self.refresh()
+            except Exception:
+                # Keep serving the previous snapshot if the reload fails
+                with self._lock:
+                    self._loaded_at = time.monotonic()
+
+    def get(self, employee_id) -> Optional[Dict[str, Any]]:
+        if employee_id is None:
+            return None
+        self._ensure_fresh()
+        key = str(employee_id)
+        with self._lock:
+            row = self._by_id.get(key)
+            if row is not None or key in self._missing:
+                self.hits += 1
+                return row
+            self.misses += 1
+        row = self._db.get_employee_by_id(key)
+        with self._lock:
+            if row is not None:
+                self._by_id[key] = row
+            else:
+                self._missing.add(key)
+        return row
+
+    def name(self, employee_id, default=None):
+        row = self.get(employee_id)
+        return row.get('name') if row and row.get('name') else default
+
+    def role(self, employee_id, default=None):
+        row = self.get(employee_id)
+        return row.get('role') if row and row.get('role') else default
+
+    def invalidate(self) -> None:
+        """Force a reload on next access"""
+        with self._lock:
+            self._loaded_at = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'size': len(self._by_id),
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'age_seconds': round(time.monotonic() - self._loaded_at, 1) if self._loaded_at else None,
+            }
@@ -0,0 +1,221 @@
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+import pymysql
+
+import async_mode
+
+try:
+    import gevent.lock
+    import gevent.socket
+except ImportError:  # threads only
+    gevent = None
+
+
+class PoolTimeout(Exception):
+    """No connection became free within the checkout timeout"""
+
+
+def make_pymysql_cooperative() -> bool:
+    """
+    Route PyMySQL's network I/O through gevent sockets without patching the
+    rest of the process, so a query in one greenlet lets the others run.
+    Returns False when gevent isn't installed.
+    """
+    if gevent is None:
+        return False
+    pymysql.connections.socket = gevent.socket
+    return True
+
+
+class _PooledConnection:
+    """Checked-out connection; `close()` hands it back to the pool"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+        self.broken = False
+
+    def cursor(self, *args):
+        return self._conn.cursor(*args)
+
+    def commit(self):
+        try:
+            self._conn.commit()
+        except pymysql.err.OperationalError:
+            self.broken = True
+            raise
+
+    def rollback(self):
+        try:
+            self._conn.rollback()
+        except pymysql.err.OperationalError:
+            self.broken = True
+            raise
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool._checkin(conn, discard=self.broken)
+
+
+class GreenConnectionPool:
+    """
+    Bounded PyMySQL pool for gevent workers (plain threads work too).
+
+    At most `maxsize` connections exist. A checkout waits on a gevent
+    semaphore, so it yields to other greenlets instead of blocking the hub,
+    and raises PoolTimeout after `timeout` seconds. Connections are not
+    pinged on every checkout. Only one idle for longer than `idle_check`
+    seconds is pinged first, and one older than `max_lifetime` is replaced.
+    Connections that failed with an OperationalError are discarded when
+    returned. Wait times are kept for `stats()`.
+    """
+
+    def __init__(self, maxsize: int = 50, timeout: float = 10.0, idle_check: float = 30.0,
+                 max_lifetime: float = 3600.0, setsession: Optional[List[str]] = None,
+                 green: Optional[bool] = None, **connect_kwargs):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.idle_check = idle_check
+        self.max_lifetime = max_lifetime
+        self._setsession = setsession or []
+        self._connect_kwargs = connect_kwargs
+        if green is None:
+            # gevent primitives only help when SocketIO runs on gevent; under
+            # eventlet app.py always monkey-patches, which makes the thread
+            # semaphore and PyMySQL's sockets green
+            green = gevent is not None and async_mode.ASYNC_MODE.startswith('gevent')
+        self.green = green
+        if self.green:
+            make_pymysql_cooperative()
+            self._slots = gevent.lock.BoundedSemaphore(maxsize)
+        else:
+            self._slots = threading.BoundedSemaphore(maxsize)
+        self._lock = threading.Lock()
+        # (connection, created_at, returned_at); LIFO keeps the warm ones busy
+        self._idle = deque()
+        self._in_use = 0
+        self.created = 0
+        self.discarded = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.health_checks = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self._created_at: Dict[int, float] = {}
+
+    def _connect(self):
+        conn = pymysql.connect(**self._connect_kwargs)
+        try:
+            with conn.cursor() as cursor:
+                for statement in self._setsession:
+                    cursor.execute(statement)
+        except Exception:
+            conn.close()
+            raise
+        with self._lock:
+            self.created += 1
+            self._created_at[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn) -> None:
+        with self._lock:
+            self.discarded += 1
+            self._created_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _acquire_slot(self) -> None:
+        if self._slots.acquire(blocking=False):
+            with self._lock:
+                self.checkouts += 1
+            return
+        started = time.monotonic()
+        acquired = self._slots.acquire(timeout=self.timeout)
+        waited = time.monotonic() - started
+        with self._lock:
+            self.waits += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+            if not acquired:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+        if not acquired:
+            raise PoolTimeout(f"No database connection free after {self.timeout}s")
+
+    def connection(self) -> _PooledConnection:
+        self._acquire_slot()
+        try:
+            conn = self._take_idle()
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use += 1
+        return _PooledConnection(self, conn)
+
+    def _take_idle(self):
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn, returned_at = self._idle.pop()
+                created_at = self._created_at.get(id(conn), now)
+            if now - created_at > self.max_lifetime:
+                self._discard(conn)
+                continue
+            if now - returned_at > self.idle_check:
+                with self._lock:
+                    self.health_checks += 1
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    self._discard(conn)
+                    continue
+            return conn
+
+    def _checkin(self, conn, discard: bool = False) -> None:
+        try:
+            if discard or not conn.open:
+                self._discard(conn)
+            else:
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def close(self) -> None:
+        """Close idle connections (checked-out ones close on return)"""
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'kind': 'green' if self.green else 'threaded',
+                'maxsize': self.maxsize,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'created': self.created,
+                'discarded': self.discarded,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'health_checks': self.health_checks,
+                'wait_ms_avg': round(1000 * self.wait_time_total / self.waits, 2) if self.waits else 0.0,
+                'wait_ms_max': round(1000 * self.wait_time_max, 2),
+            }
@@ -0,0 +1,335 @@
+"""Maintenance commands for the chat database.
+
+Usage:
+    python manage.py migrate [--schema-only] [--batch-size N]
+    python manage.py explain
+    python manage.py backfill-summary
+    python manage.py backfill-conversation-key [--batch-size N]
+    python manage.py backfill-media-index [--batch-size N]
+    python manage.py media-report
+    DB_POOL=green python manage.py bench-pool [--clients N] [--queries N] [--think-ms N]
+    python manage.py bench-roundtrips [--messages N] [--members N]
+    python manage.py rebuild-search-index
+    python manage.py bench-search [--messages N] [--batch-size N] [--keep]
+"""
+import argparse
+import os
+import random
+import threading
+import time
+
+import pymysql
+
+from blob_store import BlobStore
+from database import Database
+import search
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def backfill_summary(db, args):
+    """Rebuild conversation_summary from existing messages"""
+    db.backfill_conversation_summary()
+    print("conversation_summary rebuilt")
+
+
+def migrate(db, args):
+    """Apply pending schema migrations, then backfill existing rows"""
+    print(f"schema version {db.migrate()}")
+    if args.schema_only:
+        return
+    for step, result in db.run_backfills(args.batch_size).items():
+        print(f"{step}: {result}")
+
+
+# Representative hot queries and the index each one should use
+EXPLAIN_QUERIES = [
+    ('direct unread counts',
+     "SELECT sender_id, COUNT(*) FROM messages WHERE receiver_id = %s AND is_read = FALSE "
+     "AND group_id IS NULL GROUP BY sender_id", ('0',), 'idx_messages_unread'),
+    ('direct history',
+     "SELECT id FROM messages WHERE conversation_key = %s ORDER BY id DESC LIMIT 50", ('0:1',),
+     'idx_messages_conversation'),
+    ('group history',
+     "SELECT id FROM messages WHERE group_id = %s AND receiver_id IS NULL ORDER BY id DESC LIMIT 50", (0,),
+     'idx_messages_group'),
+    ('group last activity',
+     "SELECT MAX(created_at) FROM messages WHERE group_id = %s", (0,), 'idx_messages_group'),
+]
+
+
+def explain_plans(cursor):
+    """(label, expected index, EXPLAIN row) for each of EXPLAIN_QUERIES"""
+    plans = []
+    for label, sql, params, expected in EXPLAIN_QUERIES:
+        cursor.execute("EXPLAIN " + sql, params)
+        plans.append((label, expected, cursor.fetchone()))
+    return plans
+
+
+def explain(db, args):
+    """Check that the hot queries use their indexes; exits non-zero if not"""
+    misses = 0
+    with db.chat_conn.cursor(pymysql.cursors.DictCursor) as cursor:
+        for label, expected, row in explain_plans(cursor):
+            ok = row.get('key') == expected
+            misses += not ok
+            print(f"{'ok  ' if ok else 'MISS'} {label:<22} key={row.get('key')} (want {expected}) "
+                  f"type={row.get('type')} rows={row.get('rows')} extra={row.get('Extra')}")
+    if misses:
+        raise SystemExit(1)
+
+
+def backfill_conversation_key(db, args):
+    """Populate messages.conversation_key for older rows in batches"""
+    updated = db.backfill_conversation_keys(args.batch_size)
+    print(f"conversation_key set on {updated} messages")
+
+
+def backfill_media_index(db, args):
+    """Index media of existing messages into message_media"""
+    indexed = db.backfill_message_media(args.batch_size)
+    print(f"indexed media for {indexed} messages")
+
+
+def media_report(db, args):
+    """List messages whose indexed media file cannot be found on disk"""
+    stores = {
+        'images': BlobStore(os.getenv('UPLOAD_FOLDER') or os.path.join(APP_DIR, 'static', 'uploads', 'images')),
+        'files': BlobStore(os.getenv('FILES_UPLOAD_FOLDER') or os.path.join(APP_DIR, 'static', 'uploads', 'files')),
+    }
+    checked = missing = 0
+    for row in db.iter_message_media():
+        checked += 1
+        if not stores[row['kind']].locate(row['blob_name']):
+            missing += 1
+            print(f"missing message_id={row['message_id']} kind={row['kind']} blob={row['blob_name']}")
+    print(f"{missing} of {checked} indexed media files missing")
+
+
+def bench_pool(db, args):
+    """Simulate many concurrent sockets issuing short queries through the pool"""
+    green = db.pool_stats().get('kind') == 'green'
+    latencies = []
+    errors = []
+
+    def client():
+        for _ in range(args.queries):
+            started = time.monotonic()
+            try:
+                with db.chat_conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                    cursor.fetchall()
+            except Exception as e:
+                errors.append(e)
+            latencies.append(time.monotonic() - started)
+            if args.think_ms:
+                sleep(args.think_ms / 1000.0)
+
+    if green:
+        import gevent
+        sleep = gevent.sleep
+        started = time.monotonic()
+        gevent.joinall([gevent.spawn(client) for _ in range(args.clients)])
+    else:
+        sleep = time.sleep
+        workers = [threading.Thread(target=client) for _ in range(args.clients)]
+        started = time.monotonic()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    pct = lambda p: 1000 * latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+    print(f"{'greenlets' if green else 'threads'}: {args.clients} clients x {args.queries} queries "
+          f"in {elapsed:.2f}s ({len(latencies) / elapsed:.0f} q/s), {len(errors)} errors")
+    print(f"latency ms p50={pct(0.50):.1f} p95={pct(0.95):.1f} p99={pct(0.99):.1f}")
+    for key, value in db.pool_stats().items():
+        print(f"  {key}: {value}")
+
+
+def _server_round_trips(db):
+    """Statements + admin commands (COM_PING) the server has handled so far"""
+    with db.chat_conn.cursor() as cursor:
+        cursor.execute("SHOW GLOBAL STATUS WHERE Variable_name IN ('Questions', 'Com_admin_commands')")
+        return sum(int(value) for _, value in cursor.fetchall())
+
+
+def _seed_bench_group(db, users):
+    """Scratch group for bench-roundtrips; returns its id"""
+    with db.session():
+        return db.create_group(f"bench-roundtrips-{os.getpid()}", users[0], users[1:])
+
+
+def _drop_bench_rows(db, group_id, users, message_ids):
+    placeholders = ', '.join(['%s'] * len(users))
+    with db.chat_conn.cursor() as cursor:
+        for offset in range(0, len(message_ids), 500):
+            batch = message_ids[offset:offset + 500]
+            cursor.execute(f"DELETE FROM messages WHERE id IN ({', '.join(['%s'] * len(batch))})", batch)
+        cursor.execute(f"DELETE FROM conversation_summary WHERE user_id IN ({placeholders})", users)
+        cursor.execute("DELETE FROM group_read_pointer WHERE group_id = %s", (group_id,))
+        cursor.execute("DELETE FROM `group_members` WHERE group_id = %s", (group_id,))
+        cursor.execute("DELETE FROM `groups` WHERE id = %s", (group_id,))
+
+
+def _send_direct(db, sender_id, receiver_id, n):
+    """Database side of the send_message handler, one unit of work"""
+    with db.session():
+        message_id = db.save_message(sender_id, receiver_id, f"bench message {n}")
+        db.employees.get(sender_id)
+        db.unread_ledger.snapshot(receiver_id)
+        db.unread_ledger.snapshot(sender_id)
+    return message_id
+
+
+def _send_group(db, sender_id, group_id, n):
+    """Database side of the send_group_message handler, one unit of work"""
+    with db.session():
+        message_id = db.save_group_message(sender_id, group_id, f"bench group message {n}")
+        db.employees.get(sender_id)
+        for uid in db.memberships.members(group_id):
+            if db.unread_ledger.is_seeded(uid):
+                db.unread_ledger.snapshot(uid)
+    return message_id
+
+
+def bench_roundtrips(db, args):
+    """Server round trips per sent direct/group message, with and without ping-on-checkout"""
+    prefix = f"rt{os.getpid() % 100000}-"
+    users = [f"{prefix}{i}" for i in range(max(2, args.members))]
+    group_id = _seed_bench_group(db, users)
+    message_ids = []
+    results = {}
+    try:
+        for ping in (1, 0):
+            os.environ['DB_POOL_PING'] = str(ping)
+            bench_db = Database()
+            for uid in users:
+                bench_db.unread_ledger.seed(uid)  # connected members, as after login
+            # Warm the pool and the employee/membership caches like a running worker
+            message_ids.append(_send_direct(bench_db, users[0], users[1], 0))
+            message_ids.append(_send_group(bench_db, users[0], group_id, 0))
+            for label, send, peer in (('direct', _send_direct, users[1]), ('group', _send_group, group_id)):
+                before = _server_round_trips(bench_db)
+                for n in range(args.messages):
+                    message_ids.append(send(bench_db, users[n % len(users)], peer, n))
+                # The status reads themselves add two statements, spread over all messages
+                results[(ping, label)] = (_server_round_trips(bench_db) - before) / args.messages
+    finally:
+        _drop_bench_rows(db, group_id, users, [m for m in message_ids if m])
+    print(f"round trips per sent message (incl. commit), {len(users)}-member group:")
+    for label in ('direct', 'group'):
+        print(f"  {label:<6} ping on checkout: {results[(1, label)]:.1f}   no ping: {results[(0, label)]:.1f}")
+    print("(server-wide counters: run against an otherwise idle database)")
+
+
+def rebuild_search_index(db, args):
+    """Drop and recreate the messages full-text index"""
+    with db.chat_conn.cursor() as cursor:
+        cursor.execute("ALTER TABLE messages DROP INDEX ft_messages_text, "
+                       "ADD FULLTEXT INDEX ft_messages_text (content, filename)")
+    print("ft_messages_text rebuilt")
+
+
+_BENCH_WORDS = (
+    "invoice report meeting deploy release budget client server backup design review "
+    "schedule payroll contract ticket sprint database network laptop printer travel "
+    "hello thanks please today tomorrow update status approve reject urgent weekly"
+).split()
+
+
+def bench_search(db, args):
+    """Load a synthetic corpus into a scratch table and time full-text vs LIKE search"""
+    rng = random.Random(42)
+    table = 'messages_search_bench'
+    with db.chat_conn.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        cursor.execute(f"""CREATE TABLE {table} (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            conversation_key VARCHAR(64) NOT NULL,
+            content TEXT NOT NULL,
+            filename VARCHAR(255) NULL,
+            KEY idx_bench_conversation (conversation_key, id)
+        )""")
+    started = time.monotonic()
+    for offset in range(0, args.messages, args.batch_size):
+        rows = [
+            (f"u{rng.randrange(200)}:u{rng.randrange(200, 400)}",
+             ' '.join(rng.choice(_BENCH_WORDS) for _ in range(rng.randint(3, 25))),
+             None)
+            for _ in range(min(args.batch_size, args.messages - offset))
+        ]
+        with db.chat_conn.cursor() as cursor:
+            cursor.executemany(f"INSERT INTO {table} (conversation_key, content, filename) VALUES (%s, %s, %s)", rows)
+    print(f"loaded {args.messages} messages in {time.monotonic() - started:.1f}s")
+    started = time.monotonic()
+    with db.chat_conn.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {table} ADD FULLTEXT INDEX ft_bench_text (content, filename)")
+    print(f"built full-text index in {time.monotonic() - started:.1f}s")
+
+    queries = [('single word', 'invoice'), ('prefix', 'rep'), ('two words', 'urgent payroll')]
+    for label, query in queries:
+        tokens = search.tokenize(query)
+        boolean = search.boolean_query(tokens)
+        for mode in ('fulltext', 'like'):
+            started = time.monotonic()
+            with db.chat_conn.cursor() as cursor:
+                if mode == 'fulltext':
+                    cursor.execute(
+                        f"SELECT id, MATCH(content, filename) AGAINST (%s IN BOOLEAN MODE) AS score FROM {table} "
+                        f"WHERE MATCH(content, filename) AGAINST (%s IN BOOLEAN MODE) "
+                        f"ORDER BY score DESC, id DESC LIMIT 50", (boolean, boolean))
+                else:
+                    like = f"%{search.escape_like(query)}%"
+                    cursor.execute(
+                        f"SELECT id FROM {table} WHERE content LIKE %s OR filename LIKE %s "
+                        f"ORDER BY id DESC LIMIT 50", (like, like))
+                hits = len(cursor.fetchall())
+            print(f"{label:<12} {mode:<9} {1000 * (time.monotonic() - started):8.1f} ms  ({hits} rows)")
+    if not args.keep:
+        with db.chat_conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE {table}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Chat database maintenance')
+    sub = parser.add_subparsers(dest='command', required=True)
+    migrate_cmd = sub.add_parser('migrate', help=migrate.__doc__)
+    migrate_cmd.add_argument('--schema-only', action='store_true', help='skip row backfills')
+    migrate_cmd.add_argument('--batch-size', type=int, default=5000)
+    migrate_cmd.set_defaults(func=migrate)
+    sub.add_parser('explain', help=explain.__doc__).set_defaults(func=explain)
+    sub.add_parser('backfill-summary', help=backfill_summary.__doc__).set_defaults(func=backfill_summary)
+    backfill_key = sub.add_parser('backfill-conversation-key', help=backfill_conversation_key.__doc__)
+    backfill_key.add_argument('--batch-size', type=int, default=5000)
+    backfill_key.set_defaults(func=backfill_conversation_key)
+    backfill_media = sub.add_parser('backfill-media-index', help=backfill_media_index.__doc__)
+    backfill_media.add_argument('--batch-size', type=int, default=5000)
+    backfill_media.set_defaults(func=backfill_media_index)
+    sub.add_parser('media-report', help=media_report.__doc__).set_defaults(func=media_report)
+    bench = sub.add_parser('bench-pool', help=bench_pool.__doc__)
+    bench.add_argument('--clients', type=int, default=300)
+    bench.add_argument('--queries', type=int, default=20)
+    bench.add_argument('--think-ms', type=int, default=5)
+    bench.set_defaults(func=bench_pool)
+    roundtrips = sub.add_parser('bench-roundtrips', help=bench_roundtrips.__doc__)
+    roundtrips.add_argument('--messages', type=int, default=200)
+    roundtrips.add_argument('--members', type=int, default=20)
+    roundtrips.set_defaults(func=bench_roundtrips)
+    sub.add_parser('rebuild-search-index', help=rebuild_search_index.__doc__).set_defaults(func=rebuild_search_index)
+    bench_fts = sub.add_parser('bench-search', help=bench_search.__doc__)
+    bench_fts.add_argument('--messages', type=int, default=1000000)
+    bench_fts.add_argument('--batch-size', type=int, default=5000)
+    bench_fts.add_argument('--keep', action='store_true', help='keep the scratch table')
+    bench_fts.set_defaults(func=bench_search)
+    args = parser.parse_args(argv)
+    db = Database()
+    db.create_tables()
+    args.func(db, args)
+
+
+if __name__ == '__main__':
+    main()
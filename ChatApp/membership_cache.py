@@ -0,0 +1,102 @@
+import threading
+from typing import Dict, FrozenSet
+
+
+class GroupMembershipCache:
+    """
+    group -> members and user -> groups maps in front of `group_members`.
+
+    Entries are filled on first use with membership-only queries (no employee
+    join) and dropped by the Database methods that change membership. With
+    an InvalidationBus attached, those drops are repeated on other workers.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._bus = None
+        self._lock = threading.Lock()
+        self._members: Dict[str, FrozenSet[str]] = {}
+        self._groups: Dict[str, FrozenSet[str]] = {}
+        # Bumped on every invalidation so a lookup that raced with a
+        # membership change doesn't store its stale result
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _gid(group_id) -> str:
+        return str(group_id)
+
+    def members(self, group_id) -> FrozenSet[str]:
+        """user_ids in a group"""
+        key = self._gid(group_id)
+        with self._lock:
+            cached = self._members.get(key)
+            if cached is not None:
+                self.hits += 1
+                return cached
+            self.misses += 1
+            generation = self._generation
+        members = frozenset(str(uid) for uid in self._db.get_group_member_ids(group_id))
+        with self._lock:
+            if generation == self._generation:
+                self._members[key] = members
+        return members
+
+    def groups(self, user_id) -> FrozenSet[str]:
+        """group ids (as strings) a user belongs to"""
+        key = str(user_id)
+        with self._lock:
+            cached = self._groups.get(key)
+            if cached is not None:
+                self.hits += 1
+                return cached
+            self.misses += 1
+            generation = self._generation
+        groups = frozenset(str(gid) for gid in self._db.get_user_group_ids(user_id))
+        with self._lock:
+            if generation == self._generation:
+                self._groups[key] = groups
+        return groups
+
+    def attach_bus(self, bus) -> None:
+        self._bus = bus
+        bus.subscribe('group_members', self._drop_group)
+        bus.subscribe('user_groups', self._drop_user)
+        # Drops may have been missed while the bus was disconnected
+        bus.on_resubscribe(self.clear)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._members.clear()
+            self._groups.clear()
+
+    def _drop_group(self, group_id) -> None:
+        with self._lock:
+            self._generation += 1
+            self._members.pop(self._gid(group_id), None)
+
+    def _drop_user(self, user_id) -> None:
+        with self._lock:
+            self._generation += 1
+            self._groups.pop(str(user_id), None)
+
+    def invalidate_group(self, group_id) -> None:
+        self._drop_group(group_id)
+        if self._bus is not None:
+            self._bus.publish('group_members', group_id)
+
+    def invalidate_user(self, user_id) -> None:
+        self._drop_user(user_id)
+        if self._bus is not None:
+            self._bus.publish('user_groups', user_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'groups_cached': len(self._members),
+                'users_cached': len(self._groups),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
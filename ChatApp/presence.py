@@ -0,0 +1,197 @@
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+
+class PresenceService:
+    """
+    In-memory online state with write-behind persistence.
+
+    Sockets are reference-counted per user: only the first `connect` and the
+    last `disconnect` of a user change their state, so closing one of several
+    tabs/devices is invisible to everyone else. With a `shared` counter
+    (cluster.SharedPresence) the count spans all workers, and whether a user
+    is online is re-checked against it when their change is flushed.
+
+    State changes are only recorded here. A background loop (`run`) wakes
+    every `flush_interval` seconds and settles users whose last change is at
+    least `debounce` seconds old, so a disconnect followed by a reconnect
+    inside the window never reaches the database or other clients. Settled changes are written with one multi-row upsert
+    (`db.update_user_statuses`) and announced as a single diff through
+    `publish({'online': [...], 'offline': [...]})`.
+    """
+
+    def __init__(self, db, publish: Callable[[Dict[str, List[str]]], None],
+                 debounce: float = 3.0, flush_interval: float = 1.0,
+                 sleep: Callable[[float], None] = time.sleep, shared=None):
+        self._db = db
+        self._shared = shared
+        self._publish = publish
+        self.debounce = debounce
+        self.flush_interval = flush_interval
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        # user_id -> state last written/broadcast
+        self._published: Dict[str, bool] = {}
+        # user_id -> (wanted state, monotonic time of the last change)
+        self._pending: Dict[str, Tuple[bool, float]] = {}
+        # user_id -> socket ids currently connected to this worker
+        self._sockets: Dict[str, Set[str]] = {}
+        self._running = False
+        self.flushes = 0
+        self.writes = 0
+        self.coalesced = 0
+
+    def connect(self, user_id: str, sid: str) -> int:
+        """Register a socket; returns the user's new refcount"""
+        with self._lock:
+            sockets = self._sockets.setdefault(user_id, set())
+            if sid in sockets:
+                return len(sockets)
+            sockets.add(sid)
+            count = len(sockets)
+            if count == 1 and self._shared is None:
+                self._record(user_id, True)
+        if self._shared is not None:
+            self._shared_delta(user_id, 1)
+        return count
+
+    def disconnect(self, user_id: str, sid: str) -> int:
+        """Unregister a socket; returns the user's remaining refcount"""
+        with self._lock:
+            sockets = self._sockets.get(user_id)
+            if not sockets or sid not in sockets:
+                return len(sockets or ())
+            sockets.discard(sid)
+            count = len(sockets)
+            if not count:
+                del self._sockets[user_id]
+                if self._shared is None:
+                    self._record(user_id, False)
+        if self._shared is not None:
+            self._shared_delta(user_id, -1)
+        return count
+
+    def _shared_delta(self, user_id: str, delta: int) -> None:
+        try:
+            total = self._shared.incr(user_id, delta)
+        except Exception:
+            # Shared store unavailable: fall back to this worker's view
+            total = self.refcount(user_id)
+        if (delta > 0 and total == 1) or (delta < 0 and total == 0):
+            self.set_online(user_id, total > 0)
+
+    def refcount(self, user_id: str) -> int:
+        with self._lock:
+            return len(self._sockets.get(user_id, ()))
+
+    def set_online(self, user_id: str, is_online: bool) -> None:
+        """Record a state change directly, bypassing the socket refcount"""
+        with self._lock:
+            self._record(user_id, is_online)
+
+    def _record(self, user_id: str, is_online: bool) -> None:
+        # Caller holds self._lock
+        if user_id in self._pending:
+            self.coalesced += 1
+        self._pending[user_id] = (is_online, time.monotonic())
+
+    def is_online(self, user_id: str) -> Optional[bool]:
+        """Latest known state for a user, None if this worker hasn't seen them"""
+        if self._shared is not None:
+            try:
+                return self._shared.count(user_id) > 0
+            except Exception:
+                pass
+        with self._lock:
+            pending = self._pending.get(user_id)
+            if pending is not None:
+                return pending[0]
+            return self._published.get(user_id)
+
+    def online_users(self) -> List[str]:
+        with self._lock:
+            online = {uid for uid, state in self._published.items() if state}
+            for uid, (state, _) in self._pending.items():
+                if state:
+                    online.add(uid)
+                else:
+                    online.discard(uid)
+        return sorted(online)
+
+    def _take_settled(self, force: bool = False) -> List[Tuple[str, bool]]:
+        cutoff = time.monotonic() - self.debounce
+        changes = []
+        with self._lock:
+            for user_id, (state, changed_at) in list(self._pending.items()):
+                if not force and changed_at > cutoff:
+                    continue
+                del self._pending[user_id]
+                if self._published.get(user_id) != state:
+                    changes.append((user_id, state))
+        return changes
+
+    def flush(self, force: bool = False) -> int:
+        """Persist and broadcast settled changes; returns how many were written"""
+        changes = self._take_settled(force)
+        if self._shared is not None and changes:
+            # Another worker may have seen the user come back within the window
+            try:
+                changes = [(uid, self._shared.count(uid) > 0) for uid, _ in changes]
+                with self._lock:
+                    changes = [(uid, state) for uid, state in changes if self._published.get(uid) != state]
+            except Exception:
+                pass
+        if not changes:
+            return 0
+        try:
+            self._db.update_user_statuses(changes)
+        except Exception:
+            # Put them back (unless superseded) so the next tick retries
+            with self._lock:
+                for user_id, state in changes:
+                    self._pending.setdefault(user_id, (state, 0.0))
+            raise
+        with self._lock:
+            for user_id, state in changes:
+                self._published[user_id] = state
+            self.flushes += 1
+            self.writes += len(changes)
+        self._publish({
+            'online': [uid for uid, state in changes if state],
+            'offline': [uid for uid, state in changes if not state],
+        })
+        return len(changes)
+
+    def run(self) -> None:
+        """Flush loop; start with socketio.start_background_task"""
+        self._running = True
+        while self._running:
+            self._sleep(self.flush_interval)
+            if self._shared is not None:
+                try:
+                    self._shared.heartbeat()
+                    for user_id in self._shared.reap():
+                        self.set_online(user_id, False)
+                except Exception:
+                    pass
+            try:
+                self.flush()
+            except Exception:
+                pass  # retried on the next tick
+
+    def stop(self) -> None:
+        self._running = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'online': sum(1 for state in self._published.values() if state),
+                'connected_users': len(self._sockets),
+                'sockets': sum(len(s) for s in self._sockets.values()),
+                'multi_socket_users': sum(1 for s in self._sockets.values() if len(s) > 1),
+                'pending': len(self._pending),
+                'flushes': self.flushes,
+                'writes': self.writes,
+                'coalesced': self.coalesced,
+            }
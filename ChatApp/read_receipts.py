@@ -0,0 +1,196 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ReadReceiptBatcher:
+    """
+    Coalesces "read up to N" receipts for direct conversations.
+
+    `submit(reader, sender, up_to_id)` only records the highest message id per
+    (reader, sender) pair. A background loop (`run`) flushes every `window`
+    seconds. For each pair it issues one UPDATE (`db.mark_direct_read_up_to`)
+    and calls `publish_read(reader, sender, up_to_id)` once. After that it
+    calls `publish_counts(user_id)` once per affected user, however many
+    receipts arrived in the window.
+    """
+
+    def __init__(self, db, publish_read: Callable[[str, str, int], None],
+                 publish_counts: Callable[[str], None], window: float = 0.25,
+                 sleep: Callable[[float], None] = time.sleep):
+        self._db = db
+        self._publish_read = publish_read
+        self._publish_counts = publish_counts
+        self.window = window
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        # (reader_id, sender_id) -> highest message id reported read
+        self._pending: Dict[Tuple[str, str], int] = {}
+        self._running = False
+        self.received = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.rows_marked = 0
+
+    def submit(self, reader_id: str, sender_id: str, up_to_id: int) -> None:
+        key = (str(reader_id), str(sender_id))
+        with self._lock:
+            self.received += 1
+            current = self._pending.get(key)
+            if current is not None:
+                self.coalesced += 1
+                if current >= up_to_id:
+                    return
+            self._pending[key] = up_to_id
+
+    def _take(self) -> List[Tuple[Tuple[str, str], int]]:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return list(pending.items())
+
+    def flush(self) -> int:
+        """Apply and announce pending receipts; returns rows marked read"""
+        batch = self._take()
+        if not batch:
+            return 0
+        marked = 0
+        touched = set()
+        for (reader_id, sender_id), up_to_id in batch:
+            try:
+                with self._db.session():
+                    changed = self._db.mark_direct_read_up_to(reader_id, sender_id, up_to_id)
+            except Exception:
+                logger.warning("Marking %s's receipt for %s failed; retrying next tick",
+                               reader_id, sender_id, exc_info=True)
+                # Keep the receipt (unless superseded) for the next tick
+                with self._lock:
+                    if self._pending.get((reader_id, sender_id), 0) < up_to_id:
+                        self._pending[(reader_id, sender_id)] = up_to_id
+                continue
+            marked += changed
+            # Announce even when nothing flipped: another tab may have marked
+            # the rows already, but the sender's view may still be behind
+            self._publish_read(reader_id, sender_id, up_to_id)
+            if changed:
+                touched.update((reader_id, sender_id))
+        for user_id in touched:
+            self._publish_counts(user_id)
+        with self._lock:
+            self.flushes += 1
+            self.rows_marked += marked
+        return marked
+
+    def run(self) -> None:
+        """Flush loop; start with socketio.start_background_task"""
+        self._running = True
+        while self._running:
+            self._sleep(self.window)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Read receipt flush failed")  # retried on the next tick
+
+    def stop(self) -> None:
+        self._running = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'received': self.received,
+                'coalesced': self.coalesced,
+                'flushes': self.flushes,
+                'rows_marked': self.rows_marked,
+            }
+
+
+class GroupSeenAggregator:
+    """
+    Batches `group_message_seen_update` broadcasts.
+
+    `submit(group_id, user_id, up_to_id)` records that a member's read pointer
+    reached `up_to_id`. Every `window` seconds `run` sends each group with
+    news a single delta, `publish(group_id, updates)`. Here `updates` is a
+    list of {'message_id': N, 'user_ids': [...]}: those members have now
+    seen every message up to N. A room therefore gets at most one broadcast
+    per window, with only the newly seen user ids, and no seen-list query
+    is run. A delta that fails to publish is logged and retried in the next
+    window.
+    """
+
+    def __init__(self, publish: Callable[[str, List[dict]], None], window: float = 1.0,
+                 sleep: Callable[[float], None] = time.sleep):
+        self._publish = publish
+        self.window = window
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        # group_id -> user_id -> highest message id seen within the window
+        self._pending: Dict[str, Dict[str, int]] = {}
+        self._running = False
+        self.received = 0
+        self.coalesced = 0
+        self.broadcasts = 0
+
+    def submit(self, group_id, user_id, up_to_id: int) -> None:
+        with self._lock:
+            self.received += 1
+            members = self._pending.setdefault(str(group_id), {})
+            current = members.get(str(user_id))
+            if current is not None:
+                self.coalesced += 1
+                if current >= up_to_id:
+                    return
+            members[str(user_id)] = up_to_id
+
+    def flush(self) -> int:
+        """Broadcast pending deltas; returns how many groups were notified"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for group_id, members in pending.items():
+            by_message: Dict[int, List[str]] = {}
+            for user_id, up_to_id in members.items():
+                by_message.setdefault(up_to_id, []).append(user_id)
+            updates = [{'message_id': message_id, 'user_ids': sorted(user_ids)}
+                       for message_id, user_ids in sorted(by_message.items())]
+            try:
+                self._publish(group_id, updates)
+            except Exception:
+                logger.warning("Seen delta for group %s failed; retrying next window", group_id, exc_info=True)
+                self._requeue(group_id, members)
+                continue
+            with self._lock:
+                self.broadcasts += 1
+        return len(pending)
+
+    def _requeue(self, group_id: str, members: Dict[str, int]) -> None:
+        """Put an unsent delta back, unless newer pointers arrived meanwhile"""
+        with self._lock:
+            pending = self._pending.setdefault(group_id, {})
+            for user_id, up_to_id in members.items():
+                if pending.get(user_id, 0) < up_to_id:
+                    pending[user_id] = up_to_id
+
+    def run(self) -> None:
+        """Flush loop; start with socketio.start_background_task"""
+        self._running = True
+        while self._running:
+            self._sleep(self.window)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Group seen flush failed")
+
+    def stop(self) -> None:
+        self._running = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending_groups': len(self._pending),
+                'received': self.received,
+                'coalesced': self.coalesced,
+                'broadcasts': self.broadcasts,
+            }
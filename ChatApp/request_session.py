@@ -0,0 +1,50 @@
+from flask import g, jsonify
+from flask.signals import got_request_exception, signals_available
+
+
+def init_request_sessions(app, db):
+    """
+    One pooled connection and one commit per HTTP request.
+
+    The session opens lazily in before_request, so requests that never query
+    (static files) don't check out a connection. It is finished in
+    after_request, before the response goes out: committed on success, so a
+    failed commit turns into a 500 instead of a false success, and rolled
+    back when the view raised or answered with a 5xx. Flask also runs
+    after_request for the 500 it builds from an unhandled exception, so the
+    status check is what keeps a half-done view's writes (and their
+    after-commit emits) from being committed. teardown_request is only a
+    safety net for a session after_request never reached.
+
+    Call this after registering the other after_request hooks so this one
+    runs first (they run in reverse) and the others also see its 500.
+    """
+
+    @app.before_request
+    def open_db_session():
+        g.db_session = db.begin_session()
+
+    if signals_available:
+        def _remember_exception(sender, exception, **extra):
+            g.db_request_exception = exception
+        got_request_exception.connect(_remember_exception, app, weak=False)
+
+    @app.after_request
+    def finish_db_session(resp):
+        exc = g.pop('db_request_exception', None)
+        if exc is None and resp.status_code >= 500:
+            exc = RuntimeError(f"response status {resp.status_code}")
+        try:
+            db.end_session(g.pop('db_session', None), exc)
+        except Exception:
+            app.logger.exception('Failed to commit request DB session')
+            resp = jsonify({'error': 'Internal server error'})
+            resp.status_code = 500
+        return resp
+
+    @app.teardown_request
+    def close_db_session(exc):
+        try:
+            db.end_session(g.pop('db_session', None), exc)
+        except Exception:
+            app.logger.exception('Failed to finish request DB session')
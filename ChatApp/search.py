@@ -0,0 +1,80 @@
+import html
+import re
+from typing import List, Optional, Tuple
+
+# InnoDB's default innodb_ft_min_token_size; shorter words aren't indexed
+MIN_TOKEN_LENGTH = 3
+# Characters with a meaning in MATCH ... IN BOOLEAN MODE
+_BOOLEAN_OPERATORS = re.compile(r'[+\-<>()~*"@]+')
+_WORD = re.compile(r'\w+', re.UNICODE)
+SNIPPET_CONTEXT = 60
+# INFORMATION_SCHEMA.INNODB_FT_DEFAULT_STOPWORD; these are never indexed, so
+# requiring one ('+the*') makes the whole query match nothing
+INNODB_STOPWORDS = frozenset(
+    "a about an are as at be by com de en for from how i in is it la of on or "
+    "that the this to was what when where who will with und www".split()
+)
+# Indexed, but in a typed query they join words rather than ask for a match
+CONNECTIVES = frozenset(('and', 'but', 'nor'))
+
+
+def tokenize(query: str) -> List[str]:
+    """Search words in a user query, lowercased, boolean operators removed"""
+    return [t.lower() for t in _WORD.findall(_BOOLEAN_OPERATORS.sub(' ', query or ''))]
+
+
+def query_terms(tokens: List[str]) -> List[str]:
+    """Tokens the full-text index can match: short words and InnoDB stopwords
+    have no entries, and connectives like 'and' are left out as well"""
+    return [t for t in tokens if len(t) >= MIN_TOKEN_LENGTH
+            and t not in INNODB_STOPWORDS and t not in CONNECTIVES]
+
+
+def boolean_query(tokens: List[str]) -> Optional[str]:
+    """'+word*' for every query term (all required, prefix match); None if there are none"""
+    terms = [f"+{t}*" for t in query_terms(tokens)]
+    return ' '.join(terms) if terms else None
+
+
+def escape_like(value: str) -> str:
+    """Escape LIKE wildcards so user input only matches literally"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def encode_cursor(score, message_id) -> str:
+    return f"{float(score):.6f}:{int(message_id)}"
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[float, int]]:
+    """(score, id) from a cursor string, None if absent or malformed"""
+    if not cursor:
+        return None
+    try:
+        score, message_id = cursor.split(':', 1)
+        return float(score), int(message_id)
+    except ValueError:
+        return None
+
+
+def snippet(text: Optional[str], tokens: List[str], context: int = SNIPPET_CONTEXT) -> Optional[str]:
+    """
+    HTML-escaped excerpt around the first match with every matching word
+    wrapped in <mark>; None when nothing in `text` matches.
+    """
+    if not text or not tokens:
+        return None
+    pattern = re.compile(r'\b(?:' + '|'.join(re.escape(t) for t in tokens) + r')\w*', re.IGNORECASE | re.UNICODE)
+    first = pattern.search(text)
+    if not first:
+        return None
+    start = max(0, first.start() - context)
+    end = min(len(text), first.end() + context)
+    window = text[start:end]
+    parts = []
+    last = 0
+    for match in pattern.finditer(window):
+        parts.append(html.escape(window[last:match.start()]))
+        parts.append(f"<mark>{html.escape(match.group(0))}</mark>")
+        last = match.end()
+    parts.append(html.escape(window[last:]))
+    return ('…' if start > 0 else '') + ''.join(parts) + ('…' if end < len(text) else '')
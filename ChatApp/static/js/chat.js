@@ -50,6 +50,8 @@ document.addEventListener('DOMContentLoaded', () => {
     let replyingTo = null;
     let currentImageData = null;
     let imageGallery = [];
+    // Full image URL -> server-rendered preview (about 1024px) for the viewer
+    const imagePreviewUrls = new Map();
     let currentGroup = null;
     let groupList = [];
     let groupMembers = [];
@@ -255,6 +257,52 @@ document.addEventListener('DOMContentLoaded', () => {
         return data;
     }
 
+    // Attachments are sent as raw chunks through the resumable /uploads
+    // endpoint; the socket event then only carries the upload_id
+    async function uploadAttachment(att) {
+        const file = att.file;
+        const created = await fetchJSON('/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: att.name, size: file.size, mime_type: att.type })
+        });
+        const uploadId = created.upload_id;
+        const chunkSize = created.chunk_size || (1024 * 1024);
+        let offset = created.offset || 0;
+        let failures = 0;
+        while (offset < file.size) {
+            let res;
+            try {
+                res = await fetch(`/uploads/${encodeURIComponent(uploadId)}`, {
+                    method: 'PATCH',
+                    credentials: 'same-origin',
+                    headers: { 'Upload-Offset': String(offset), 'Content-Type': 'application/octet-stream' },
+                    body: file.slice(offset, offset + chunkSize)
+                });
+            } catch (err) {
+                // Network blip: ask the server where to resume
+                if (++failures > 5) throw err;
+                await new Promise(r => setTimeout(r, 500 * failures));
+                const status = await fetchJSON(`/uploads/${encodeURIComponent(uploadId)}`);
+                offset = status.offset || 0;
+                continue;
+            }
+            let data = null;
+            try { data = await res.json(); } catch (_) {}
+            if (res.status === 409 && data && typeof data.offset === 'number') {
+                // Offset mismatch or a chunk still in flight: resume where the server is
+                if (++failures > 5) throw new Error(data.error || 'Upload conflict');
+                await new Promise(r => setTimeout(r, 200 * failures));
+                offset = data.offset;
+                continue;
+            }
+            if (!res.ok) throw new Error((data && data.error) || res.statusText || 'Upload failed');
+            failures = 0;
+            offset = data.offset;
+        }
+        return uploadId;
+    }
+
     // Helper function to safely access DOM elements
     function getElement(selector) {
         const el = document.querySelector(selector);
@@ -614,12 +662,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 // ✅ FIXED: Only mark as read if it's a received message and we're viewing the chat
                 // This triggers the real-time read receipt
                 if (message.receiver_id === currentUser && currentReceiver === message.sender_id) {
-                    // Immediate read receipt for real-time viewing
-                    socket.emit('mark_read', {
-                        message_id: message.id,
-                        receiver_id: currentUser,
-                        sender_id: message.sender_id
-                    });
+                    queueReadReceipt(message.sender_id, message.id);
                 }
             }
             
@@ -724,6 +767,12 @@ document.addEventListener('DOMContentLoaded', () => {
             updateUserStatus(data.user_id, false);
         });
 
+        // Batched presence changes: { online: [ids], offline: [ids] }
+        socket.on('presence_update', (diff) => {
+            (diff && diff.online || []).forEach(id => updateUserStatus(id, true));
+            (diff && diff.offline || []).forEach(id => updateUserStatus(id, false));
+        });
+
         // React to pin changes from server
         socket.on('chat_pin_updated', (evt) => {
             const { target_type, target_id, pin } = evt || {};
@@ -761,10 +810,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 
                 // Mark as seen if it's a received message and we're viewing the group
                 if (message.sender_id !== currentUser) {
-                    socket.emit('mark_group_message_seen', {
-                        message_id: message.id,
-                        group_id: message.group_id
-                    });
+                    queueGroupSeen(message.group_id, message.id);
                 }
             }
             
@@ -794,15 +840,16 @@ document.addEventListener('DOMContentLoaded', () => {
         });
         
         socket.on('group_message_seen_update', (data) => {
-            // Update seen status UI
-            const messageId = data.message_id;
-            const seenUsers = data.seen_users;
-            
-            // Update seen status UI
-            const messageElement = document.querySelector(`[data-message-id="${messageId}"]`);
-            if (messageElement) {
-                messageElement.classList.add('seen');
-            }
+            // Aggregated delta: each update means user_ids have seen everything up to message_id
+            if (!data || String(data.group_id) !== String(currentGroup) || !messagesContainer) return;
+            const upTo = Math.max(0, ...(data.updates || [])
+                .filter(u => (u.user_ids || []).some(id => id !== currentUser))
+                .map(u => Number(u.message_id) || 0));
+            if (!upTo) return;
+            messagesContainer.querySelectorAll('.message.sent[data-message-id]').forEach(el => {
+                const id = Number(el.getAttribute('data-message-id'));
+                if (Number.isFinite(id) && id <= upTo) el.classList.add('seen');
+            });
         });
     }
 
@@ -829,27 +876,34 @@ document.addEventListener('DOMContentLoaded', () => {
             if (previewContainer) {
                 previewContainer.innerHTML = `<div class="attachment-preview loading"><i class="fas fa-image fa-spin"></i><span class="file-name">${currentImageData.name}</span><div class="loading-text">Sending...</div></div>`;
             }
-            messageData.media_url = currentImageData.data;
         }
-        socket.emit('send_message', messageData, (response) => {
-            sending = false;
-            if (response && response.error) {
-                alert('Failed to send message: ' + response.error);
-                if (currentImageData) {
-                    updateImagePreview(currentImageData.data);
-                }
-            } else {
-                if (messageInput) messageInput.value = '';
-                if (currentImageData) {
-                    currentImageData = null;
-                    pendingAttachments = [];
-                    clearAttachmentsPreview();
-                }
-                if (replyingTo) {
-                    cancelReply();
+        const uploaded = currentImageData ? uploadAttachment(currentImageData) : Promise.resolve(null);
+        uploaded.then(uploadId => {
+            if (uploadId) messageData.upload_id = uploadId;
+            socket.emit('send_message', messageData, (response) => {
+                sending = false;
+                if (response && response.error) {
+                    alert('Failed to send message: ' + response.error);
+                    if (currentImageData) {
+                        updateImagePreview(currentImageData);
+                    }
+                } else {
+                    if (messageInput) messageInput.value = '';
+                    if (currentImageData) {
+                        currentImageData = null;
+                        pendingAttachments = [];
+                        clearAttachmentsPreview();
+                    }
+                    if (replyingTo) {
+                        cancelReply();
+                    }
+                    // Sorting removed
                 }
-                // Sorting removed
-            }
+            });
+        }).catch(err => {
+            sending = false;
+            alert('Failed to upload attachment: ' + (err.message || err));
+            if (currentImageData) updateImagePreview(currentImageData);
         });
     }
 
@@ -878,17 +932,22 @@ document.addEventListener('DOMContentLoaded', () => {
                 content: (index === 0 && hasText) ? content : '',
                 filename: att.name || '',
                 type: replyingTo ? 'reply' : (isImage ? 'image' : 'file'),
-                parent_message_id: replyingTo,
-                media_url: att.data
+                parent_message_id: replyingTo
             };
-            socket.emit('send_message', messageData, (response) => {
-                if (response && response.error) {
-                    sending = false;
-                    try { showToast('Error', 'Failed to send one of the attachments'); } catch (_) {}
-                    return;
-                }
-                index++;
-                sendNext();
+            uploadAttachment(att).then(uploadId => {
+                messageData.upload_id = uploadId;
+                socket.emit('send_message', messageData, (response) => {
+                    if (response && response.error) {
+                        sending = false;
+                        try { showToast('Error', 'Failed to send one of the attachments'); } catch (_) {}
+                        return;
+                    }
+                    index++;
+                    sendNext();
+                });
+            }).catch(() => {
+                sending = false;
+                try { showToast('Error', `Failed to upload ${att.name || 'attachment'}`); } catch (_) {}
             });
         };
         sendNext();
@@ -925,16 +984,12 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!validFiles.length) return;
 
         validFiles.forEach(file => {
-            const reader = new FileReader();
-            reader.onload = (event) => {
-                const att = { name: file.name, type: file.type, data: event.target.result };
-                pendingAttachments.push(att);
-                currentImageData = att; // maintain existing single-attachment behavior
-                updateAttachmentsPreview();
-            };
-            reader.onerror = () => { try { showToast('Error', `Failed to read ${file.name}`); } catch (_) {} };
-            reader.readAsDataURL(file);
+            // The File itself is kept and uploaded in chunks on send
+            const att = { name: file.name, type: file.type, file };
+            pendingAttachments.push(att);
+            currentImageData = att; // maintain existing single-attachment behavior
         });
+        updateAttachmentsPreview();
     }
 
     function formatBytes(bytes) {
@@ -1293,10 +1348,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 if (!imageGallery.includes(fullImageUrl)) imageGallery.push(fullImageUrl);
                 let fileName = message.filename || 'Attachment';
                 contentHtml += `<div class="image-message-block">
-                    <div class="message-attachment" data-image-url="${fullImageUrl}">
-                        <i class="fas fa-paperclip"></i>
-                        <span class="file-name">${fileName}</span>
-                    </div>
+                    ${imageAttachmentHtml(message, fullImageUrl, fileName)}
                 </div>`;
             } else {
                 // Non-image forwarded attachment or text
@@ -1332,10 +1384,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 contentHtml += `<div class="image-message-text">${message.content}</div>`;
             }
             contentHtml += `
-                <div class="message-attachment" data-image-url="${fullImageUrl}">
-                    <i class="fas fa-paperclip"></i>
-                    <span class="file-name">${fileName}</span>
-                </div>
+                ${imageAttachmentHtml(message, fullImageUrl, fileName)}
             </div>`;
         } else if (messageType === 'file' && message.media_url) {
             const fullFileUrl = message.media_url.startsWith('/static/') ? message.media_url : `/static/${message.media_url}`;
@@ -1408,12 +1457,8 @@ document.addEventListener('DOMContentLoaded', () => {
     
         // ✅ CRITICAL FIX: Immediately mark received messages as read when viewing the chat
         if (message.receiver_id === currentUser && !message.is_read && currentReceiver === message.sender_id) {
-            // This message is for the current user and they're viewing the chat - mark as read immediately
-            socket.emit('mark_read', {
-                message_id: message.id,
-                receiver_id: currentUser,
-                sender_id: message.sender_id
-            });
+            // This message is for the current user and they're viewing the chat
+            queueReadReceipt(message.sender_id, message.id);
         }
     
         if (message.pinned) {
@@ -1421,6 +1466,57 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // Highest received message id per sender waiting to be reported read
+    const pendingReadReceipts = new Map();
+    let readReceiptTimer = null;
+
+    function queueReadReceipt(senderId, messageId) {
+        const id = Number(messageId);
+        if (!senderId || !Number.isFinite(id)) return;
+        if ((pendingReadReceipts.get(senderId) || 0) < id) pendingReadReceipts.set(senderId, id);
+        if (readReceiptTimer) return;
+        readReceiptTimer = setTimeout(() => {
+            readReceiptTimer = null;
+            const receipts = Array.from(pendingReadReceipts, ([sender_id, up_to_id]) => ({ sender_id, up_to_id }));
+            pendingReadReceipts.clear();
+            if (receipts.length && socket) socket.emit('mark_read_batch', { receipts });
+        }, 100);
+    }
+
+    // Group read pointers only move forward, so one marker per group carries a whole burst
+    const pendingGroupSeen = new Map();
+    let groupSeenTimer = null;
+
+    function queueGroupSeen(groupId, messageId) {
+        const id = Number(messageId);
+        if (groupId == null || !Number.isFinite(id)) return;
+        const key = String(groupId);
+        if ((pendingGroupSeen.get(key) || 0) < id) pendingGroupSeen.set(key, id);
+        if (groupSeenTimer) return;
+        groupSeenTimer = setTimeout(() => {
+            groupSeenTimer = null;
+            pendingGroupSeen.forEach((message_id, group_id) => {
+                if (socket) socket.emit('mark_group_message_seen', { message_id, group_id });
+            });
+            pendingGroupSeen.clear();
+        }, 100);
+    }
+
+    // Bubble for an image attachment: the small thumbnail when the server has
+    // one, the file name otherwise. The original only loads when zooming in.
+    function imageAttachmentHtml(message, fullImageUrl, fileName) {
+        if (message.preview_url) imagePreviewUrls.set(fullImageUrl, message.preview_url);
+        if (message.thumb_url) {
+            return `<div class="message-attachment" data-image-url="${fullImageUrl}">
+                <img class="message-thumb" src="${message.thumb_url}" alt="${escapeHtml(fileName)}" loading="lazy" decoding="async">
+            </div>`;
+        }
+        return `<div class="message-attachment" data-image-url="${fullImageUrl}">
+                <i class="fas fa-paperclip"></i>
+                <span class="file-name">${fileName}</span>
+            </div>`;
+    }
+
     function loadMessages(senderId, receiverId) {
         if (!messagesContainer) return;
         // Increment request id so stale responses are ignored
@@ -1432,19 +1528,9 @@ document.addEventListener('DOMContentLoaded', () => {
                 if (!Array.isArray(messages)) return;
                 // Ensure container is clean before render
                 messagesContainer.innerHTML = '';
-                messages.reverse().forEach(message => {
-                    appendMessage(message);
-                    
-                    // ✅ FIXED: Only mark as read if it's a received message that's unread AND we're viewing the chat
-                    if (message.receiver_id === currentUser && !message.is_read && currentReceiver === message.sender_id) {
-                        // This ensures read receipts are sent when loading historical messages
-                        socket.emit('mark_read', {
-                            message_id: message.id,
-                            receiver_id: currentUser,
-                            sender_id: message.sender_id
-                        });
-                    }
-                });
+                // appendMessage queues read receipts for unread received messages;
+                // they go out as a single "read up to" event
+                messages.reverse().forEach(message => appendMessage(message));
             })
             .catch(err => {
                 try { showToast('Error', err.message || 'Failed to load messages'); } catch (_) {}
@@ -1828,6 +1914,7 @@ document.addEventListener('DOMContentLoaded', () => {
         .status-online { color: #31a24c !important; }
         .status-away { color: #f1c40f !important; }
         .status-offline { color: #95a5a6 !important; }
+        .message-attachment .message-thumb { display: block; max-width: 256px; max-height: 256px; border-radius: 8px; cursor: zoom-in; }
     `;
     document.head.appendChild(style);
 
@@ -1859,6 +1946,11 @@ document.addEventListener('DOMContentLoaded', () => {
 
     function applyTransform() {
         if (!modalImage) return;
+        // The viewer opens on the preview; swap in the original once zoomed
+        const fullUrl = modalImage.dataset.fullUrl;
+        if (viewScale > 1 && fullUrl && modalImage.getAttribute('src') !== fullUrl) {
+            modalImage.src = fullUrl;
+        }
         modalImage.style.transform = `translate(${viewTranslateX}px, ${viewTranslateY}px) scale(${viewScale})`;
         // update cursor
         if (imageStage) {
@@ -1902,6 +1994,8 @@ document.addEventListener('DOMContentLoaded', () => {
         modalImage.alt = 'Loading image...';
 
         const fullUrl = imageUrl.startsWith('/static/') ? imageUrl : `/static/${imageUrl.replace(/^\/*/, '')}`;
+        const viewUrl = imagePreviewUrls.get(fullUrl) || fullUrl;
+        modalImage.dataset.fullUrl = fullUrl;
 
         if (imageUrl.includes('90fcee5b-e844-4edd-87f6-7e6db517f6f6_img21.png')) {
             showErrorState();
@@ -1911,7 +2005,7 @@ document.addEventListener('DOMContentLoaded', () => {
         const img = new Image();
 
         img.onload = function() {
-            modalImage.src = fullUrl;
+            modalImage.src = viewUrl;
             modalImage.classList.remove('loading');
             currentImageIndex = index;
             updateNavigationButtons();
@@ -1922,7 +2016,7 @@ document.addEventListener('DOMContentLoaded', () => {
             showErrorState();
         };
 
-        img.src = fullUrl;
+        img.src = viewUrl;
 
         function showErrorState() {
             modalImage.src = '/static/images/error-image.png';
@@ -1946,8 +2040,9 @@ document.addEventListener('DOMContentLoaded', () => {
         prevButton.addEventListener('click', () => {
             if (currentImageIndex > 0) {
                 currentImageIndex--;
+                modalImage.dataset.fullUrl = imageGallery[currentImageIndex];
                 resetTransform();
-                modalImage.src = imageGallery[currentImageIndex];
+                modalImage.src = imagePreviewUrls.get(imageGallery[currentImageIndex]) || imageGallery[currentImageIndex];
                 updateNavigationButtons();
             }
         });
@@ -1955,8 +2050,9 @@ document.addEventListener('DOMContentLoaded', () => {
         nextButton.addEventListener('click', () => {
             if (currentImageIndex < imageGallery.length - 1) {
                 currentImageIndex++;
+                modalImage.dataset.fullUrl = imageGallery[currentImageIndex];
                 resetTransform();
-                modalImage.src = imageGallery[currentImageIndex];
+                modalImage.src = imagePreviewUrls.get(imageGallery[currentImageIndex]) || imageGallery[currentImageIndex];
                 updateNavigationButtons();
             }
         });
@@ -2819,16 +2915,8 @@ document.addEventListener('DOMContentLoaded', () => {
                 if (reqId !== groupMessagesRequestId) return; // Ignore outdated response
                 if (!Array.isArray(messages)) return;
                 messagesContainer.innerHTML = '';
-                messages.reverse().forEach(message => {
-                    if (message.sender_id !== currentUser) {
-                        socket.emit('mark_group_message_seen', {
-                            message_id: message.id,
-                            user_id: currentUser,
-                            group_id: groupId
-                        });
-                    }
-                    appendGroupMessage(message);
-                });
+                // appendGroupMessage queues the seen marker; only the newest id is sent
+                messages.reverse().forEach(message => appendGroupMessage(message));
             })
             .catch(err => {
                 try { showToast('Error', err.message || 'Failed to load group messages'); } catch (_) {}
@@ -2885,10 +2973,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 if (!imageGallery.includes(fullImageUrl)) imageGallery.push(fullImageUrl);
                 let fileName = message.filename || 'Attachment';
                 contentHtml += `<div class="image-message-block">
-                    <div class="message-attachment" data-image-url="${fullImageUrl}">
-                        <i class="fas fa-paperclip"></i>
-                        <span class="file-name">${fileName}</span>
-                    </div>
+                    ${imageAttachmentHtml(message, fullImageUrl, fileName)}
                 </div>`;
             } else {
                 if (message.media_url && message.media_type === 'file') {
@@ -2920,10 +3005,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 contentHtml += `<div class="image-message-text">${message.content}</div>`;
             }
             contentHtml += `
-                <div class="message-attachment" data-image-url="${fullImageUrl}">
-                    <i class="fas fa-paperclip"></i>
-                    <span class="file-name">${fileName}</span>
-                </div>
+                ${imageAttachmentHtml(message, fullImageUrl, fileName)}
             </div>`;
         } else if (messageType === 'file' && message.media_url) {
             const fullFileUrl = message.media_url.startsWith('/static/') ? message.media_url : `/static/${message.media_url}`;
@@ -2980,12 +3062,9 @@ document.addEventListener('DOMContentLoaded', () => {
         messagesContainer.appendChild(messageElement);
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
         
-                    if (message.sender_id !== currentUser) {
-                        socket.emit('mark_group_message_seen', {
-                            message_id: message.id,
-                            group_id: message.group_id
-                        });
-                    }
+        if (message.sender_id !== currentUser) {
+            queueGroupSeen(message.group_id, message.id);
+        }
     
         if (message.pinned) {
             updatePinUI(message.id, true);
@@ -3344,27 +3423,34 @@ document.addEventListener('DOMContentLoaded', () => {
             if (previewContainer) {
                 previewContainer.innerHTML = `<div class=\"attachment-preview loading\"><i class=\"fas fa-image fa-spin\"></i><span class=\"file-name\">${currentImageData.name}</span><div class=\"loading-text\">Sending...</div></div>`;
             }
-            messageData.media_url = currentImageData.data;
         }
-        socket.emit('send_group_message', messageData, (response) => {
-            sending = false;
-            if (response && response.error) {
-                alert('Failed to send message: ' + response.error);
-                if (currentImageData) {
-                    updateImagePreview(currentImageData.data);
-                }
-            } else {
-                if (messageInput) messageInput.value = '';
-                if (currentImageData) {
-                    currentImageData = null;
-                    pendingAttachments = [];
-                    clearAttachmentsPreview();
-                }
-                if (replyingTo) {
-                    cancelReply();
+        const uploaded = currentImageData ? uploadAttachment(currentImageData) : Promise.resolve(null);
+        uploaded.then(uploadId => {
+            if (uploadId) messageData.upload_id = uploadId;
+            socket.emit('send_group_message', messageData, (response) => {
+                sending = false;
+                if (response && response.error) {
+                    alert('Failed to send message: ' + response.error);
+                    if (currentImageData) {
+                        updateImagePreview(currentImageData);
+                    }
+                } else {
+                    if (messageInput) messageInput.value = '';
+                    if (currentImageData) {
+                        currentImageData = null;
+                        pendingAttachments = [];
+                        clearAttachmentsPreview();
+                    }
+                    if (replyingTo) {
+                        cancelReply();
+                    }
+                    // Sorting removed
                 }
-                // Sorting removed
-            }
+            });
+        }).catch(err => {
+            sending = false;
+            alert('Failed to upload attachment: ' + (err.message || err));
+            if (currentImageData) updateImagePreview(currentImageData);
         });
     }
 
@@ -3393,17 +3479,22 @@ document.addEventListener('DOMContentLoaded', () => {
                 content: (index === 0 && hasText) ? content : '',
                 filename: att.name || '',
                 type: replyingTo ? 'reply' : (isImage ? 'image' : 'file'),
-                parent_message_id: replyingTo,
-                media_url: att.data
+                parent_message_id: replyingTo
             };
-            socket.emit('send_group_message', messageData, (response) => {
-                if (response && response.error) {
-                    sending = false;
-                    try { showToast('Error', 'Failed to send one of the attachments'); } catch (_) {}
-                    return;
-                }
-                index++;
-                sendNext();
+            uploadAttachment(att).then(uploadId => {
+                messageData.upload_id = uploadId;
+                socket.emit('send_group_message', messageData, (response) => {
+                    if (response && response.error) {
+                        sending = false;
+                        try { showToast('Error', 'Failed to send one of the attachments'); } catch (_) {}
+                        return;
+                    }
+                    index++;
+                    sendNext();
+                });
+            }).catch(() => {
+                sending = false;
+                try { showToast('Error', `Failed to upload ${att.name || 'attachment'}`); } catch (_) {}
             });
         };
         sendNext();
@@ -3808,8 +3899,17 @@ document.addEventListener('DOMContentLoaded', () => {
             el.classList.remove('read');
         });
 
-        socket.on('message_read', ({ message_id }) => {
-            updateMessageReadStatus(message_id);
+        socket.on('message_read', ({ message_id, reader_id, up_to_id }) => {
+            if (up_to_id == null) {
+                updateMessageReadStatus(message_id);
+                return;
+            }
+            // Range receipt: everything we sent to reader_id up to up_to_id
+            if (reader_id !== currentReceiver || !messagesContainer) return;
+            messagesContainer.querySelectorAll('.message.sent[data-message-id]').forEach(el => {
+                const id = Number(el.getAttribute('data-message-id'));
+                if (Number.isFinite(id) && id <= up_to_id) updateMessageReadStatus(id);
+            });
         });
 
     }
@@ -3959,9 +4059,20 @@ document.addEventListener('DOMContentLoaded', () => {
                 url += `&group_id=${currentGroup}`;
             } else if (currentUser && currentReceiver) {
                 url += `&sender_id=${currentUser}&receiver_id=${currentReceiver}`;
+            } else {
+                // No chat open: search everything the user can see
+                url += '&scope=all';
             }
             
             fetch(url).then(res => res.json()).then(messages => {
+                if (messages && Array.isArray(messages.conversations)) {
+                    if (searchMessagesResults) {
+                        searchMessagesResults.innerHTML = messages.conversations.length
+                            ? messages.conversations.map(renderSearchConversation).join('')
+                            : '<div class="empty-state">No results found.</div>';
+                    }
+                    return;
+                }
                 try {
                     // Dedupe by id and keep most recent first
                     const seen = new Set();
@@ -3981,6 +4092,16 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    function renderSearchConversation(conv) {
+        const icon = conv.type === 'group' ? 'fa-users' : 'fa-user';
+        const title = conv.name || (conv.type === 'group' ? `Group ${conv.group_id}` : conv.peer_id) || '';
+        return `<div class="search-conversation" data-type="${conv.type}" data-id="${escapeHtml(String(conv.type === 'group' ? conv.group_id : conv.peer_id))}">
+            <div class="search-conversation-title"><i class="fas ${icon}"></i> ${escapeHtml(String(title))}
+                <span class="text-muted">(${conv.messages.length})</span></div>
+            ${conv.messages.map(renderSearchResult).join('')}
+        </div>`;
+    }
+
     function renderSearchResult(msg) {
         const isPinned = !!msg.pinned;
         const when = msg.created_at ? new Date(msg.created_at).toLocaleString() : '';
@@ -4022,6 +4143,9 @@ document.addEventListener('DOMContentLoaded', () => {
                     <span class="file-name">${escapeHtml(fileName)}</span>
                 </div>
             </div>`;
+        } else if (msg.snippet) {
+            // Server-built excerpt: already HTML-escaped, matches wrapped in <mark>
+            bodyHtml = `<div class="result-content">${msg.snippet}</div>`;
         } else {
             let text = msg.content || '';
             if (text.length > 180) text = text.substring(0, 180) + '…';
@@ -57,7 +57,7 @@ self.addEventListener('fetch', event => {
     const url = new URL(event.request.url);
     const isNavigate = event.request.mode === 'navigate';
     const isStatic = url.pathname.startsWith('/static/');
-    const isAPI = /\/(messages|groups|online_users|user_status|logout)\b/.test(url.pathname) || url.pathname.startsWith('/socket.io');
+    const isAPI = /\/(messages|groups|online_users|user_status|logout|uploads)\b/.test(url.pathname) || url.pathname.startsWith('/socket.io');
 
     // Network-first for navigations (dynamic HTML)
     if (isNavigate) {
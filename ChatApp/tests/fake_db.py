@@ -0,0 +1,55 @@
+import pymysql
+
+from database import Database, _PooledConnectionProxy
+
+
+class _Cursor:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def execute(self, query, args=None):
+        if query == 'FAIL':
+            raise pymysql.err.IntegrityError(1062, 'Duplicate entry')
+        self._conn.statements.append(query)
+        return 1
+
+    def close(self):
+        pass
+
+
+class _Connection:
+    def __init__(self):
+        self.statements = []
+        self.committed = []
+        self.rolled_back = False
+
+    def cursor(self, cursor_class=None):
+        return _Cursor(self)
+
+    def commit(self):
+        self.committed.extend(self.statements)
+        self.statements = []
+
+    def rollback(self):
+        self.rolled_back = True
+        self.statements = []
+
+    def close(self):
+        pass
+
+
+class _Pool:
+    def __init__(self):
+        self.conn = _Connection()
+
+    def connection(self):
+        return self.conn
+
+
+def fake_database():
+    """Database on one in-memory connection that records statements and commits"""
+    db = Database.__new__(Database)
+    db._pool = _Pool()
+    db.db_config = {}
+    db.chat_conn = _PooledConnectionProxy(db._pool, db.db_config)
+    return db
@@ -0,0 +1,187 @@
+import threading
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+import redis  # noqa: E402
+
+from cluster import InvalidationBus, SharedPresence  # noqa: E402
+from membership_cache import GroupMembershipCache  # noqa: E402
+
+
+class _MembershipDb:
+    def __init__(self):
+        self.members = {'g1': ['u1', 'u2']}
+        self.queries = 0
+
+    def get_group_member_ids(self, group_id):
+        self.queries += 1
+        return list(self.members.get(str(group_id), []))
+
+    def get_user_group_ids(self, user_id):
+        self.queries += 1
+        return [g for g, members in self.members.items() if str(user_id) in members]
+
+
+class _DroppingPubSub:
+    """Subscribes normally, then loses the connection when listened on"""
+
+    def __init__(self, pubsub):
+        self._pubsub = pubsub
+
+    def subscribe(self, *channels):
+        self._pubsub.subscribe(*channels)
+
+    def listen(self):
+        raise redis.ConnectionError('connection reset')
+
+    def close(self):
+        self._pubsub.close()
+
+
+class _FlakyClient:
+    def __init__(self, client, drops: int):
+        self._client = client
+        self.drops = drops
+
+    def pubsub(self, **kwargs):
+        pubsub = self._client.pubsub(**kwargs)
+        if self.drops:
+            self.drops -= 1
+            return _DroppingPubSub(pubsub)
+        return pubsub
+
+    def publish(self, channel, message):
+        return self._client.publish(channel, message)
+
+
+def _worker(client, worker_id, db):
+    bus = InvalidationBus(client, worker_id=worker_id, sleep=lambda s: None)
+    cache = GroupMembershipCache(db)
+    cache.attach_bus(bus)
+    threading.Thread(target=bus.run, daemon=True).start()
+    return bus, cache
+
+
+def _wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def _wait_subscribed(client, n):
+    assert _wait_for(lambda: client.pubsub_numsub('chatapp:invalidate')[0][1] >= n)
+
+
+def test_membership_change_on_one_worker_drops_the_other_workers_cache():
+    server = fakeredis.FakeServer()
+    db = _MembershipDb()
+    bus_a, cache_a = _worker(fakeredis.FakeStrictRedis(server=server), 'worker-a', db)
+    bus_b, cache_b = _worker(fakeredis.FakeStrictRedis(server=server), 'worker-b', db)
+    _wait_subscribed(fakeredis.FakeStrictRedis(server=server), 2)
+
+    assert cache_b.members('g1') == frozenset({'u1', 'u2'})
+    db.members['g1'].append('u3')
+    cache_a.invalidate_group('g1')
+
+    assert _wait_for(lambda: bus_b.received == 1)
+    assert cache_b.members('g1') == frozenset({'u1', 'u2', 'u3'})
+    assert bus_a.received == 0  # a worker ignores its own publishes
+    bus_a.stop()
+    bus_b.stop()
+
+
+def test_presence_counts_are_summed_across_workers():
+    server = fakeredis.FakeServer()
+    a = SharedPresence(fakeredis.FakeStrictRedis(server=server, decode_responses=True), worker_id='worker-a')
+    b = SharedPresence(fakeredis.FakeStrictRedis(server=server, decode_responses=True), worker_id='worker-b')
+    a.heartbeat()
+    b.heartbeat()
+
+    assert a.incr('u1', 1) == 1
+    assert b.incr('u1', 1) == 2
+    assert a.incr('u1', -1) == 1
+    assert a.count('u1') == 1 and b.count('u1') == 1
+
+
+def test_bus_reconnects_and_flushes_cache_after_resubscribing():
+    server = fakeredis.FakeServer()
+    db = _MembershipDb()
+    client = _FlakyClient(fakeredis.FakeStrictRedis(server=server), drops=2)
+    bus = InvalidationBus(client, worker_id='worker-a', sleep=lambda s: None)
+    cache = GroupMembershipCache(db)
+    cache.attach_bus(bus)
+    assert cache.members('g1') == frozenset({'u1', 'u2'})
+    threading.Thread(target=bus.run, daemon=True).start()
+
+    # Invalidations published during the outage were lost, so start cold
+    assert _wait_for(lambda: cache.stats()['groups_cached'] == 0)
+    assert bus.reconnects == 2
+    _wait_subscribed(fakeredis.FakeStrictRedis(server=server), 1)
+
+    publisher = InvalidationBus(fakeredis.FakeStrictRedis(server=server), worker_id='worker-b')
+    publisher.publish('group_members', 'g1')
+    assert _wait_for(lambda: bus.received == 1)
+    bus.stop()
+
+
+def _daemon_task(target, *args, **kwargs):
+    thread = threading.Thread(target=target, args=args, kwargs=kwargs, daemon=True)
+    thread.start()
+    return thread
+
+
+def _socketio_worker(url):
+    flask = pytest.importorskip('flask')
+    flask_socketio = pytest.importorskip('flask_socketio')
+    app = flask.Flask(__name__)
+    socketio = flask_socketio.SocketIO(app, async_mode='threading', message_queue=url)
+    # The queue listener never returns; don't let it keep the test run alive
+    socketio.server.start_background_task = _daemon_task
+
+    @socketio.on('connect')
+    def connect(auth=None):
+        # What handle_connect does: the user's own room plus its group rooms
+        flask_socketio.join_room(flask.request.args['user_id'])
+        flask_socketio.join_room('group_7')
+
+    return app, socketio
+
+
+def test_emits_on_one_worker_reach_clients_on_the_other(monkeypatch):
+    redis_manager = pytest.importorskip('socketio.redis_manager')
+    server = fakeredis.FakeServer()
+    # Both workers' RedisManager connect to the same fake server
+    monkeypatch.setattr(redis_manager, 'redis', type('redis', (), {
+        'Redis': type('Redis', (), {
+            'from_url': staticmethod(lambda url, **kwargs: fakeredis.FakeStrictRedis(server=server))}),
+        'exceptions': redis.exceptions,
+    }))
+    # The test client refuses a message queue because delivery through it is
+    # asynchronous; the assertions below wait for it instead
+    test_client = pytest.importorskip('flask_socketio.test_client')
+    monkeypatch.setattr(test_client, 'PubSubManager', type('NoQueue', (), {}))
+    app_a, socketio_a = _socketio_worker('redis://queue')
+    app_b, socketio_b = _socketio_worker('redis://queue')
+    client_a = socketio_a.test_client(app_a, query_string='user_id=u1')
+    client_b = socketio_b.test_client(app_b, query_string='user_id=u2')
+    assert _wait_for(lambda: fakeredis.FakeStrictRedis(server=server).pubsub_numsub('flask-socketio')[0][1] >= 2)
+
+    received = []
+
+    def events(name):
+        received.extend(client_b.get_received())
+        return [packet['args'][0] for packet in received if packet['name'] == name]
+
+    socketio_a.emit('new_group_message', {'id': 1}, room='group_7')
+    socketio_a.emit('new_message', {'id': 2}, room='u2')
+    assert _wait_for(lambda: events('new_group_message') == [{'id': 1}])
+    assert _wait_for(lambda: events('new_message') == [{'id': 2}])
+    # The user room of worker A's own client is not crossed over to B
+    socketio_a.emit('new_message', {'id': 3}, room='u1')
+    assert _wait_for(lambda: any(p['args'][0] == {'id': 3} for p in client_a.get_received()))
+    assert events('new_message') == [{'id': 2}]
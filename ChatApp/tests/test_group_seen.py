@@ -0,0 +1,167 @@
+import pytest
+
+import database
+from database import Database
+
+
+class _ScriptedCursor:
+    """Answers each SELECT from `answers` (first matching fragment wins) and records every statement"""
+
+    def __init__(self, answers, rowcount=0):
+        self.answers = answers
+        self.statements = []
+        self.rowcount = rowcount
+        self.connection = self
+        self.commits = 0
+        self._row = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, args=None):
+        self.statements.append((' '.join(sql.split()), args))
+        self._row = next((row for fragment, row in self.answers.items() if fragment in sql), None)
+
+    def fetchone(self):
+        return self._row
+
+    def commit(self):
+        self.commits += 1
+
+    def cursor(self, cursor_class=None):
+        return self
+
+    def matching(self, fragment):
+        return [args for sql, args in self.statements if fragment in sql]
+
+
+class _Ledger:
+    def __init__(self):
+        self.seen = []
+
+    def on_group_seen(self, user_id, group_id, count):
+        self.seen.append((user_id, group_id, count))
+
+
+class _Memberships:
+    def __init__(self, groups):
+        self._groups = groups
+
+    def groups(self, user_id):
+        return frozenset(self._groups.get(user_id, ()))
+
+
+def _db(pointer=None, newly_seen=0, message_group=7, groups=None):
+    cursor = _ScriptedCursor({
+        'FROM messages WHERE id': (message_group,),
+        'FROM group_read_pointer': (pointer,) if pointer is not None else None,
+        'SELECT COUNT(*)': (newly_seen,),
+    })
+    db = Database.__new__(Database)
+    db.chat_conn = cursor
+    db.unread_ledger = _Ledger()
+    db.memberships = _Memberships(groups if groups is not None else {'u1': {'7'}})
+    return db, cursor
+
+
+def test_pointer_never_moves_back():
+    db, cursor = _db(pointer=50)
+    assert db.mark_group_seen_up_to(7, 'u1', 40) is None
+    assert db.mark_group_seen_up_to(7, 'u1', 50) is None
+    assert cursor.matching('INSERT INTO group_read_pointer') == []
+    assert db.unread_ledger.seen == []
+
+
+def test_advancing_counts_others_messages_in_the_range_and_decrements_summary():
+    db, cursor = _db(pointer=10, newly_seen=3)
+    assert db.mark_group_seen_up_to(7, 'u1', 20) == (7, 10, 20)
+    assert cursor.matching('INSERT INTO group_read_pointer') == [(7, 'u1', 20)]
+    # (previous, up_to] and only messages the reader didn't send
+    assert cursor.matching('SELECT COUNT(*)') == [(7, 10, 20, 'u1')]
+    assert cursor.matching('UPDATE conversation_summary') == [(3, 'u1', '7')]
+    assert db.unread_ledger.seen == [('u1', 7, 3)]
+
+
+def test_first_pointer_starts_from_zero_and_skips_summary_when_nothing_was_unread():
+    db, cursor = _db(pointer=None, newly_seen=0)
+    assert db.mark_group_seen_up_to(7, 'u1', 5) == (7, 0, 5)
+    assert cursor.matching('SELECT COUNT(*)') == [(7, 0, 5, 'u1')]
+    assert cursor.matching('UPDATE conversation_summary') == []
+    assert db.unread_ledger.seen == []
+
+
+def test_advance_upsert_keeps_the_higher_pointer():
+    sql = ' '.join(database._ADVANCE_READ_POINTER_SQL.split())
+    assert 'last_seen_message_id = GREATEST(last_seen_message_id, VALUES(last_seen_message_id))' in sql
+    # seen_at is assigned first, while last_seen_message_id still holds the old value
+    assert sql.index('seen_at = IF') < sql.index('last_seen_message_id = GREATEST')
+
+
+def test_seen_pointer_moves_in_the_messages_own_group():
+    db, cursor = _db(pointer=0, newly_seen=1, message_group=7)
+    assert db.mark_message_seen(42, 'u1') == (7, 0, 42)
+    assert cursor.matching('INSERT INTO group_read_pointer') == [(7, 'u1', 42)]
+
+
+def test_non_member_cannot_mark_a_group_message_seen():
+    db, cursor = _db(message_group=7, groups={'u1': {'8'}})
+    with pytest.raises(PermissionError):
+        db.mark_message_seen(42, 'u1')
+    assert cursor.matching('group_read_pointer') == []
+
+
+def test_compaction_walks_message_ids_in_batches():
+    cursor = _ScriptedCursor({'MIN(message_id)': (3, 12)}, rowcount=4)
+    assert database._compact_message_seen(cursor, batch_size=5) == 8
+    ranges = [(2, 7), (7, 12)]
+    assert cursor.matching('INSERT INTO group_read_pointer') == ranges
+    assert cursor.matching('DELETE FROM message_seen') == ranges
+    assert cursor.commits == 2
+
+
+def test_compaction_of_an_empty_table_does_nothing():
+    cursor = _ScriptedCursor({'MIN(message_id)': (None, None)})
+    assert database._compact_message_seen(cursor) == 0
+    assert len(cursor.statements) == 1
+
+
+_SEEN_TABLES = ('group_read_pointer', 'message_seen', 'messages', '`groups`')
+
+
+def test_compaction_on_mysql(mysql_conn):
+    cursor = mysql_conn.cursor()
+    for table in _SEEN_TABLES:
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    cursor.execute("CREATE TABLE `groups` (id INT PRIMARY KEY)")
+    cursor.execute("""CREATE TABLE messages (
+        id INT PRIMARY KEY, group_id INT NULL, sender_id VARCHAR(20) NOT NULL)""")
+    cursor.execute("""CREATE TABLE message_seen (
+        message_id INT NOT NULL, user_id VARCHAR(20) NOT NULL,
+        seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (message_id, user_id))""")
+    database._migration_group_read_pointer(cursor)
+    try:
+        cursor.execute("INSERT INTO `groups` VALUES (1), (2)")
+        cursor.executemany("INSERT INTO messages VALUES (%s, %s, 'u9')",
+                           [(i, 1 if i % 2 else 2) for i in range(1, 21)])
+        # u1 saw the odd messages (group 1) up to 19; u2 only 2 and 4 of group 2
+        cursor.executemany("INSERT INTO message_seen (message_id, user_id) VALUES (%s, %s)",
+                           [(i, 'u1') for i in range(1, 21, 2)] + [(2, 'u2'), (4, 'u2')])
+        # An existing pointer ahead of the legacy rows must not move back
+        cursor.execute("""INSERT INTO group_read_pointer (group_id, user_id, last_seen_message_id, seen_at)
+                          VALUES (2, 'u2', 18, '2020-01-01 00:00:00')""")
+
+        assert database._compact_message_seen(cursor, batch_size=3) == 12
+
+        cursor.execute("SELECT COUNT(*) FROM message_seen")
+        assert cursor.fetchone()[0] == 0
+        cursor.execute("SELECT group_id, user_id, last_seen_message_id, seen_at FROM group_read_pointer "
+                       "ORDER BY group_id, user_id")
+        rows = cursor.fetchall()
+        assert [row[:3] for row in rows] == [(1, 'u1', 19), (2, 'u2', 18)]
+        assert str(rows[1][3]) == '2020-01-01 00:00:00'
+    finally:
+        for table in _SEEN_TABLES:
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
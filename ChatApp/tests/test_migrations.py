@@ -0,0 +1,91 @@
+import pymysql
+import pytest
+
+import database
+import manage
+
+
+class _FakeCursor:
+    def __init__(self, lock_result):
+        self.lock_result = lock_result
+        self.statements = []
+        self._last = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, args=None):
+        self.statements.append(sql)
+        self._last = sql
+
+    def fetchone(self):
+        return (self.lock_result,) if 'GET_LOCK' in self._last else None
+
+    def fetchall(self):
+        return []
+
+
+class _FakeConn:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self, *args):
+        return self._cursor
+
+
+@pytest.mark.parametrize('lock_result', [0, None])
+def test_migrate_refuses_to_run_without_the_lock(lock_result):
+    db = object.__new__(database.Database)
+    cursor = _FakeCursor(lock_result)
+    db.chat_conn = _FakeConn(cursor)
+    with pytest.raises(database.MigrationLockTimeout):
+        db.migrate()
+    assert not any('ALTER' in sql or 'RELEASE_LOCK' in sql for sql in cursor.statements)
+
+
+# EXPLAIN checks need a real server (see mysql_conn in conftest.py)
+_MESSAGES_DDL = """
+    CREATE TABLE messages (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        sender_id VARCHAR(20) NOT NULL,
+        receiver_id VARCHAR(20) NULL,
+        group_id INT NULL,
+        content TEXT,
+        filename VARCHAR(255) NULL,
+        is_read BOOLEAN DEFAULT FALSE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+@pytest.fixture
+def mysql_cursor(mysql_conn):
+    cursor = mysql_conn.cursor(pymysql.cursors.DictCursor)
+    cursor.execute("DROP TABLE IF EXISTS messages")
+    cursor.execute(_MESSAGES_DDL)
+    try:
+        yield cursor
+    finally:
+        cursor.execute("DROP TABLE IF EXISTS messages")
+
+
+def test_hot_queries_use_their_indexes(mysql_cursor):
+    database._migration_message_indexes(mysql_cursor)
+    database._migration_conversation_key(mysql_cursor)
+    rows = []
+    for i in range(4000):
+        if i % 3 == 0:
+            rows.append((f"u{i % 40}", None, i % 25, f"g:{i % 25}", i % 2 == 0))
+        else:
+            a, b = f"u{i % 40}", f"u{(i * 7) % 40}"
+            rows.append((a, b, None, database.direct_conversation_key(a, b), i % 2 == 0))
+    mysql_cursor.executemany(
+        "INSERT INTO messages (sender_id, receiver_id, group_id, conversation_key, is_read) "
+        "VALUES (%s, %s, %s, %s, %s)", rows)
+    mysql_cursor.execute("ANALYZE TABLE messages")
+    mysql_cursor.fetchall()
+    for label, expected, plan in manage.explain_plans(mysql_cursor):
+        assert plan['key'] == expected, f"{label}: {plan}"
@@ -0,0 +1,153 @@
+from read_receipts import GroupSeenAggregator, ReadReceiptBatcher
+
+
+class _Db:
+    def __init__(self, changed=1, fail=False):
+        self.changed = changed
+        self.fail = fail
+        self.calls = []
+
+    def session(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def mark_direct_read_up_to(self, reader_id, sender_id, up_to_id):
+        self.calls.append((reader_id, sender_id, up_to_id))
+        if self.fail:
+            raise RuntimeError('database went away')
+        return self.changed
+
+
+def _batcher(db):
+    reads, counts = [], []
+    batcher = ReadReceiptBatcher(db, lambda r, s, n: reads.append((r, s, n)), counts.append)
+    return batcher, reads, counts
+
+
+def test_receipts_coalesce_to_the_highest_message_id():
+    db = _Db()
+    batcher, reads, _ = _batcher(db)
+    batcher.submit('u1', 'u2', 10)
+    batcher.submit('u1', 'u2', 30)
+    batcher.submit('u1', 'u2', 20)  # late, lower receipt doesn't pull the mark back
+    assert batcher.flush() == 1
+    assert db.calls == [('u1', 'u2', 30)]
+    assert reads == [('u1', 'u2', 30)]
+    assert batcher.stats()['coalesced'] == 2
+
+
+def test_failed_update_is_requeued_for_the_next_tick():
+    db = _Db(fail=True)
+    batcher, reads, counts = _batcher(db)
+    batcher.submit('u1', 'u2', 10)
+    assert batcher.flush() == 0
+    assert reads == [] and counts == []
+    assert batcher.stats()['pending'] == 1
+
+    db.fail = False
+    assert batcher.flush() == 1
+    assert db.calls[-1] == ('u1', 'u2', 10)
+    assert reads == [('u1', 'u2', 10)]
+
+
+def test_requeue_does_not_override_a_newer_receipt():
+    db = _Db(fail=True)
+    batcher, _, _ = _batcher(db)
+    batcher.submit('u1', 'u2', 10)
+    failing = db.mark_direct_read_up_to
+
+    def newer_receipt_arrives_mid_flush(*args):
+        batcher.submit('u1', 'u2', 15)
+        return failing(*args)
+
+    db.mark_direct_read_up_to = newer_receipt_arrives_mid_flush
+    batcher.flush()
+    assert batcher._take() == [(('u1', 'u2'), 15)]
+
+
+def test_counts_are_published_once_per_affected_user():
+    db = _Db()
+    batcher, reads, counts = _batcher(db)
+    batcher.submit('u1', 'u2', 5)
+    batcher.submit('u1', 'u3', 7)
+    batcher.submit('u3', 'u2', 9)
+    batcher.flush()
+    assert len(reads) == 3
+    assert sorted(counts) == ['u1', 'u2', 'u3']
+
+
+def test_nothing_flipped_still_announces_but_skips_counts():
+    batcher, reads, counts = _batcher(_Db(changed=0))
+    batcher.submit('u1', 'u2', 5)
+    batcher.flush()
+    assert reads == [('u1', 'u2', 5)]
+    assert counts == []
+
+
+def test_run_logs_flush_errors_and_keeps_going(caplog):
+    batcher, _, _ = _batcher(_Db())
+    ticks = []
+
+    def sleep(_):
+        ticks.append(1)
+        if len(ticks) == 2:
+            batcher.stop()
+
+    batcher._sleep = sleep
+    batcher.flush = lambda: 1 / 0
+    batcher.run()
+    assert len(ticks) == 2
+    assert 'Read receipt flush failed' in caplog.text
+
+
+def _aggregator():
+    published = []
+    return GroupSeenAggregator(lambda group_id, updates: published.append((group_id, updates))), published
+
+
+def test_seen_pointers_coalesce_within_a_window():
+    aggregator, published = _aggregator()
+    aggregator.submit(7, 'u1', 10)
+    aggregator.submit(7, 'u1', 12)
+    aggregator.submit(7, 'u1', 11)
+    assert aggregator.flush() == 1
+    assert published == [('7', [{'message_id': 12, 'user_ids': ['u1']}])]
+    assert aggregator.flush() == 0  # nothing new, no broadcast
+    assert len(published) == 1
+
+
+def test_seen_delta_groups_members_by_message_id():
+    aggregator, published = _aggregator()
+    aggregator.submit(7, 'u2', 12)
+    aggregator.submit(7, 'u1', 12)
+    aggregator.submit(7, 'u3', 9)
+    aggregator.submit(8, 'u1', 3)
+    aggregator.flush()
+    assert dict(published) == {
+        '7': [{'message_id': 9, 'user_ids': ['u3']}, {'message_id': 12, 'user_ids': ['u1', 'u2']}],
+        '8': [{'message_id': 3, 'user_ids': ['u1']}],
+    }
+
+
+def test_failed_seen_broadcast_is_requeued(caplog):
+    attempts = []
+
+    def publish(group_id, updates):
+        attempts.append(updates)
+        if len(attempts) == 1:
+            aggregator.submit(group_id, 'u1', 20)  # newer pointer while sending
+            raise RuntimeError('queue unavailable')
+
+    aggregator = GroupSeenAggregator(publish)
+    aggregator.submit(7, 'u1', 10)
+    aggregator.submit(7, 'u2', 10)
+    aggregator.flush()
+    assert 'Seen delta for group 7 failed' in caplog.text
+    aggregator.flush()
+    assert attempts[-1] == [{'message_id': 10, 'user_ids': ['u2']}, {'message_id': 20, 'user_ids': ['u1']}]
+    assert aggregator.stats()['broadcasts'] == 1
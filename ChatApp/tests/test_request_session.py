@@ -0,0 +1,45 @@
+from flask import Flask
+
+from fake_db import fake_database
+from request_session import init_request_sessions
+
+
+def _app(db):
+    app = Flask(__name__)
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    init_request_sessions(app, db)
+
+    @app.route('/ok')
+    def ok():
+        with db.chat_conn.cursor() as cursor:
+            cursor.execute('INSERT ok')
+        db.after_commit(emitted.append, 'ok')
+        return 'done'
+
+    @app.route('/boom')
+    def boom():
+        with db.chat_conn.cursor() as cursor:
+            cursor.execute('INSERT half')
+        db.after_commit(emitted.append, 'half')
+        raise RuntimeError('view failed halfway')
+
+    emitted = []
+    app.emitted = emitted
+    return app
+
+
+def test_request_commits_before_the_response():
+    db = fake_database()
+    app = _app(db)
+    assert app.test_client().get('/ok').status_code == 200
+    assert db._pool.conn.committed == ['INSERT ok']
+    assert app.emitted == ['ok']
+
+
+def test_raising_view_rolls_back_its_writes():
+    db = fake_database()
+    app = _app(db)
+    assert app.test_client().get('/boom').status_code == 500
+    assert db._pool.conn.committed == []
+    assert db._pool.conn.rolled_back
+    assert app.emitted == []
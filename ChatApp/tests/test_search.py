@@ -0,0 +1,45 @@
+import search
+
+
+def test_stopwords_are_not_required_terms():
+    assert search.boolean_query(search.tokenize('the report')) == '+report*'
+    assert search.boolean_query(search.tokenize('About the budget and payroll')) == '+budget* +payroll*'
+
+
+def test_query_of_only_stopwords_or_short_words_has_no_fulltext_form():
+    # None makes the caller fall back to a LIKE scan
+    assert search.boolean_query(search.tokenize('what is it')) is None
+    assert search.boolean_query(search.tokenize('ok go')) is None
+
+
+def test_boolean_operators_in_user_input_are_stripped():
+    assert search.boolean_query(search.tokenize('+invoice -"draft"*')) == '+invoice* +draft*'
+
+
+def test_snippet_highlights_query_terms_not_stopwords():
+    terms = search.query_terms(search.tokenize('the report'))
+    assert terms == ['report']
+    text = 'Here is the draft; the final report follows'
+    assert search.snippet(text, terms).count('<mark>') == 1
+    assert '<mark>report</mark>' in search.snippet(text, terms)
+
+
+class _Names:
+    def name(self, user_id):
+        return f"name-{user_id}"
+
+
+def test_global_hits_are_grouped_per_conversation_before_the_key_backfill():
+    from database import Database
+    db = Database.__new__(Database)
+    db.employees = _Names()
+    rows = [
+        {'id': 3, 'sender_id': 'u2', 'receiver_id': 'u1', 'group_id': None, 'conversation_key': None, 'score': 2.0},
+        {'id': 2, 'sender_id': 'u1', 'receiver_id': 'u3', 'group_id': None, 'conversation_key': None, 'score': 1.5},
+        {'id': 1, 'sender_id': 'u1', 'receiver_id': 'u2', 'group_id': None, 'conversation_key': None, 'score': 1.0},
+    ]
+    conversations = db._group_search_hits('u1', rows)
+    assert [(c['peer_id'], c['name'], [m['id'] for m in c['messages']]) for c in conversations] == [
+        ('u2', 'name-u2', [3, 1]),
+        ('u3', 'name-u3', [2]),
+    ]
@@ -0,0 +1,62 @@
+import pymysql
+import pytest
+
+import database
+from fake_db import fake_database as _db
+
+
+def test_handled_statement_error_does_not_roll_back_the_session():
+    db = _db()
+    with db.session():
+        with db.chat_conn.cursor() as cursor:
+            cursor.execute('INSERT message')
+        try:
+            with db.chat_conn.cursor() as cursor:
+                cursor.execute('FAIL')
+        except pymysql.err.IntegrityError:
+            pass
+    assert db._pool.conn.committed == ['INSERT message']
+    assert not db._pool.conn.rolled_back
+
+
+def test_after_commit_hooks_see_committed_rows_outside_the_session():
+    db = _db()
+    seen = []
+
+    def hook():
+        seen.append((list(db._pool.conn.committed), database._current_session.get()))
+
+    with db.session():
+        with db.chat_conn.cursor() as cursor:
+            cursor.execute('INSERT message')
+        db.after_commit(hook)
+        assert seen == []
+    assert seen == [(['INSERT message'], None)]
+
+
+def test_escaping_exception_rolls_back_and_skips_hooks():
+    db = _db()
+    seen = []
+    with pytest.raises(RuntimeError):
+        with db.session():
+            with db.chat_conn.cursor() as cursor:
+                cursor.execute('INSERT message')
+            db.after_commit(seen.append, 'emitted')
+            raise RuntimeError('handler failed')
+    assert db._pool.conn.rolled_back
+    assert db._pool.conn.committed == []
+    assert seen == []
+
+
+def test_failing_hook_is_logged_and_later_hooks_still_run(caplog):
+    db = _db()
+    seen = []
+
+    def broken():
+        raise ValueError('ledger exploded')
+
+    with db.session():
+        db.after_commit(broken)
+        db.after_commit(seen.append, 'emitted')
+    assert seen == ['emitted']
+    assert 'ledger exploded' in caplog.text
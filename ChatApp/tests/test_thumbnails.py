@@ -0,0 +1,29 @@
+import time
+
+import pytest
+
+import thumbnails
+from thumbnails import ThumbnailService
+
+pytestmark = pytest.mark.skipif(thumbnails.Image is None, reason='Pillow not installed')
+
+DIGEST = 'ab' * 32
+
+
+def _wait_idle(service):
+    deadline = time.monotonic() + 5
+    while service.stats()['pending'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_failed_render_is_not_resubmitted_until_retry_after(tmp_path):
+    service = ThumbnailService(str(tmp_path / 'thumbs'), workers=1, retry_after=60)
+    missing = str(tmp_path / f'{DIGEST}.png')
+    assert service.submit(missing)
+    _wait_idle(service)
+    assert service.stats()['failed'] == 1
+    assert not service.submit(missing)
+    assert service.stats()['skipped'] == 1
+    service.retry_after = 0
+    assert service.submit(missing)
+    _wait_idle(service)
@@ -0,0 +1,25 @@
+import io
+
+import pytest
+
+from uploads import ChunkedUploadStore, UploadError
+
+
+def _store(tmp_path):
+    return ChunkedUploadStore(str(tmp_path), max_size=1024, finalize=lambda s: (True, {'size': s.received}))
+
+
+def test_concurrent_chunk_is_rejected_with_current_offset(tmp_path):
+    store = _store(tmp_path)
+    upload = store.create('u1', 'a.bin', 8)
+    store.append(upload.upload_id, 'u1', 0, io.BytesIO(b'abcd'))
+    upload.lock.acquire()  # another request is streaming a chunk
+    try:
+        with pytest.raises(UploadError) as err:
+            store.append(upload.upload_id, 'u1', 4, io.BytesIO(b'efgh'))
+    finally:
+        upload.lock.release()
+    assert err.value.status == 409
+    assert err.value.offset == 4
+    done = store.append(upload.upload_id, 'u1', 4, io.BytesIO(b'efgh'))
+    assert done.result == {'size': 8}
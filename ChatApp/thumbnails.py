@@ -0,0 +1,157 @@
+import os
+import re
+import secrets
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+import async_mode
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # thumbnails are optional; originals are served as before
+    Image = None
+
+# Bounding-box edge (px) of each variant: chat bubble thumb and viewer preview
+THUMB_SIZES = (256, 1024)
+_BLOB_DIGEST_RE = re.compile(r'^([0-9a-f]{64})(?:\.[A-Za-z0-9]+)?$')
+
+
+class ThumbnailService:
+    """
+    Size-bucketed previews of image blobs, rendered in a background pool.
+
+    Variants are named '<sha256>-<size>.<fmt>' and stored with the same
+    fan-out layout as BlobStore, so they are keyed by content hash and shared
+    by every message that points at the same image. WebP is used when Pillow
+    was built with it, JPEG otherwise. Without Pillow the service is disabled
+    and every lookup returns None. An image that failed to render (missing
+    or undecodable source) is not resubmitted for `retry_after` seconds.
+    """
+
+    def __init__(self, root: str, sizes: Iterable[int] = THUMB_SIZES, workers: int = 2, quality: int = 80,
+                 retry_after: float = 3600.0, max_failures: int = 10000):
+        self.root = root
+        self.sizes = tuple(sorted(sizes))
+        self.quality = quality
+        self.enabled = Image is not None
+        self.format = 'webp' if self.enabled and features.check('webp') else 'jpg'
+        self.tmp_dir = os.path.join(root, '.tmp')
+        self._lock = threading.Lock()
+        self._pending = set()
+        # digest -> monotonic time of the last failed render (insertion ordered)
+        self._failures: Dict[str, float] = {}
+        self.retry_after = retry_after
+        self.max_failures = max_failures
+        # Real OS threads under gevent/eventlet too: Pillow would otherwise
+        # decode and resize on the hub and stall every socket meanwhile
+        self._executor = async_mode.native_executor(workers, thread_name_prefix='thumbnails') if self.enabled else None
+        self.generated = 0
+        self.failed = 0
+        self.skipped = 0
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    @staticmethod
+    def digest_of(blob_name: str) -> Optional[str]:
+        """Content hash of a '<sha256>.<ext>' blob name, None for legacy names"""
+        match = _BLOB_DIGEST_RE.match(os.path.basename(blob_name or ''))
+        return match.group(1) if match else None
+
+    def variant_name(self, digest: str, size: int) -> str:
+        return f"{digest}-{size}.{self.format}"
+
+    def path_for(self, name: str) -> str:
+        return os.path.join(self.root, name[0:2], name[2:4], name)
+
+    def locate(self, name: str) -> Optional[str]:
+        name = os.path.basename(name or '')
+        if not name:
+            return None
+        path = self.path_for(name)
+        return path if os.path.isfile(path) else None
+
+    def variants(self, digest: str) -> Dict[int, str]:
+        """size -> variant name for the variants of `digest` already on disk"""
+        if not self.enabled or not digest:
+            return {}
+        found = {}
+        for size in self.sizes:
+            name = self.variant_name(digest, size)
+            if os.path.isfile(self.path_for(name)):
+                found[size] = name
+        return found
+
+    def submit(self, source_path: str, digest: Optional[str] = None) -> bool:
+        """Queue variant generation for an image blob; False if nothing was queued"""
+        digest = digest or self.digest_of(source_path)
+        if not self.enabled or not digest or not source_path:
+            return False
+        with self._lock:
+            if digest in self._pending:
+                return False
+            failed_at = self._failures.get(digest)
+            if failed_at is not None:
+                if time.monotonic() - failed_at < self.retry_after:
+                    self.skipped += 1
+                    return False
+                del self._failures[digest]
+            self._pending.add(digest)
+        self._executor.submit(self._run, source_path, digest)
+        return True
+
+    def _run(self, source_path: str, digest: str) -> None:
+        try:
+            self.generate(source_path, digest)
+            with self._lock:
+                self.generated += 1
+        except Exception:
+            with self._lock:
+                self.failed += 1
+                self._failures[digest] = time.monotonic()
+                if len(self._failures) > self.max_failures:
+                    del self._failures[next(iter(self._failures))]
+        finally:
+            with self._lock:
+                self._pending.discard(digest)
+
+    def generate(self, source_path: str, digest: str) -> Dict[int, str]:
+        """Render every missing variant of one image synchronously"""
+        missing = [size for size in self.sizes if not os.path.isfile(self.path_for(self.variant_name(digest, size)))]
+        if missing:
+            with Image.open(source_path) as img:
+                img = ImageOps.exif_transpose(img)
+                if self.format == 'jpg' and img.mode not in ('RGB', 'L'):
+                    img = img.convert('RGB')
+                elif img.mode not in ('RGB', 'RGBA', 'L'):
+                    img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+                # Largest first, each step downscaling the previous result
+                for size in sorted(missing, reverse=True):
+                    img.thumbnail((size, size), Image.LANCZOS)
+                    self._write(img, self.variant_name(digest, size))
+        return self.variants(digest)
+
+    def _write(self, img, name: str) -> None:
+        dest = self.path_for(name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        temp_path = os.path.join(self.tmp_dir, secrets.token_hex(12))
+        try:
+            if self.format == 'webp':
+                img.save(temp_path, 'WEBP', quality=self.quality, method=4)
+            else:
+                img.save(temp_path, 'JPEG', quality=self.quality, optimize=True, progressive=True)
+            os.replace(temp_path, dest)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'format': self.format if self.enabled else None,
+                'pending': len(self._pending),
+                'generated': self.generated,
+                'failed': self.failed,
+                'failures_cached': len(self._failures),
+                'skipped': self.skipped,
+            }
@@ -0,0 +1,148 @@
+import threading
+from typing import Dict, Iterable
+
+
+class UnreadLedger:
+    """
+    In-process unread counters, seeded from the database once per user and
+    then kept current by deltas reported from the Database write paths.
+
+    Counts are keyed the same way the client expects them in
+    `unread_counts_update`: direct chats by peer user_id, groups by
+    'group_<id>'. Users that were never seeded are ignored by the delta
+    methods; they are loaded from the database on first use.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._lock = threading.RLock()
+        self._counts: Dict[str, Dict[str, int]] = {}
+
+    # --- seeding ---
+    def seed(self, user_id: str) -> Dict[str, int]:
+        """(Re)load a user's counts from the database and return a snapshot."""
+        summary = self._db.get_unread_summary(user_id)
+        counts = {k: int(v) for k, v in summary.items() if v}
+        with self._lock:
+            self._counts[user_id] = counts
+            return dict(counts)
+
+    def invalidate(self, user_id: str) -> None:
+        """Drop a user's counts so the next snapshot reloads them."""
+        with self._lock:
+            self._counts.pop(user_id, None)
+
+    def is_seeded(self, user_id: str) -> bool:
+        with self._lock:
+            return user_id in self._counts
+
+    def snapshot(self, user_id: str) -> Dict[str, int]:
+        """Combined direct + group counts for `unread_counts_update`."""
+        with self._lock:
+            counts = self._counts.get(user_id)
+            if counts is not None:
+                return dict(counts)
+        return self.seed(user_id)
+
+    # --- deltas ---
+    def _add(self, user_id: str, key: str, delta: int) -> None:
+        with self._lock:
+            counts = self._counts.get(user_id)
+            if counts is None:
+                return
+            value = counts.get(key, 0) + delta
+            if value > 0:
+                counts[key] = value
+            else:
+                counts.pop(key, None)
+
+    def on_direct_message(self, sender_id: str, receiver_id: str) -> None:
+        self._add(receiver_id, sender_id, 1)
+
+    def on_direct_read(self, receiver_id: str, sender_id: str, count: int = 1) -> None:
+        self._add(receiver_id, sender_id, -count)
+
+    def on_group_message(self, group_id, sender_id: str, member_ids: Iterable[str]) -> None:
+        key = f"group_{group_id}"
+        for uid in member_ids:
+            if uid != sender_id:
+                self._add(uid, key, 1)
+
+    def on_group_seen(self, user_id: str, group_id, count: int = 1) -> None:
+        self._add(user_id, f"group_{group_id}", -count)
+
+
+class RedisUnreadLedger(UnreadLedger):
+    """
+    UnreadLedger kept in Redis hashes ('unread:<user_id>') so every worker
+    reads and updates the same counters.
+
+    A marker field tells a seeded user with nothing unread apart from one
+    that was never loaded; deltas for unseeded users are still ignored.
+    Hashes expire `ttl` seconds after their last seed. If Redis is
+    unreachable, snapshots are served straight from the database and deltas
+    are dropped (the next seed corrects them).
+    """
+
+    _MARKER = '_seeded'
+    # Conditional HINCRBY: only touch users that are seeded, drop zeroed keys
+    _ADD_SCRIPT = """
+    if redis.call('EXISTS', KEYS[1]) == 0 then return nil end
+    local v = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+    if v <= 0 then redis.call('HDEL', KEYS[1], ARGV[1]) end
+    return v
+    """
+
+    def __init__(self, db, client, ttl: int = 86400, prefix: str = 'unread:'):
+        super().__init__(db)
+        self._client = client
+        self.ttl = ttl
+        self._prefix = prefix
+        self._add_script = client.register_script(self._ADD_SCRIPT)
+
+    def _key(self, user_id: str) -> str:
+        return f"{self._prefix}{user_id}"
+
+    def seed(self, user_id: str) -> Dict[str, int]:
+        summary = self._db.get_unread_summary(user_id)
+        counts = {k: int(v) for k, v in summary.items() if v}
+        key = self._key(user_id)
+        pipe = self._client.pipeline()
+        pipe.delete(key)
+        pipe.hset(key, mapping={self._MARKER: 1, **counts})
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+        return dict(counts)
+
+    def invalidate(self, user_id: str) -> None:
+        self._client.delete(self._key(user_id))
+
+    def is_seeded(self, user_id: str) -> bool:
+        return bool(self._client.exists(self._key(user_id)))
+
+    def snapshot(self, user_id: str) -> Dict[str, int]:
+        try:
+            data = self._client.hgetall(self._key(user_id))
+            if not data:
+                return self.seed(user_id)
+        except Exception:
+            summary = self._db.get_unread_summary(user_id)
+            return {k: int(v) for k, v in summary.items() if v}
+        return {k: int(v) for k, v in data.items() if k != self._MARKER and int(v) > 0}
+
+    def _add(self, user_id: str, key: str, delta: int) -> None:
+        try:
+            self._add_script(keys=[self._key(user_id)], args=[key, delta])
+        except Exception:
+            pass
+
+    def on_group_message(self, group_id, sender_id: str, member_ids: Iterable[str]) -> None:
+        key = f"group_{group_id}"
+        pipe = self._client.pipeline(transaction=False)
+        for uid in member_ids:
+            if uid != sender_id:
+                self._add_script(keys=[self._key(uid)], args=[key, 1], client=pipe)
+        try:
+            pipe.execute()
+        except Exception:
+            pass
@@ -0,0 +1,84 @@
+import os
+import re
+import threading
+import time
+from typing import Dict, Optional
+
+# Legacy upload names were stored as '<prefix>_<original>' or '<prefix>-<original>'
+_SEPARATORS = re.compile(r'[_-]')
+# Upper bound on remembered misses; the negative cache is reset past this
+MAX_NEGATIVE_ENTRIES = 10000
+
+
+class UploadNameIndex:
+    """
+    In-memory basename/suffix index of the files directly inside one upload
+    directory, for resolving legacy names without listing the directory.
+
+    Every file is indexed under its full name and under each suffix that
+    follows a '_' or '-', so 'photo.jpg' finds 'a1b2_photo.jpg'. The index
+    is rebuilt when the directory's mtime changes (checked at most every
+    `poll_interval` seconds); names confirmed missing are remembered for
+    `negative_ttl` seconds or until the next rebuild.
+    """
+
+    def __init__(self, directory: str, poll_interval: float = 5.0, negative_ttl: float = 60.0):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._names: Dict[str, str] = {}
+        self._missing: Dict[str, float] = {}
+        self._dir_mtime = None
+        self._checked_at = 0.0
+
+    def refresh(self) -> None:
+        """Rebuild the index from a single directory scan"""
+        try:
+            mtime = os.stat(self.directory).st_mtime
+            entries = [e.name for e in os.scandir(self.directory) if e.is_file()]
+        except FileNotFoundError:
+            mtime, entries = None, []
+        names: Dict[str, str] = {}
+        # Sorted so the same directory always resolves a suffix to the same file
+        for name in sorted(entries):
+            names.setdefault(name, name)
+            for m in _SEPARATORS.finditer(name):
+                suffix = name[m.end():]
+                if suffix:
+                    names.setdefault(suffix, name)
+        with self._lock:
+            self._names = names
+            self._missing = {}
+            self._dir_mtime = mtime
+            self._checked_at = time.monotonic()
+
+    def _maybe_refresh(self) -> None:
+        now = time.monotonic()
+        if now - self._checked_at < self.poll_interval:
+            return
+        try:
+            mtime = os.stat(self.directory).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._dir_mtime:
+            self.refresh()
+        else:
+            self._checked_at = now
+
+    def find(self, legacy_name: str) -> Optional[str]:
+        """Stored filename (inside `directory`) for a legacy name, or None"""
+        self._maybe_refresh()
+        now = time.monotonic()
+        with self._lock:
+            missing_at = self._missing.get(legacy_name)
+            if missing_at is not None and now - missing_at < self.negative_ttl:
+                return None
+            stored = self._names.get(legacy_name)
+        if stored and os.path.isfile(os.path.join(self.directory, stored)):
+            return stored
+        with self._lock:
+            if len(self._missing) >= MAX_NEGATIVE_ENTRIES:
+                self._missing = {}
+            self._missing[legacy_name] = now
+        return None
@@ -0,0 +1,155 @@
+import hashlib
+import os
+import secrets
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Bytes read from the request stream per write/hash step
+STREAM_BLOCK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """Client-facing upload failure; `status` is the HTTP status to return"""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+class _UploadSession:
+    def __init__(self, upload_id, user_id, filename, size, mime, temp_path):
+        self.upload_id = upload_id
+        self.user_id = user_id
+        self.filename = filename
+        self.size = size
+        self.mime = mime
+        self.temp_path = temp_path
+        self.received = 0
+        self.sha256 = hashlib.sha256()
+        self.head = b''  # first bytes, kept for type sniffing at finalize
+        self.result: Optional[Dict[str, Any]] = None
+        self.touched_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def to_dict(self):
+        data = {
+            'upload_id': self.upload_id,
+            'offset': self.received,
+            'size': self.size,
+            'complete': self.result is not None,
+        }
+        if self.result:
+            data.update(self.result)
+        return data
+
+
+class ChunkedUploadStore:
+    """
+    Resumable chunked uploads streamed to a temp file.
+
+    Each chunk is appended at the offset the client claims; a mismatch is
+    rejected with the current offset so the client can resume from there.
+    The SHA-256 is computed while writing, and once the declared size has
+    arrived `finalize(session)` is called to validate and store the file.
+    It must return (True, result_dict) or (False, error_message).
+    """
+
+    def __init__(self, temp_dir: str, max_size: int,
+                 finalize: Callable[['_UploadSession'], Tuple[bool, Any]],
+                 chunk_size: int = 1024 * 1024, ttl: float = 3600):
+        self.temp_dir = temp_dir
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+        self._finalize = finalize
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, _UploadSession] = {}
+        os.makedirs(self.temp_dir, exist_ok=True)
+
+    def create(self, user_id: str, filename: str, size: int, mime: Optional[str] = None) -> _UploadSession:
+        if not size or size <= 0:
+            raise UploadError('Missing or invalid file size')
+        if size > self.max_size:
+            raise UploadError(f"File size exceeds {self.max_size / (1024 * 1024)}MB", status=413)
+        self.expire()
+        upload_id = secrets.token_urlsafe(18)
+        temp_path = os.path.join(self.temp_dir, f"{upload_id}.part")
+        open(temp_path, 'wb').close()
+        session = _UploadSession(upload_id, user_id, filename, size, (mime or '').lower() or None, temp_path)
+        with self._lock:
+            self._sessions[upload_id] = session
+        return session
+
+    def get(self, upload_id: str, user_id: str) -> _UploadSession:
+        with self._lock:
+            session = self._sessions.get(upload_id)
+        if session is None or session.user_id != user_id:
+            raise UploadError('Unknown upload', status=404)
+        session.touched_at = time.monotonic()
+        return session
+
+    def append(self, upload_id: str, user_id: str, offset: int, stream) -> _UploadSession:
+        """Stream one chunk from a file-like `stream` into the upload at `offset`"""
+        session = self.get(upload_id, user_id)
+        # Never wait for another request's chunk: that would hold this worker
+        # (or, under gevent, the hub) while the other body is still streaming
+        if not session.lock.acquire(blocking=False):
+            raise UploadError('Another chunk for this upload is in progress', status=409, offset=session.received)
+        try:
+            if session.result is not None:
+                return session
+            if offset != session.received:
+                raise UploadError('Offset mismatch', status=409, offset=session.received)
+            with open(session.temp_path, 'ab') as f:
+                while True:
+                    block = stream.read(STREAM_BLOCK_SIZE)
+                    if not block:
+                        break
+                    if session.received + len(block) > session.size:
+                        raise UploadError('Chunk exceeds declared size', status=413, offset=session.received)
+                    f.write(block)
+                    session.sha256.update(block)
+                    if len(session.head) < 64:
+                        session.head = (session.head + block)[:64]
+                    session.received += len(block)
+            if session.received == session.size:
+                ok, result = self._finalize(session)
+                if not ok:
+                    self.discard(session)
+                    raise UploadError(result)
+                session.result = result
+                self._remove_temp(session)
+        finally:
+            session.lock.release()
+        return session
+
+    def resolve(self, upload_id: str, user_id: str) -> Dict[str, Any]:
+        """Stored-file details for a completed upload token"""
+        session = self.get(upload_id, user_id)
+        if session.result is None:
+            raise UploadError('Upload not complete', status=409, offset=session.received)
+        return dict(session.result)
+
+    def discard(self, session: _UploadSession) -> None:
+        with self._lock:
+            self._sessions.pop(session.upload_id, None)
+        self._remove_temp(session)
+
+    def expire(self) -> None:
+        """Drop sessions idle for longer than the TTL"""
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            stale = [s for s in self._sessions.values() if s.touched_at < cutoff]
+            for session in stale:
+                self._sessions.pop(session.upload_id, None)
+        for session in stale:
+            self._remove_temp(session)
+
+    @staticmethod
+    def _remove_temp(session: _UploadSession) -> None:
+        try:
+            os.remove(session.temp_path)
+        except FileNotFoundError:
+            pass